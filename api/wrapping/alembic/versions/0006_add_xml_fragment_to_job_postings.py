@@ -0,0 +1,32 @@
+"""add xml_fragment to job_postings
+
+Revision ID: 0006_add_xml_fragment_to_job_postings
+Revises: 0005_create_job_posting_pre
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+revision: str = "0006_add_xml_fragment_to_job_postings"
+down_revision: Union[str, None] = "0005_create_job_posting_pre"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Pre-rendered <job> element; filled by the pipeline and by scripts/backfill_xml_fragments.py.
+    # MEDIUMTEXT on MySQL because the fragment embeds the TEXT description plus markup.
+    op.add_column(
+        "job_postings",
+        sa.Column("xml_fragment", sa.Text().with_variant(mysql.MEDIUMTEXT(), "mysql"), nullable=True),
+        schema="lw",
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("job_postings", "xml_fragment", schema="lw")
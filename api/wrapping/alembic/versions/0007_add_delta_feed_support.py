@@ -0,0 +1,39 @@
+"""add updated_at index and job_posting_tombstones for the delta feed
+
+Revision ID: 0007_add_delta_feed_support
+Revises: 0006_add_xml_fragment_to_job_postings
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0007_add_delta_feed_support"
+down_revision: Union[str, None] = "0006_add_xml_fragment_to_job_postings"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_job_postings_updated_at", "job_postings", ["updated_at"], schema="lw")
+
+    # Postings removed by the pipeline, surfaced as deletions by /wrapping?since=...
+    op.create_table(
+        "job_posting_tombstones",
+        sa.Column("id", sa.BigInteger(), primary_key=True, nullable=False, autoincrement=True),
+        sa.Column("partner_job_id", sa.String(length=255), nullable=False),
+        sa.Column("deleted_at", sa.DateTime(), nullable=False),
+        schema="lw",
+    )
+    op.create_index("ix_job_posting_tombstones_partner_job_id", "job_posting_tombstones", ["partner_job_id"], schema="lw")
+    op.create_index("ix_job_posting_tombstones_deleted_at", "job_posting_tombstones", ["deleted_at"], schema="lw")
+
+
+def downgrade() -> None:
+    op.drop_index("ix_job_posting_tombstones_deleted_at", table_name="job_posting_tombstones", schema="lw")
+    op.drop_index("ix_job_posting_tombstones_partner_job_id", table_name="job_posting_tombstones", schema="lw")
+    op.drop_table("job_posting_tombstones", schema="lw")
+    op.drop_index("ix_job_postings_updated_at", table_name="job_postings", schema="lw")
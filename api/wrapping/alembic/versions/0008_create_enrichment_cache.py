@@ -0,0 +1,37 @@
+"""create enrichment_cache table
+
+Revision ID: 0008_create_enrichment_cache
+Revises: 0007_add_delta_feed_support
+Create Date: 2026-10-18 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+revision: str = "0008_create_enrichment_cache"
+down_revision: Union[str, None] = "0007_add_delta_feed_support"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Cache delle descrizioni migliorate da OpenAI, chiave sha256(prompt, modello, descrizione normalizzata)
+    op.create_table(
+        "enrichment_cache",
+        sa.Column("cache_key", sa.String(length=64), primary_key=True, nullable=False),
+        sa.Column("improved_description", sa.Text().with_variant(mysql.MEDIUMTEXT(), "mysql"), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("last_used_at", sa.DateTime(), nullable=False),
+        sa.Column("hits", sa.Integer(), nullable=False, server_default=sa.text("0")),
+        schema="lw",
+    )
+    op.create_index("ix_enrichment_cache_last_used_at", "enrichment_cache", ["last_used_at"], schema="lw")
+
+
+def downgrade() -> None:
+    op.drop_index("ix_enrichment_cache_last_used_at", table_name="enrichment_cache", schema="lw")
+    op.drop_table("enrichment_cache", schema="lw")
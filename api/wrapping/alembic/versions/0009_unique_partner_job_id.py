@@ -0,0 +1,39 @@
+"""add unique indexes on partner_job_id to job_postings and job_posting_pre
+
+Revision ID: 0009_unique_partner_job_id
+Revises: 0008_create_enrichment_cache
+Create Date: 2026-10-18 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0009_unique_partner_job_id"
+down_revision: Union[str, None] = "0008_create_enrichment_cache"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _drop_duplicates(table: str) -> None:
+    # Keep the most recent row (highest id) for each partner_job_id; the derived table
+    # lets MySQL delete from the table it reads
+    table_name = table if op.get_bind().dialect.name == "mysql" else f"lw.{table}"
+    op.execute(sa.text(
+        f"DELETE FROM {table_name} WHERE partner_job_id IS NOT NULL AND id NOT IN ("
+        f"SELECT keep_id FROM (SELECT MAX(id) AS keep_id FROM {table_name} "
+        f"WHERE partner_job_id IS NOT NULL GROUP BY partner_job_id) AS kept)"
+    ))
+
+
+def upgrade() -> None:
+    for table in ("job_postings", "job_posting_pre"):
+        _drop_duplicates(table)
+        op.create_index(f"ix_{table}_partner_job_id", table, ["partner_job_id"], unique=True, schema="lw")
+
+
+def downgrade() -> None:
+    for table in ("job_posting_pre", "job_postings"):
+        op.drop_index(f"ix_{table}_partner_job_id", table_name=table, schema="lw")
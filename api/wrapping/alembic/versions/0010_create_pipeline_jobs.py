@@ -0,0 +1,46 @@
+"""create pipeline_jobs state table for resumable enrichment runs
+
+Revision ID: 0010_create_pipeline_jobs
+Revises: 0009_unique_partner_job_id
+Create Date: 2026-10-18 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0010_create_pipeline_jobs"
+down_revision: Union[str, None] = "0009_unique_partner_job_id"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "pipeline_jobs",
+        sa.Column("partner_job_id", sa.String(length=255), primary_key=True, nullable=False),
+        sa.Column("status", sa.String(length=16), nullable=False, server_default="pending"),
+        sa.Column("attempts", sa.Integer(), nullable=False, server_default=sa.text("0")),
+        sa.Column("last_error", sa.Text(), nullable=True),
+        sa.Column("next_attempt_at", sa.DateTime(), nullable=True),
+        sa.Column("worker_id", sa.String(length=255), nullable=True),
+        sa.Column("claim_token", sa.String(length=32), nullable=True),
+        sa.Column("claimed_at", sa.DateTime(), nullable=True),
+        sa.Column("finished_at", sa.DateTime(), nullable=True),
+        sa.Column("duration_ms", sa.Integer(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        schema="lw",
+    )
+    op.create_index("ix_pipeline_jobs_status", "pipeline_jobs", ["status"], schema="lw")
+    op.create_index("ix_pipeline_jobs_next_attempt_at", "pipeline_jobs", ["next_attempt_at"], schema="lw")
+    op.create_index("ix_pipeline_jobs_claim_token", "pipeline_jobs", ["claim_token"], schema="lw")
+
+
+def downgrade() -> None:
+    op.drop_index("ix_pipeline_jobs_claim_token", table_name="pipeline_jobs", schema="lw")
+    op.drop_index("ix_pipeline_jobs_next_attempt_at", table_name="pipeline_jobs", schema="lw")
+    op.drop_index("ix_pipeline_jobs_status", table_name="pipeline_jobs", schema="lw")
+    op.drop_table("pipeline_jobs", schema="lw")
@@ -0,0 +1,31 @@
+"""add description_hash and content_hash fingerprints to job_postings and job_posting_pre
+
+Revision ID: 0011_add_content_fingerprints
+Revises: 0010_create_pipeline_jobs
+Create Date: 2026-10-18 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0011_add_content_fingerprints"
+down_revision: Union[str, None] = "0010_create_pipeline_jobs"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # NULL on existing job_postings rows: the pipeline adopts the current job_posting_pre
+    # fingerprints as baseline instead of re-enriching everything
+    for table in ("job_postings", "job_posting_pre"):
+        op.add_column(table, sa.Column("description_hash", sa.String(length=64), nullable=True), schema="lw")
+        op.add_column(table, sa.Column("content_hash", sa.String(length=64), nullable=True), schema="lw")
+
+
+def downgrade() -> None:
+    for table in ("job_posting_pre", "job_postings"):
+        op.drop_column(table, "content_hash", schema="lw")
+        op.drop_column(table, "description_hash", schema="lw")
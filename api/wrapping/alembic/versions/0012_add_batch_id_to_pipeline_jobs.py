@@ -0,0 +1,27 @@
+"""add batch_id to pipeline_jobs so bulk mode resumes its OpenAI batches from the database
+
+Revision ID: 0012_add_batch_id_to_pipeline_jobs
+Revises: 0011_add_content_fingerprints
+Create Date: 2026-10-18 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0012_add_batch_id_to_pipeline_jobs"
+down_revision: Union[str, None] = "0011_add_content_fingerprints"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("pipeline_jobs", sa.Column("batch_id", sa.String(length=64), nullable=True), schema="lw")
+    op.create_index("ix_pipeline_jobs_batch_id", "pipeline_jobs", ["batch_id"], schema="lw")
+
+
+def downgrade() -> None:
+    op.drop_index("ix_pipeline_jobs_batch_id", table_name="pipeline_jobs", schema="lw")
+    op.drop_column("pipeline_jobs", "batch_id", schema="lw")
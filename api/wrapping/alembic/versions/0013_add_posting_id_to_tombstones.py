@@ -0,0 +1,28 @@
+"""add posting_id to job_posting_tombstones so a removal only invalidates the page covering it
+
+Revision ID: 0013_add_posting_id_to_tombstones
+Revises: 0012_add_batch_id_to_pipeline_jobs
+Create Date: 2026-10-18 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0013_add_posting_id_to_tombstones"
+down_revision: Union[str, None] = "0012_add_batch_id_to_pipeline_jobs"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # NULL on existing tombstones: they keep invalidating every page until pruned
+    op.add_column("job_posting_tombstones", sa.Column("posting_id", sa.Integer(), nullable=True), schema="lw")
+    op.create_index("ix_job_posting_tombstones_posting_id", "job_posting_tombstones", ["posting_id"], schema="lw")
+
+
+def downgrade() -> None:
+    op.drop_index("ix_job_posting_tombstones_posting_id", table_name="job_posting_tombstones", schema="lw")
+    op.drop_column("job_posting_tombstones", "posting_id", schema="lw")
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import os
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+try:
+    import brotli  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    brotli = None  # type: ignore
+
+try:
+    import zstandard  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    zstandard = None  # type: ignore
+
+
+GZIP_LEVEL = int(os.getenv("WRAPPING_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("WRAPPING_BROTLI_QUALITY", "5"))
+ZSTD_LEVEL = int(os.getenv("WRAPPING_ZSTD_LEVEL", "6"))
+
+
+class _GzipStream:
+    def __init__(self) -> None:
+        # wbits=31 makes zlib emit a gzip header and trailer
+        self._obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush()
+
+
+class _BrotliStream:
+    def __init__(self) -> None:
+        self._obj = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.process(data)
+
+    def flush(self) -> bytes:
+        return self._obj.finish()
+
+
+class _ZstdStream:
+    def __init__(self) -> None:
+        self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush()
+
+
+# Supported content codings in server preference order
+_STREAMS: Dict[str, Callable[[], object]] = {}
+if brotli is not None:
+    _STREAMS["br"] = _BrotliStream
+if zstandard is not None:
+    _STREAMS["zstd"] = _ZstdStream
+_STREAMS["gzip"] = _GzipStream
+
+SUPPORTED_ENCODINGS = tuple(_STREAMS)
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Pick the content coding for a response from an Accept-Encoding header.
+    Returns None for identity. Client q-values win; ties go to the server preference order.
+    """
+    if not accept_encoding:
+        return None
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding] = q
+
+    best: Optional[str] = None
+    best_q = 0.0
+    for coding in SUPPORTED_ENCODINGS:
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def iter_compressed(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    """Compress a stream of chunks incrementally, yielding output as it becomes available."""
+    stream = _STREAMS[encoding]()
+    for chunk in chunks:
+        out = stream.compress(chunk)
+        if out:
+            yield out
+    yield stream.flush()
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """Compress a complete body with the given content coding."""
+    return b"".join(iter_compressed((body,), encoding))
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, NamedTuple, TypeVar
+
+from utils.metrics import Counter, Histogram
+
+
+T = TypeVar("T")
+
+# Documents served by the wrapping endpoints; every label combination is created at import
+FEED_KINDS = ("feed", "page", "delta", "index")
+
+ROW_BUCKETS = (0, 10, 100, 1000, 5000, 10000, 50000, 100000, 500000)
+
+WRAPPING_DB_FETCH_SECONDS = Histogram(
+    "wrapping_db_fetch_seconds",
+    "Time spent in database queries and fetching rows per request",
+    ["kind"],
+)
+WRAPPING_RENDER_SECONDS = Histogram(
+    "wrapping_render_seconds",
+    "Time spent rendering XML per document build, excluding row fetching",
+    ["kind"],
+)
+WRAPPING_ENCODE_SECONDS = Histogram(
+    "wrapping_encode_seconds",
+    "Time spent compressing the body per document build",
+    ["kind"],
+)
+WRAPPING_ROWS = Histogram(
+    "wrapping_rows",
+    "Rows rendered per document build (jobs, or pages for the index)",
+    ["kind"],
+    buckets=ROW_BUCKETS,
+)
+WRAPPING_RESPONSE_BYTES = Counter(
+    "wrapping_response_bytes_total",
+    "Body bytes sent, after compression",
+    ["kind"],
+)
+
+
+class _FeedSeries(NamedTuple):
+    fetch: Any
+    render: Any
+    encode: Any
+    rows: Any
+    bytes: Any
+
+
+_SERIES: Dict[str, _FeedSeries] = {
+    kind: _FeedSeries(
+        WRAPPING_DB_FETCH_SECONDS.labels(kind),
+        WRAPPING_RENDER_SECONDS.labels(kind),
+        WRAPPING_ENCODE_SECONDS.labels(kind),
+        WRAPPING_ROWS.labels(kind),
+        WRAPPING_RESPONSE_BYTES.labels(kind),
+    )
+    for kind in FEED_KINDS
+}
+
+
+class FeedBuild:
+    """
+    Time split of one wrapping request. The layers of a streamed body are timed cumulatively (row fetching
+    inside rendering inside compression), so render and encode times are obtained by subtraction.
+    """
+
+    __slots__ = ("_series", "query_s", "row_fetch_s", "render_s", "encode_s", "rows", "bytes_sent")
+
+    def __init__(self, kind: str):
+        self._series = _SERIES[kind]
+        self.query_s = 0.0
+        self.row_fetch_s = 0.0
+        self.render_s = 0.0
+        self.encode_s = 0.0
+        self.rows = 0
+        self.bytes_sent = 0
+
+    def fetch(self, query: Callable[..., T], *args) -> T:
+        """Run a database query, adding its time to the fetch time."""
+        started = time.perf_counter()
+        try:
+            return query(*args)
+        finally:
+            self.query_s += time.perf_counter() - started
+
+    def _timed(self, items: Iterable[T], attribute: str) -> Iterator[T]:
+        iterator = iter(items)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                setattr(self, attribute, getattr(self, attribute) + time.perf_counter() - started)
+            yield item
+
+    def rows_from(self, rows: Iterable[T]) -> Iterator[T]:
+        """Pass database rows through, counting them and timing their fetch."""
+        for row in self._timed(rows, "row_fetch_s"):
+            self.rows += 1
+            yield row
+
+    def rendered(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Pass rendered chunks through, timing the render (row fetching included)."""
+        return self._timed(chunks, "render_s")
+
+    def encoded(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Pass compressed chunks through, timing the compression (render included)."""
+        return self._timed(chunks, "encode_s")
+
+    def observe_fetch(self) -> None:
+        """Record a request answered without building the document (304 or cached snapshot)."""
+        self._series.fetch.observe(self.query_s + self.row_fetch_s)
+        self._series.bytes.inc(self.bytes_sent)
+
+    def observe_build(self, encoded: bool) -> None:
+        """Record a completed document build."""
+        self._series.render.observe(max(self.render_s - self.row_fetch_s, 0.0))
+        if encoded:
+            self._series.encode.observe(max(self.encode_s - self.render_s, 0.0))
+        self._series.rows.observe(self.rows)
+        self.observe_fetch()
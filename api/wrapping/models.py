@@ -1,9 +1,10 @@
 from __future__ import annotations
 
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Optional
 
+from sqlalchemy import text
 from sqlalchemy.engine.url import make_url
 from sqlmodel import SQLModel, Field
 
@@ -18,6 +19,11 @@ def _resolve_schema() -> dict:
     return {"schema": "lw"}
 
 
+def utc_now() -> datetime:
+    """Current time as naive UTC, the convention of every timestamp column (the feed serves them as UTC)."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class JobPostings(SQLModel, table=True):
     __tablename__ = "job_postings"
     __table_args__ = _resolve_schema()
@@ -32,12 +38,21 @@ class JobPostings(SQLModel, table=True):
     workplace_types: str | None = None
     experience_level: str | None = None
     jobtype: str | None = None
-    partner_job_id: str | None = None
+    # Unique: the pipeline upserts on it and the delta feed keys deletions by it
+    partner_job_id: str | None = Field(default=None, unique=True, index=True, max_length=255)
     last_build_date: datetime | None = None
-    created_at: datetime | None = Field(default=None, sa_column_kwargs={"server_default": "CURRENT_TIMESTAMP"})
+    # Pre-rendered <job> element served verbatim by /wrapping; must be refreshed whenever
+    # the feed fields change (NULL means render on the fly)
+    xml_fragment: str | None = None
+    # Fingerprints of the job_posting_pre content this row was built from (see scripts/diff_engine.py)
+    description_hash: str | None = Field(default=None, max_length=64)
+    content_hash: str | None = Field(default=None, max_length=64)
+    created_at: datetime | None = Field(default=None, sa_column_kwargs={"server_default": text("CURRENT_TIMESTAMP")})
+    # Indexed for the delta feed (/wrapping?since=...)
     updated_at: datetime | None = Field(
         default=None,
-        sa_column_kwargs={"server_default": "CURRENT_TIMESTAMP", "onupdate": datetime.now}
+        index=True,
+        sa_column_kwargs={"server_default": text("CURRENT_TIMESTAMP"), "onupdate": utc_now}
     )
 
 
@@ -55,11 +70,60 @@ class JobPostingPre(SQLModel, table=True):
     workplace_types: str | None = None
     experience_level: str | None = None
     jobtype: str | None = None
-    partner_job_id: str | None = None
+    partner_job_id: str | None = Field(default=None, unique=True, index=True, max_length=255)
     last_build_date: datetime | None = None
-    created_at: datetime | None = Field(default=None, sa_column_kwargs={"server_default": "CURRENT_TIMESTAMP"})
+    # Content fingerprints computed by the enrichment pipeline (see scripts/diff_engine.py)
+    description_hash: str | None = Field(default=None, max_length=64)
+    content_hash: str | None = Field(default=None, max_length=64)
+    created_at: datetime | None = Field(default=None, sa_column_kwargs={"server_default": text("CURRENT_TIMESTAMP")})
     updated_at: datetime | None = Field(
         default=None,
-        sa_column_kwargs={"server_default": "CURRENT_TIMESTAMP", "onupdate": datetime.now}
+        sa_column_kwargs={"server_default": text("CURRENT_TIMESTAMP"), "onupdate": utc_now}
     )
 
+
+class JobPostingTombstone(SQLModel, table=True):
+    """Records a job posting removed from job_postings, so delta feed consumers can drop it."""
+    __tablename__ = "job_posting_tombstones"
+    __table_args__ = _resolve_schema()
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    partner_job_id: str = Field(index=True)
+    deleted_at: datetime = Field(index=True)
+    # job_postings.id of the removed row: a removal only invalidates the feed page covering that id
+    posting_id: Optional[int] = Field(default=None, index=True)
+
+
+class EnrichmentCacheEntry(SQLModel, table=True):
+    """OpenAI-improved description keyed by a hash of (prompt, model, normalized original description)."""
+    __tablename__ = "enrichment_cache"
+    __table_args__ = _resolve_schema()
+
+    cache_key: str = Field(primary_key=True, max_length=64)
+    improved_description: str
+    created_at: datetime
+    last_used_at: datetime = Field(index=True)
+    hits: int = 0
+
+
+class PipelineJob(SQLModel, table=True):
+    """Enrichment pipeline work item for one partner_job_id: claimed by workers and checkpointed as it progresses."""
+    __tablename__ = "pipeline_jobs"
+    __table_args__ = _resolve_schema()
+
+    partner_job_id: str = Field(primary_key=True, max_length=255)
+    # pending | enriching | done | failed
+    status: str = Field(default="pending", index=True, max_length=16)
+    attempts: int = 0
+    last_error: str | None = None
+    # Failed items are not claimed again before this time (exponential backoff)
+    next_attempt_at: datetime | None = Field(default=None, index=True)
+    worker_id: str | None = Field(default=None, max_length=255)
+    claim_token: str | None = Field(default=None, index=True, max_length=32)
+    claimed_at: datetime | None = None
+    # OpenAI batch (--bulk mode) the enriching item was submitted with; polled again after a restart
+    batch_id: str | None = Field(default=None, index=True, max_length=64)
+    finished_at: datetime | None = None
+    duration_ms: int | None = None
+    created_at: datetime
+    updated_at: datetime
@@ -1,7 +1,19 @@
-from sqlmodel import Session, select
-from typing import List
+import os
+from datetime import datetime
+from sqlalchemy import and_, case, null, or_
+from sqlmodel import Session, select, func, col
+from typing import Any, Iterator, List, NamedTuple, Type, TypeVar
 
-from api.wrapping.models import JobPostings
+from api.wrapping.models import JobPostings, JobPostingTombstone
+
+
+# Number of rows fetched from the database per round trip when iterating
+FETCH_BATCH_SIZE = int(os.getenv("WRAPPING_FETCH_BATCH_SIZE", "500"))
+
+# Number of job postings per paginated feed page
+PAGE_SIZE = int(os.getenv("WRAPPING_PAGE_SIZE", "1000"))
+
+ModelT = TypeVar("ModelT")
 
 
 def get_available_job_postings(session: Session) -> List[JobPostings]:
@@ -14,3 +26,234 @@ def get_available_job_postings(session: Session) -> List[JobPostings]:
     return list(results.all())
 
 
+def streams_results(session: Session) -> bool:
+    """
+    Whether the session's driver can stream rows from a server-side cursor (psycopg2, mysqlclient, PyMySQL).
+    mysql-connector-python buffers the whole result set client-side, so it reports False like SQLite.
+    """
+    return bool(session.get_bind().dialect.supports_server_side_cursors)
+
+
+# Columns rendered into JobPostings.xml_fragment: the feed only needs them for rows without a fragment
+_FRAGMENT_COLUMNS = (
+    JobPostings.position,
+    JobPostings.description,
+    JobPostings.company,
+    JobPostings.apply_url,
+    JobPostings.company_id,
+    JobPostings.location,
+    JobPostings.workplace_types,
+    JobPostings.experience_level,
+    JobPostings.jobtype,
+)
+
+
+def feed_columns() -> tuple:
+    """
+    Columns selected to render feed rows. The stored fragment already holds the rendered fields,
+    so they are returned as NULL (and never leave the database) unless the fragment is missing.
+    The resulting rows expose the same attribute names as JobPostings.
+    """
+    no_fragment = or_(JobPostings.xml_fragment.is_(None), JobPostings.xml_fragment == "")
+    return (
+        JobPostings.id,
+        JobPostings.partner_job_id,
+        JobPostings.last_build_date,
+        JobPostings.xml_fragment,
+        *(case((no_fragment, column), else_=null()).label(column.key) for column in _FRAGMENT_COLUMNS),
+    )
+
+
+def iter_all(
+    session: Session, model: Type[ModelT], batch_size: int = FETCH_BATCH_SIZE, where=None, columns=None
+) -> Iterator[ModelT]:
+    """
+    Iterate over every row of a table (optionally filtered by the where clause) ordered by id,
+    holding at most batch_size rows in memory. With columns, plain rows of those columns are
+    yielded instead of model instances.
+    Drivers with server-side cursors stream a single query (yield_per implies stream_results);
+    the others fall back to keyset pagination on the primary key.
+    """
+    base = select(*columns) if columns else select(model)
+    if where is not None:
+        base = base.where(where)
+    if streams_results(session):
+        statement = base.order_by(model.id).execution_options(yield_per=batch_size)
+        yield from session.exec(statement)
+        return
+
+    last_id = None
+    while True:
+        statement = base.order_by(model.id).limit(batch_size)
+        if last_id is not None:
+            statement = statement.where(model.id > last_id)
+        rows = session.exec(statement).all()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1].id
+
+
+def iter_available_job_postings(session: Session, batch_size: int = FETCH_BATCH_SIZE) -> Iterator[Any]:
+    """
+    Streaming variant of get_available_job_postings, yielding feed rows (see feed_columns).
+    Memory is bounded by batch_size instead of the table size.
+    """
+    return iter_all(session, JobPostings, batch_size, columns=feed_columns())
+
+
+class FeedState(NamedTuple):
+    """Cheap aggregate describing the current content of job_postings."""
+    row_count: int
+    max_id: int | None
+    max_updated_at: datetime | None
+    last_build_date: datetime | None
+    # Latest removal recorded in job_posting_tombstones: deletions change no remaining row's timestamps
+    last_deleted_at: datetime | None = None
+
+
+def _last_deleted_at():
+    return select(func.max(JobPostingTombstone.deleted_at)).scalar_subquery()
+
+
+def get_feed_state(session: Session) -> FeedState:
+    """
+    Return row count, max id, max updated_at, max last_build_date and the latest tombstone in a single query.
+    Any insert, delete or ORM update of job_postings changes at least one of the values,
+    so the result doubles as a change token for the rendered feed.
+    """
+    statement = select(
+        func.count(JobPostings.id),
+        func.max(JobPostings.id),
+        func.max(JobPostings.updated_at),
+        func.max(JobPostings.last_build_date),
+        _last_deleted_at(),
+    )
+    return FeedState(*session.exec(statement).one())
+
+
+class FeedPage(NamedTuple):
+    """A keyset page of the feed: rows with id > after_id, at most PAGE_SIZE of them."""
+    after_id: int
+    state: FeedState
+
+
+def get_page_state(session: Session, after_id: int, page_size: int = PAGE_SIZE) -> FeedState:
+    """
+    Change token of a single keyset page, computed over the page's rows plus the latest tombstone in the
+    page's id range (a removal inside the page leaves the timestamps of its remaining rows unchanged).
+    The range is after_id < id <= the page's last id, open-ended for a partial (last) page; tombstones
+    recorded without posting_id cannot be placed and count for every page.
+    """
+    page = (
+        select(JobPostings.id, JobPostings.updated_at, JobPostings.last_build_date)
+        .where(JobPostings.id > after_id)
+        .order_by(JobPostings.id)
+        .limit(page_size)
+        .subquery()
+    )
+    totals = select(
+        func.count(page.c.id).label("row_count"),
+        func.max(page.c.id).label("max_id"),
+        func.max(page.c.updated_at).label("max_updated_at"),
+        func.max(page.c.last_build_date).label("last_build_date"),
+    ).subquery()
+    in_page = and_(
+        JobPostingTombstone.posting_id > after_id,
+        or_(totals.c.row_count < page_size, JobPostingTombstone.posting_id <= totals.c.max_id),
+    )
+    last_deleted_at = (
+        select(func.max(JobPostingTombstone.deleted_at))
+        .where(or_(JobPostingTombstone.posting_id.is_(None), in_page))
+        .scalar_subquery()
+    )
+    statement = select(
+        totals.c.row_count, totals.c.max_id, totals.c.max_updated_at, totals.c.last_build_date, last_deleted_at
+    )
+    return FeedState(*session.exec(statement).one())
+
+
+def is_page_boundary(session: Session, after_id: int, page_size: int = PAGE_SIZE) -> bool:
+    """
+    Whether after_id starts a page listed in the feed index (0, or the last id of a full page):
+    the number of ids up to after_id is a multiple of page_size and after_id itself exists.
+    A range count on the primary key, much cheaper than rendering the page.
+    """
+    if after_id == 0:
+        return True
+    count, max_id = session.exec(
+        select(func.count(JobPostings.id), func.max(JobPostings.id)).where(JobPostings.id <= after_id)
+    ).one()
+    return max_id == after_id and count % page_size == 0
+
+
+def iter_job_postings_page(session: Session, after_id: int, page_size: int = PAGE_SIZE) -> Iterator[Any]:
+    """Feed rows (see feed_columns) of the keyset page starting after after_id, in id order."""
+    statement = (
+        select(*feed_columns())
+        .where(JobPostings.id > after_id)
+        .order_by(JobPostings.id)
+        .limit(page_size)
+    )
+    yield from session.exec(statement)
+
+
+def iter_feed_pages(session: Session, page_size: int = PAGE_SIZE) -> Iterator[FeedPage]:
+    """
+    Walk the table by keyset pagination on id, reading only id and timestamp columns,
+    and yield the boundaries and change token of every page.
+    """
+    after_id = 0
+    while True:
+        statement = (
+            select(JobPostings.id, JobPostings.updated_at, JobPostings.last_build_date)
+            .where(JobPostings.id > after_id)
+            .order_by(JobPostings.id)
+            .limit(page_size)
+        )
+        rows = session.exec(statement).all()
+        if not rows:
+            return
+        updated = [row[1] for row in rows if row[1] is not None]
+        built = [row[2] for row in rows if row[2] is not None]
+        state = FeedState(
+            row_count=len(rows),
+            max_id=rows[-1][0],
+            max_updated_at=max(updated) if updated else None,
+            last_build_date=max(built) if built else None,
+        )
+        yield FeedPage(after_id=after_id, state=state)
+        after_id = rows[-1][0]
+
+
+def get_delta_state(session: Session, since: datetime) -> FeedState:
+    """Change token of the postings updated after since (served by the updated_at index)."""
+    statement = select(
+        func.count(JobPostings.id),
+        func.max(JobPostings.id),
+        func.max(JobPostings.updated_at),
+        func.max(JobPostings.last_build_date),
+    ).where(JobPostings.updated_at > since)
+    return FeedState(*session.exec(statement).one())
+
+
+def iter_changed_job_postings(
+    session: Session, since: datetime, batch_size: int = FETCH_BATCH_SIZE
+) -> Iterator[Any]:
+    """Feed rows of the postings updated after since, in id order, at most batch_size in memory (see iter_all)."""
+    return iter_all(session, JobPostings, batch_size, where=JobPostings.updated_at > since, columns=feed_columns())
+
+
+def get_tombstones_since(session: Session, since: datetime) -> List[JobPostingTombstone]:
+    """
+    Postings removed after since that have not been published again since.
+    Tombstones are pruned by the pipeline, so the result stays small.
+    """
+    republished = select(JobPostings.id).where(JobPostings.partner_job_id == JobPostingTombstone.partner_job_id)
+    statement = (
+        select(JobPostingTombstone)
+        .where(JobPostingTombstone.deleted_at > since)
+        .where(~republished.exists())
+        .order_by(col(JobPostingTombstone.deleted_at), col(JobPostingTombstone.id))
+    )
+    return list(session.exec(statement).all())
@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+from api.wrapping.encoding import compress
+from api.wrapping.service import FeedState
+
+
+@dataclass(frozen=True)
+class FeedSnapshot:
+    """A fully rendered feed together with the state it was rendered from."""
+    state: FeedState
+    body: bytes
+    # Compressed variants of body, filled once per content coding
+    encoded: Dict[str, bytes] = field(default_factory=dict)
+
+    def body_for(self, encoding: Optional[str]) -> bytes:
+        """Return the body in the given content coding (None for identity), compressing it at most once."""
+        if encoding is None:
+            return self.body
+        body = self.encoded.get(encoding)
+        if body is None:
+            body = compress(self.body, encoding)
+            self.encoded[encoding] = body
+        return body
+
+    @property
+    def size(self) -> int:
+        """Bytes held by the snapshot: the body and every compressed variant."""
+        return len(self.body) + sum(len(body) for body in self.encoded.values())
+
+
+def make_etag(key: Hashable, state: FeedState, encoding: Optional[str] = None) -> str:
+    """Strong ETag derived from the document key and its change token; each content coding gets its own tag."""
+    digest = hashlib.sha1(repr((key, tuple(state))).encode("utf-8")).hexdigest()
+    if encoding:
+        return f'"{digest}-{encoding}"'
+    return f'"{digest}"'
+
+
+def last_modified(state: FeedState) -> Optional[datetime]:
+    """Most recent modification time known for the feed (removals included), as an aware UTC datetime."""
+    candidates = [
+        dt for dt in (state.max_updated_at, state.last_build_date, state.last_deleted_at) if dt is not None
+    ]
+    if not candidates:
+        return None
+    latest = max(candidates)
+    # Database timestamps are stored naive in UTC
+    if latest.tzinfo is None:
+        latest = latest.replace(tzinfo=timezone.utc)
+    return latest.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def format_http_date(dt: datetime) -> str:
+    """Format an aware datetime as an IMF-fixdate (e.g. Mon, 08 Jan 2024 11:34:23 GMT)."""
+    return format_datetime(dt, usegmt=True)
+
+
+def is_not_modified(
+    etag: str,
+    modified_at: Optional[datetime],
+    if_none_match: Optional[str],
+    if_modified_since: Optional[str],
+) -> bool:
+    """Evaluate conditional request headers as described in RFC 9110 section 13.2.2."""
+    if if_none_match:
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        # Weak comparison is what GET conditional requests use
+        return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+    if if_modified_since and modified_at is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return modified_at <= since
+    return False
+
+
+class RenderFlight:
+    """A document render in progress: concurrent requests for the same key and state wait for its snapshot."""
+    __slots__ = ("state", "started_at", "done")
+
+    def __init__(self, state: FeedState, started_at: float) -> None:
+        self.state = state
+        self.started_at = started_at
+        self.done = threading.Event()
+
+
+class SnapshotCache:
+    """
+    Holds rendered feed documents (full feed, pages, index) by key.
+    A snapshot is served only while its state is current; the least recently used keys are evicted once
+    there are more than max_entries of them or they hold more than max_bytes. Documents larger than
+    max_document_bytes are never snapshotted, so the renderer stops buffering them.
+    Renders are single-flight per key and state: the first miss renders, the others wait for its snapshot
+    (at most render_wait_s, after which the render is considered abandoned).
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        max_bytes: int = 256 * 1024 * 1024,
+        max_document_bytes: int = 64 * 1024 * 1024,
+        render_wait_s: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._max_document_bytes = min(max_document_bytes, max_bytes)
+        self._render_wait_s = render_wait_s
+        self._clock = clock
+        self._snapshots: "OrderedDict[Hashable, FeedSnapshot]" = OrderedDict()
+        self._renders: Dict[Hashable, RenderFlight] = {}
+
+    def get(self, key: Hashable, state: FeedState) -> Optional[FeedSnapshot]:
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is None or snapshot.state != state:
+                return None
+            self._snapshots.move_to_end(key)
+            return snapshot
+
+    def accepts(self, size: int) -> bool:
+        """Whether a document of size bytes (all its buffered variants) may be snapshotted."""
+        return size <= self._max_document_bytes
+
+    def put(self, key: Hashable, snapshot: FeedSnapshot) -> None:
+        with self._lock:
+            if not self.accepts(snapshot.size):
+                # The previous snapshot of key is stale anyway
+                self._snapshots.pop(key, None)
+                return
+            self._snapshots[key] = snapshot
+            self._snapshots.move_to_end(key)
+            self._trim()
+
+    def body_for(self, snapshot: FeedSnapshot, encoding: Optional[str]) -> bytes:
+        """snapshot.body_for, keeping the byte budget when a new compressed variant is added."""
+        size = snapshot.size
+        body = snapshot.body_for(encoding)
+        if snapshot.size != size:
+            with self._lock:
+                self._trim()
+        return body
+
+    def _trim(self) -> None:
+        # Called with the lock held; compressed variants are added lazily, so sizes are summed here
+        total = sum(snapshot.size for snapshot in self._snapshots.values())
+        while self._snapshots and (len(self._snapshots) > self._max_entries or total > self._max_bytes):
+            _, evicted = self._snapshots.popitem(last=False)
+            total -= evicted.size
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(snapshot.size for snapshot in self._snapshots.values())
+
+    def start_render(self, key: Hashable, state: FeedState) -> Tuple[RenderFlight, bool]:
+        """
+        Register a render of key at state. Returns the render and True when the caller must render it,
+        or the render already in progress and False when the caller should wait for it (see wait_render).
+        """
+        now = self._clock()
+        with self._lock:
+            render = self._renders.get(key)
+            if render is not None and render.state == state and now - render.started_at < self._render_wait_s:
+                return render, False
+            render = RenderFlight(state, now)
+            self._renders[key] = render
+            return render, True
+
+    def wait_render(self, render: RenderFlight) -> bool:
+        """Wait for a render started by another request; False when it did not finish in time."""
+        remaining = self._render_wait_s - (self._clock() - render.started_at)
+        return render.done.wait(max(remaining, 0.0))
+
+    def finish_render(self, key: Hashable, render: RenderFlight) -> None:
+        """Release the requests waiting for render, whether or not it stored a snapshot."""
+        with self._lock:
+            if self._renders.get(key) is render:
+                del self._renders[key]
+        render.done.set()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._snapshots.clear()
+
+    def __len__(self) -> int:
+        return len(self._snapshots)
+
+
+snapshot_cache = SnapshotCache(
+    int(os.getenv("WRAPPING_SNAPSHOT_MAX_ENTRIES", "256")),
+    # 256 MiB for all cached documents and their compressed variants
+    max_bytes=int(os.getenv("WRAPPING_SNAPSHOT_MAX_BYTES", "268435456")),
+    # 64 MiB: larger documents are streamed without keeping a copy
+    max_document_bytes=int(os.getenv("WRAPPING_SNAPSHOT_MAX_DOCUMENT_BYTES", "67108864")),
+    render_wait_s=float(os.getenv("WRAPPING_SNAPSHOT_RENDER_WAIT_S", "30")),
+)
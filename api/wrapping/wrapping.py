@@ -1,11 +1,51 @@
+import os
 import re
-from fastapi import Depends, Response
+from typing import Callable, Hashable, Iterable, Iterator
+from fastapi import Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlmodel import Session
 from datetime import datetime, timezone
 from email.utils import format_datetime
 
 from utils.database import get_session
-from api.wrapping.service import get_available_job_postings
+from api.wrapping.encoding import iter_compressed, negotiate_encoding
+from api.wrapping.metrics import FeedBuild
+from api.wrapping.service import (
+    PAGE_SIZE,
+    FeedPage,
+    FeedState,
+    get_delta_state,
+    get_feed_state,
+    get_page_state,
+    get_tombstones_since,
+    iter_available_job_postings,
+    iter_changed_job_postings,
+    iter_feed_pages,
+    iter_job_postings_page,
+    is_page_boundary,
+)
+from api.wrapping.snapshot import (
+    FeedSnapshot,
+    RenderFlight,
+    format_http_date,
+    is_not_modified,
+    last_modified,
+    make_etag,
+    snapshot_cache,
+)
+
+
+# Number of <job> elements rendered per streamed chunk
+STREAM_JOBS_PER_CHUNK = int(os.getenv("WRAPPING_STREAM_JOBS_PER_CHUNK", "100"))
+
+# Keep the last rendered feed in memory and serve it until job_postings changes
+SNAPSHOT_CACHE_ENABLED = os.getenv("WRAPPING_SNAPSHOT_CACHE", "true").lower() in ("1", "true", "yes")
+
+
+# Invalid XML control characters: \x00-\x08, \x0B-\x0C, \x0E-\x1F, \x7F
+_INVALID_XML_CHARS_RE = re.compile(r"[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]")
+# Same set as bytes; in UTF-8 these values never occur inside multi-byte sequences
+_INVALID_XML_BYTES = bytes([*range(0x00, 0x09), 0x0B, 0x0C, *range(0x0E, 0x20), 0x7F])
 
 
 def _format_rfc1123_gmt(dt: datetime | None = None) -> str:
@@ -35,75 +75,361 @@ def _escape_cdata(value: str) -> str:
     """Escape CDATA ending sequence and clean invalid XML characters."""
     if value is None:
         return ""
-    
-    # First ensure valid UTF-8 encoding
-    value_str = _ensure_utf8(value)
-    
-    # Remove invalid XML control characters (except tab \x09, newline \x0A, carriage return \x0D)
-    # These characters break XML parsing: \x00-\x08, \x0B-\x0C, \x0E-\x1F, \x7F
-    value_str = re.sub(r'[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]', '', value_str)
-    
-    # Replace ]]> with ]]>]]&gt;<![CDATA[ to prevent premature CDATA closure
+
+    if not isinstance(value, str):
+        # bytes and other types go through the full UTF-8 normalisation
+        value = _ensure_utf8(value)
+
+    try:
+        encoded = value.encode("utf-8")
+    except UnicodeEncodeError:
+        # Lone surrogates are the only str content that is not valid UTF-8
+        value = _ensure_utf8(value)
+        encoded = value.encode("utf-8")
+
+    # Fast path: the overwhelming majority of values need no change at all.
+    # bytes.translate/in run at memcpy speed, far faster than a regex scan.
+    if len(encoded.translate(None, _INVALID_XML_BYTES)) == len(encoded):
+        if b"]]>" not in encoded:
+            return value
+    else:
+        # Remove invalid XML control characters (except tab \x09, newline \x0A, carriage return \x0D)
+        value = _INVALID_XML_CHARS_RE.sub("", value)
+
+    # Replace ]]> with ]]]]><![CDATA[> to prevent premature CDATA closure
     # This is the standard way to include ]]> in CDATA sections
-    value_str = value_str.replace("]]>", "]]]]><![CDATA[>")
-    
-    return value_str
+    return value.replace("]]>", "]]]]><![CDATA[>")
+
+
+def _render_header(last_build_date: datetime | None) -> str:
+    """Render the XML prolog, opening <source> tag and lastBuildDate."""
+    parts: list[str] = []
+    parts.append('<?xml version="1.0" encoding="UTF-8"?>')
+    parts.append("<source>")
+    parts.append(f" <lastBuildDate> {_format_rfc1123_gmt(last_build_date)} </lastBuildDate>")
+    return "\n".join(parts)
+
+
+def render_job_fragment(job) -> str:
+    """Render a single <job> element."""
+    # Use partner_job_id if available, fallback to id
+    partner_job_id = getattr(job, "partner_job_id", None) or (job.id if getattr(job, "id", None) is not None else "")
+    company = _escape_cdata(getattr(job, "company", None) or "")
+    title = _escape_cdata(job.position if getattr(job, "position", None) else "")
+    description = _escape_cdata(getattr(job, "description", None) or "")
+    apply_url = _escape_cdata(getattr(job, "apply_url", None) or "")
+    company_id = _escape_cdata(getattr(job, "company_id", None) or "")
+    location = _escape_cdata(getattr(job, "location", None) or "")
+    workplace_types = _escape_cdata(getattr(job, "workplace_types", None) or "")
+    experience_level = _escape_cdata(getattr(job, "experience_level", None) or "")
+    jobtype = _escape_cdata(getattr(job, "jobtype", None) or "")
+
+    parts: list[str] = []
+    parts.append(" <job>")
+    # partner_job_id is typically numeric, but escape it anyway for safety
+    partner_job_id_str = _escape_cdata(str(partner_job_id))
+    parts.append(f"  <partnerJobId><![CDATA[{partner_job_id_str}]]></partnerJobId>")
+    parts.append(f"  <company><![CDATA[{company}]]></company>")
+    parts.append(f"  <title><![CDATA[{title}]]></title>")
+    parts.append(f"  <description><![CDATA[{description}]]></description>")
+    parts.append(f"  <applyUrl><![CDATA[{apply_url}]]></applyUrl>")
+    parts.append(f"  <companyId> <![CDATA[{company_id}]]></companyId>")
+    parts.append(f"  <location><![CDATA[{location}]]></location>")
+    parts.append(f"  <workplaceTypes><![CDATA[{workplace_types}]]></workplaceTypes>")
+    parts.append(f"  <experienceLevel><![CDATA[{experience_level}]]></experienceLevel>")
+    parts.append(f"  <jobtype><![CDATA[{jobtype}]]></jobtype>")
+    parts.append(" </job>")
+    return "\n".join(parts)
+
+
+def materialize_job_fragment(job) -> str | None:
+    """
+    Return the fragment to store in JobPostings.xml_fragment.
+    None when the posting has no partner_job_id, since the fallback id may not be assigned yet.
+    """
+    if not getattr(job, "partner_job_id", None):
+        return None
+    return render_job_fragment(job)
+
+
+def _job_xml(job) -> str:
+    """Return the stored fragment of a job if present, rendering it otherwise."""
+    fragment = getattr(job, "xml_fragment", None)
+    if fragment:
+        return fragment
+    return render_job_fragment(job)
+
+
+def _render_deleted_job(tombstone) -> str:
+    """Render a <deletedJob> element for a posting removed from the feed."""
+    partner_job_id = _escape_cdata(str(tombstone.partner_job_id))
+    parts: list[str] = []
+    parts.append(" <deletedJob>")
+    parts.append(f"  <partnerJobId><![CDATA[{partner_job_id}]]></partnerJobId>")
+    parts.append(f"  <deletedAt> {_format_rfc1123_gmt(tombstone.deleted_at)} </deletedAt>")
+    parts.append(" </deletedJob>")
+    return "\n".join(parts)
+
+
+def iter_wrapping_xml(
+    job_postings: Iterable,
+    last_build_date: datetime | None = None,
+    jobs_per_chunk: int = STREAM_JOBS_PER_CHUNK,
+    deleted_jobs: Iterable = (),
+) -> Iterator[bytes]:
+    """
+    Yield the LinkedIn wrapping XML as UTF-8 encoded chunks.
+    Each chunk holds up to jobs_per_chunk <job> elements, so job_postings can be a
+    lazy iterable and only one chunk is held in memory at a time. The joined chunks
+    are byte-for-byte identical to generate_wrapping_xml().
+    deleted_jobs (tombstones) are rendered as <deletedJob> elements after the jobs; only the delta feed uses them.
+    """
+    yield _render_header(last_build_date).encode("utf-8")
+
+    buffer: list[str] = []
+    for job in job_postings:
+        buffer.append(_job_xml(job))
+        if len(buffer) >= jobs_per_chunk:
+            yield ("\n" + "\n".join(buffer)).encode("utf-8")
+            buffer.clear()
+    if buffer:
+        yield ("\n" + "\n".join(buffer)).encode("utf-8")
+
+    deleted = [_render_deleted_job(tombstone) for tombstone in deleted_jobs]
+    if deleted:
+        yield ("\n" + "\n".join(deleted)).encode("utf-8")
+
+    yield b"\n</source>"
 
 
 def generate_wrapping_xml(job_postings) -> str:
     """Generate XML response for LinkedIn wrapping in the LinkedIn expected format."""
     # Use max last_build_date from job postings if available, otherwise generate current time
     last_build_dates = [job.last_build_date for job in job_postings if getattr(job, "last_build_date", None) is not None]
-    if last_build_dates:
-        last_build_date = _format_rfc1123_gmt(max(last_build_dates))
-    else:
-        last_build_date = _format_rfc1123_gmt()
+    last_build_date = max(last_build_dates) if last_build_dates else None
+
+    return b"".join(iter_wrapping_xml(job_postings, last_build_date)).decode("utf-8")
+
 
+def _render_index(request: Request, pages: Iterable[FeedPage], last_build_date: datetime | None) -> Iterator[bytes]:
+    """Render the feed index: one <page> per keyset page with its URL and lastBuildDate."""
+    base_url = request.url_for("get_wrapping")
     parts: list[str] = []
     parts.append('<?xml version="1.0" encoding="UTF-8"?>')
-    parts.append("<source>")
-    parts.append(f" <lastBuildDate> {last_build_date} </lastBuildDate>")
+    parts.append("<sourceIndex>")
+    parts.append(f" <lastBuildDate> {_format_rfc1123_gmt(last_build_date)} </lastBuildDate>")
+    for page in pages:
+        url = _escape_cdata(str(base_url.include_query_params(after_id=page.after_id)))
+        parts.append(" <page>")
+        parts.append(f"  <url><![CDATA[{url}]]></url>")
+        parts.append(f"  <lastBuildDate> {_format_rfc1123_gmt(page.state.last_build_date)} </lastBuildDate>")
+        parts.append(f"  <jobs>{page.state.row_count}</jobs>")
+        parts.append(" </page>")
+    parts.append("</sourceIndex>")
+    yield "\n".join(parts).encode("utf-8")
 
-    for job in job_postings:
-        # Use partner_job_id if available, fallback to id
-        partner_job_id = getattr(job, "partner_job_id", None) or (job.id if getattr(job, "id", None) is not None else "")
-        company = _escape_cdata(getattr(job, "company", None) or "")
-        title = _escape_cdata(job.position if getattr(job, "position", None) else "")
-        description = _escape_cdata(getattr(job, "description", None) or "")
-        apply_url = _escape_cdata(getattr(job, "apply_url", None) or "")
-        company_id = _escape_cdata(getattr(job, "company_id", None) or "")
-        location = _escape_cdata(getattr(job, "location", None) or "")
-        workplace_types = _escape_cdata(getattr(job, "workplace_types", None) or "")
-        experience_level = _escape_cdata(getattr(job, "experience_level", None) or "")
-        jobtype = _escape_cdata(getattr(job, "jobtype", None) or "")
-
-        parts.append(" <job>")
-        # partner_job_id is typically numeric, but escape it anyway for safety
-        partner_job_id_str = _escape_cdata(str(partner_job_id))
-        parts.append(f"  <partnerJobId><![CDATA[{partner_job_id_str}]]></partnerJobId>")
-        parts.append(f"  <company><![CDATA[{company}]]></company>")
-        parts.append(f"  <title><![CDATA[{title}]]></title>")
-        parts.append(f"  <description><![CDATA[{description}]]></description>")
-        parts.append(f"  <applyUrl><![CDATA[{apply_url}]]></applyUrl>")
-        parts.append(f"  <companyId> <![CDATA[{company_id}]]></companyId>")
-        parts.append(f"  <location><![CDATA[{location}]]></location>")
-        parts.append(f"  <workplaceTypes><![CDATA[{workplace_types}]]></workplaceTypes>")
-        parts.append(f"  <experienceLevel><![CDATA[{experience_level}]]></experienceLevel>")
-        parts.append(f"  <jobtype><![CDATA[{jobtype}]]></jobtype>")
-        parts.append(" </job>")
-
-    parts.append("</source>")
 
-    return "\n".join(parts)
+def _stream_document(
+    session: Session,
+    key: Hashable,
+    state: FeedState,
+    render: Callable[[FeedBuild], Iterator[bytes]],
+    encoding: str | None,
+    build: FeedBuild,
+    cacheable: bool = True,
+    render_flight: RenderFlight | None = None,
+) -> Iterator[bytes]:
+    """
+    Stream a document, store it as the current snapshot for key (when cacheable) and release the session once
+    the last chunk is sent. The build timings are recorded only when the whole body was sent.
+    A copy of the body is buffered for the snapshot only while it fits the cache's per-document limit;
+    past it the document is just streamed. render_flight (see SnapshotCache.start_render) is released
+    at the end, so the requests waiting for this render pick up the snapshot or render it themselves.
+    """
+    # The get_session dependency exits before a StreamingResponse body is consumed,
+    # so the session reconnects lazily here and is closed by the generator itself.
+    keep = SNAPSHOT_CACHE_ENABLED and cacheable
+    chunks: list[bytes] = []
+    encoded_chunks: list[bytes] = []
+    buffered = 0
+
+    def _buffer(target: list[bytes], chunk: bytes) -> None:
+        nonlocal keep, buffered
+        if not keep:
+            return
+        buffered += len(chunk)
+        if snapshot_cache.accepts(buffered):
+            target.append(chunk)
+        else:
+            # Too large to snapshot: stop holding a copy of the body
+            keep = False
+            chunks.clear()
+            encoded_chunks.clear()
+
+    def _rendered() -> Iterator[bytes]:
+        for chunk in build.rendered(render(build)):
+            _buffer(chunks, chunk)
+            yield chunk
+
+    try:
+        try:
+            if encoding is None:
+                for chunk in _rendered():
+                    build.bytes_sent += len(chunk)
+                    yield chunk
+            else:
+                for chunk in build.encoded(iter_compressed(_rendered(), encoding)):
+                    _buffer(encoded_chunks, chunk)
+                    build.bytes_sent += len(chunk)
+                    yield chunk
+        finally:
+            session.close()
+        # Only reached when the whole body was rendered
+        build.observe_build(encoded=encoding is not None)
+        if keep:
+            snapshot = FeedSnapshot(state=state, body=b"".join(chunks))
+            if encoding is not None:
+                snapshot.encoded[encoding] = b"".join(encoded_chunks)
+            snapshot_cache.put(key, snapshot)
+    finally:
+        if render_flight is not None:
+            snapshot_cache.finish_render(key, render_flight)
 
 
-async def get_wrapping(session: Session = Depends(get_session)) -> Response:
-    """GET /wrapping endpoint that returns XML with job postings data."""
-    job_postings = get_available_job_postings(session)
-    xml_content = generate_wrapping_xml(job_postings)
-    
+def _snapshot_response(snapshot: FeedSnapshot, encoding: str | None, headers: dict, build: FeedBuild) -> Response:
+    """Serve a cached snapshot in the negotiated content coding."""
+    body = snapshot_cache.body_for(snapshot, encoding)
+    build.bytes_sent = len(body)
+    build.observe_fetch()
     return Response(
-        content=xml_content.encode('utf-8'),
-        media_type="application/xml; charset=utf-8"
+        content=body,
+        media_type="application/xml; charset=utf-8",
+        headers=headers,
     )
 
+
+def _serve_document(
+    request: Request,
+    session: Session,
+    key: Hashable,
+    state: FeedState,
+    render: Callable[[FeedBuild], Iterator[bytes]],
+    build: FeedBuild,
+    cacheable: bool = True,
+) -> Response:
+    """
+    Answer a GET for an XML document: 304, cached snapshot or freshly streamed body.
+    render receives the build so it can pass its database rows through build.rows_from().
+    Documents whose key the client picks freely are served with cacheable=False: they get validators
+    (ETag, Last-Modified) but are never stored as snapshots, so clients cannot fill the cache.
+    """
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+    etag = make_etag(key, state, encoding)
+    modified_at = last_modified(state)
+
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    if modified_at is not None:
+        headers["Last-Modified"] = format_http_date(modified_at)
+
+    if is_not_modified(
+        etag,
+        modified_at,
+        request.headers.get("if-none-match"),
+        request.headers.get("if-modified-since"),
+    ):
+        session.close()
+        build.observe_fetch()
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=304, headers=headers)
+
+    render_flight = None
+    if SNAPSHOT_CACHE_ENABLED and cacheable:
+        snapshot = snapshot_cache.get(key, state)
+        if snapshot is not None:
+            session.close()
+            return _snapshot_response(snapshot, encoding, headers, build)
+
+        flight, leader = snapshot_cache.start_render(key, state)
+        if leader:
+            render_flight = flight
+        else:
+            # Another request is rendering this document: wait for its snapshot instead of rendering it again.
+            # Without one (too large, failed or abandoned render) the document is rendered here.
+            session.close()
+            snapshot_cache.wait_render(flight)
+            snapshot = snapshot_cache.get(key, state)
+            if snapshot is not None:
+                return _snapshot_response(snapshot, encoding, headers, build)
+
+    return StreamingResponse(
+        _stream_document(session, key, state, render, encoding, build, cacheable, render_flight),
+        media_type="application/xml; charset=utf-8",
+        headers=headers,
+    )
+
+
+# Plain (non-async) endpoints: FastAPI runs them in the threadpool, so the blocking state queries never
+# stall the event loop; StreamingResponse likewise pulls each chunk of the synchronous body in the threadpool.
+def get_wrapping(
+    request: Request,
+    after_id: int | None = Query(default=None, ge=0, description="Return the feed page of jobs with id greater than this value"),
+    since: datetime | None = Query(default=None, description="Return only jobs changed (and removed) after this ISO 8601 timestamp"),
+    session: Session = Depends(get_session),
+) -> Response:
+    """GET /wrapping endpoint that streams XML with job postings data: whole, one keyset page, or changes since a watermark."""
+    if since is not None:
+        # Database timestamps are stored naive in UTC
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        build = FeedBuild("delta")
+        state = build.fetch(get_delta_state, session, since)
+        tombstones = build.fetch(get_tombstones_since, session, since)
+        tombstones_token = (len(tombstones), tombstones[-1].deleted_at if tombstones else None)
+        # Removals listed in the delta also move its Last-Modified
+        state = state._replace(last_deleted_at=tombstones_token[1])
+        return _serve_document(
+            request, session, ("delta", since, tombstones_token), state,
+            lambda build: iter_wrapping_xml(
+                build.rows_from(iter_changed_job_postings(session, since)),
+                state.last_build_date,
+                deleted_jobs=tombstones,
+            ),
+            build,
+            # since is arbitrary and an old one renders the whole feed: rely on ETag/304 only
+            cacheable=False,
+        )
+
+    if after_id is None:
+        build = FeedBuild("feed")
+        state = build.fetch(get_feed_state, session)
+        return _serve_document(
+            request, session, "feed", state,
+            lambda build: iter_wrapping_xml(build.rows_from(iter_available_job_postings(session)), state.last_build_date),
+            build,
+        )
+
+    page_size = PAGE_SIZE
+    build = FeedBuild("page")
+    state = build.fetch(get_page_state, session, after_id, page_size)
+    return _serve_document(
+        request, session, ("page", after_id, page_size), state,
+        lambda build: iter_wrapping_xml(
+            build.rows_from(iter_job_postings_page(session, after_id, page_size)), state.last_build_date
+        ),
+        build,
+        # Any after_id is accepted, but only the pages published in the index are kept as snapshots
+        cacheable=build.fetch(is_page_boundary, session, after_id, page_size),
+    )
+
+
+def get_wrapping_index(request: Request, session: Session = Depends(get_session)) -> Response:
+    """GET /wrapping/index endpoint listing the paginated feed pages."""
+    build = FeedBuild("index")
+    state = build.fetch(get_feed_state, session)
+    return _serve_document(
+        request, session, "index", state,
+        lambda build: _render_index(request, build.rows_from(iter_feed_pages(session, PAGE_SIZE)), state.last_build_date),
+        build,
+    )
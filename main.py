@@ -1,12 +1,16 @@
 import os
 import traceback
+from contextlib import asynccontextmanager
 
+import anyio
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, Response
 from starlette.middleware.cors import CORSMiddleware
 
 from api.wrapping.router import router as wrapping_router
-from utils.logger import get_logger, build_log_payload, lookup_geo
+from utils.geo import close_geo_client
+from utils.logger import build_log_payload, request_log_policy, request_log_queue
+from utils.metrics import CONTENT_TYPE, REGISTRY, Histogram
 import time
 
 
@@ -16,7 +20,31 @@ if os.path.exists(_dotenv_path):
     load_dotenv(_dotenv_path)
 
 
+# Worker threads shared by sync endpoints, sync dependencies and streamed bodies (anyio default: 40)
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
+# Streamed bodies (the feeds) are timed separately by the wrapping_* metrics
+HTTP_REQUEST_DURATION_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time until the response headers are ready, per route template and status",
+    ["route", "status"],
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    # Expose the success series of every route from the first scrape
+    for route in app.routes:
+        HTTP_REQUEST_DURATION_SECONDS.labels(route.path, "200")
+    yield
+    # Flush request logs still waiting for their geo lookup
+    await request_log_queue.close()
+    await close_geo_client()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="LinkedIn Wrapping Service",
     description="Service for providing job posting data for LinkedIn wrapping",
     servers=[{
@@ -50,14 +78,20 @@ async def general_exception_handler(request: Request, exc: Exception):
 
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    logger = get_logger()
     started_at_ns = time.time_ns()
     try:
         response = await call_next(request)
     except Exception:
         # Let exception handler decide the output, but still log attempt
         raise
+    route = request.scope.get("route")
+    HTTP_REQUEST_DURATION_SECONDS.labels(
+        route.path if route is not None else "unmatched", str(response.status_code)
+    ).observe((time.time_ns() - started_at_ns) / 1_000_000_000)
     try:
+        # Skipped and unsampled requests (e.g. probes on /health) cost no payload building or geo lookup
+        if not request_log_policy.should_log(request.url.path, response.status_code):
+            return response
         authorization = request.headers.get("authorization")
         origin = request.headers.get("origin")
         user_agent = request.headers.get("user-agent")
@@ -67,8 +101,6 @@ async def log_requests(request: Request, call_next):
             client_ip = forwarded_for.split(",")[0].strip()
         else:
             client_ip = request.headers.get("x-real-ip") or (request.client.host if request.client else None)
-        # Optional geo lookup (non-blocking with small timeout)
-        destination_geo = await lookup_geo(client_ip)
         # starlette Headers are case-insensitive; convert to lower-case keys
         response_headers = {k.lower(): v for k, v in response.headers.items()}
         payload = build_log_payload(
@@ -83,22 +115,28 @@ async def log_requests(request: Request, call_next):
             client_ip=client_ip,
             status_code=response.status_code,
             response_headers=response_headers,
-            destination_geo=destination_geo if destination_geo else None,
         )
-        logger.info("http_request", extra={"extra": payload})
+        # Geo enrichment and the log write happen in the background, off the request path
+        request_log_queue.submit(payload, client_ip)
     except Exception:
         # Never break the request due to logging failures
         pass
     return response
 
 
+# Async on purpose: probes are answered on the event loop and never wait for a threadpool slot
 @app.get("/health")
-def health():
+async def health():
     return {"Ok!"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
 @app.get("/")
-def root():
+async def root():
     return {"message": "LinkedIn Wrapping Service API", "version": "1.0.0"}
 
 
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Script per popolare la colonna xml_fragment di job_postings.
+Pre-renderizza il frammento <job> servito da /wrapping per i record che ne sono privi
+(o per tutti i record con --all, ad esempio dopo una modifica al formato XML).
+"""
+
+import argparse
+import os
+import sys
+from pathlib import Path
+from dotenv import load_dotenv
+from sqlmodel import Session, create_engine
+
+# Aggiungi il path del progetto per gli import
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from api.wrapping.models import JobPostings
+from api.wrapping.service import iter_all
+from api.wrapping.wrapping import materialize_job_fragment
+
+# Carica variabili d'ambiente
+env_path = project_root / ".env"
+if env_path.exists():
+    load_dotenv(env_path)
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+if not DATABASE_URL:
+    raise ValueError("DATABASE_URL non trovata nel file .env")
+
+
+def create_database_engine():
+    """Crea l'engine del database con configurazione appropriata."""
+    engine = create_engine(
+        DATABASE_URL,
+        pool_recycle=3600,
+        pool_pre_ping=True,
+        echo=False,
+        connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
+    )
+    
+    # Gestione schema per MySQL
+    if engine.dialect.name == "mysql":
+        engine = engine.execution_options(schema_translate_map={
+            "lw": None,
+        })
+    
+    return engine
+
+
+def backfill_xml_fragments(engine, rebuild_all: bool = False, batch_size: int = 200) -> int:
+    """Calcola e salva xml_fragment, con un commit ogni batch_size record aggiornati."""
+    print("=" * 60)
+    print("BACKFILL xml_fragment - job_postings")
+    print("=" * 60)
+    
+    updated = 0
+    pending = []
+    with Session(engine) as read_session, Session(engine) as write_session:
+        for posting in iter_all(read_session, JobPostings):
+            if posting.xml_fragment and not rebuild_all:
+                continue
+            pending.append({"id": posting.id, "xml_fragment": materialize_job_fragment(posting)})
+            if len(pending) >= batch_size:
+                write_session.bulk_update_mappings(JobPostings, pending)
+                write_session.commit()
+                updated += len(pending)
+                pending = []
+                print(f"  📊 Aggiornati {updated} record...")
+        if pending:
+            write_session.bulk_update_mappings(JobPostings, pending)
+            write_session.commit()
+            updated += len(pending)
+    
+    print(f"\n✅ Aggiornati {updated} frammenti XML.")
+    return updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--all", action="store_true", help="Rigenera il frammento anche per i record che lo hanno già")
+    parser.add_argument("--batch-size", type=int, default=200)
+    args = parser.parse_args()
+    try:
+        backfill_xml_fragments(create_database_engine(), rebuild_all=args.all, batch_size=args.batch_size)
+        print("\n" + "=" * 60)
+        print("Script completato!")
+        print("=" * 60)
+    except Exception as e:
+        print(f"Errore durante l'esecuzione: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,80 @@
+"""
+Modalità bulk dell'arricchimento tramite la Batch API di OpenAI.
+Le richieste vengono impacchettate in file JSONL, inviate come batch e raccolte al termine;
+l'id del batch di ogni item è salvato in pipeline_jobs (vedi scripts/pipeline_state.py) così che un
+processo riavviato riprenda il polling invece di inviare di nuovo le stesse richieste.
+L'endpoint è quello del client passato (base_url), quindi il flusso è testabile con un server stub.
+"""
+
+from __future__ import annotations
+
+import json
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+# Stati finali di un batch OpenAI
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def build_batch_file(requests: Iterable[Tuple[str, Dict[str, Any]]], endpoint: str = "/v1/chat/completions") -> bytes:
+    """Serializza le coppie (custom_id, body) nel formato JSONL della Batch API."""
+    lines = [
+        json.dumps({"custom_id": custom_id, "method": "POST", "url": endpoint, "body": body}, ensure_ascii=False)
+        for custom_id, body in requests
+    ]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def submit_batch(client, payload: bytes, metadata: Optional[Dict[str, str]] = None) -> str:
+    """Carica il file JSONL e crea il batch; restituisce l'id del batch."""
+    input_file = client.files.create(file=("batch.jsonl", payload), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata=metadata,
+    )
+    return batch.id
+
+
+def wait_for_batch(
+    client,
+    batch_id: str,
+    poll_interval_s: float = 60.0,
+    sleep: Callable[[float], None] = time.sleep,
+):
+    """Interroga il batch finché non raggiunge uno stato finale."""
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        completed = getattr(batch.request_counts, "completed", 0) if batch.request_counts else 0
+        total = getattr(batch.request_counts, "total", 0) if batch.request_counts else 0
+        print(f"  ⏳ Batch {batch_id}: {batch.status} ({completed}/{total})")
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+        sleep(poll_interval_s)
+
+
+def fetch_batch_results(client, batch) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Scarica i risultati di un batch terminato.
+    Restituisce (contenuti per custom_id, errori per custom_id).
+    """
+    results: Dict[str, str] = {}
+    errors: Dict[str, str] = {}
+    if batch.output_file_id:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") == 200:
+                content = response["body"]["choices"][0]["message"]["content"]
+                results[record["custom_id"]] = content.strip()
+            else:
+                errors[record["custom_id"]] = json.dumps(record.get("error") or response.get("body"))
+    if batch.error_file_id:
+        for line in client.files.content(batch.error_file_id).text.splitlines():
+            if line.strip():
+                record = json.loads(line)
+                errors[record["custom_id"]] = json.dumps(record.get("error") or record.get("response"))
+    return results, errors
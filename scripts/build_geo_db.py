@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Script per costruire il database geo locale usato dal logging delle richieste (GEO_DB_PATH).
+Converte un CSV di range IP (ad esempio un export MaxMind/DB-IP/IP2Location convertito) nel formato
+binario di utils.geo.RangeGeoDatabase, letto via mmap con ricerca binaria.
+
+Colonne del CSV (con intestazione): start_ip, end_ip, continent_name, country_iso_code, country_name,
+region_iso_code, region_name, city_name, latitude, longitude. Le colonne geo mancanti o vuote vengono ignorate.
+"""
+
+import argparse
+import csv
+import sys
+from pathlib import Path
+
+# Aggiungi il path del progetto per gli import
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from utils.geo import write_range_database
+
+GEO_COLUMNS = (
+    "continent_name",
+    "country_iso_code",
+    "country_name",
+    "region_iso_code",
+    "region_name",
+    "city_name",
+)
+
+
+def _row_to_geo(row: dict) -> dict:
+    """Converte una riga del CSV nel dict geo dei log (stesse chiavi del provider HTTP)."""
+    geo = {column: row[column] for column in GEO_COLUMNS if row.get(column)}
+    if row.get("latitude") and row.get("longitude"):
+        geo["location"] = {"lon": float(row["longitude"]), "lat": float(row["latitude"])}
+    return geo
+
+
+def iter_csv_ranges(csv_path: Path):
+    """Restituisce le terne (primo IP, ultimo IP, geo) lette dal CSV."""
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            yield row["start_ip"], row["end_ip"], _row_to_geo(row)
+
+
+def build_geo_db(csv_path: Path, output_path: Path) -> int:
+    """Scrive il database in un file temporaneo e lo sostituisce atomicamente (i processi attivi mantengono il vecchio mmap)."""
+    tmp_path = output_path.with_suffix(output_path.suffix + ".tmp")
+    count = write_range_database(str(tmp_path), iter_csv_ranges(csv_path))
+    tmp_path.replace(output_path)
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("csv_path", type=Path, help="CSV dei range IP")
+    parser.add_argument("output_path", type=Path, help="File del database da generare (da indicare in GEO_DB_PATH)")
+    args = parser.parse_args()
+    try:
+        count = build_geo_db(args.csv_path, args.output_path)
+        print(f"✅ Scritti {count} range in {args.output_path}")
+    except Exception as e:
+        print(f"Errore durante l'esecuzione: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
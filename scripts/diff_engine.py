@@ -0,0 +1,299 @@
+"""
+Confronto set-based tra job_posting_pre e job_postings.
+Tutte le differenze sono calcolate nel database con anti-join NOT EXISTS su partner_job_id e
+restituiscono solo id: la memoria usata dalla pipeline non dipende dalla dimensione delle tabelle.
+Le impronte del contenuto (description_hash, content_hash) distinguono i record nuovi, con descrizione
+cambiata (da arricchire di nuovo), con soli metadati cambiati (aggiornati senza OpenAI), invariati e scaduti.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from datetime import datetime
+from typing import Iterator, List, Mapping, NamedTuple, Tuple
+
+from sqlalchemy import and_, case, delete, insert, literal, or_, update
+from sqlmodel import Session, func, select
+
+from api.wrapping.models import JobPostingPre, JobPostings, JobPostingTombstone
+from scripts.enrichment_cache import normalize_description
+
+# Record letti o eliminati per ogni round trip
+CHUNK_SIZE = 1000
+
+
+def tracked_condition():
+    """
+    Record di job_posting_pre con partner_job_id: gli unici confrontabili con job_postings.
+    Quelli senza non hanno una chiave per riconoscerli come già pubblicati, quindi non vengono processati.
+    """
+    return JobPostingPre.partner_job_id.is_not(None)
+
+
+def published_condition():
+    """Condizione correlata: il record di job_posting_pre ha già un corrispondente in job_postings."""
+    return select(JobPostings.id).where(JobPostings.partner_job_id == JobPostingPre.partner_job_id).exists()
+
+
+def _still_available():
+    """Condizione correlata: il record di job_postings è ancora presente in job_posting_pre."""
+    return select(JobPostingPre.id).where(JobPostingPre.partner_job_id == JobPostings.partner_job_id).exists()
+
+
+def new_pre_ids_statement():
+    """Id dei record di job_posting_pre non ancora presenti in job_postings."""
+    return select(JobPostingPre.id).where(tracked_condition(), ~published_condition()).order_by(JobPostingPre.id)
+
+
+def expired_posting_condition():
+    """Record di job_postings il cui partner_job_id non è più in job_posting_pre."""
+    return JobPostings.partner_job_id.is_not(None) & ~_still_available()
+
+
+def count_rows(session: Session, model) -> int:
+    return session.exec(select(func.count()).select_from(model)).one()
+
+
+def count_distinct_partner_ids(session: Session, model) -> int:
+    return session.exec(select(func.count(func.distinct(model.partner_job_id)))).one()
+
+
+def count_new(session: Session) -> int:
+    return session.exec(select(func.count()).select_from(new_pre_ids_statement().subquery())).one()
+
+
+def count_untracked(session: Session) -> int:
+    """Record di job_posting_pre senza partner_job_id (esclusi dalla pipeline)."""
+    return session.exec(select(func.count()).select_from(JobPostingPre).where(~tracked_condition())).one()
+
+
+def to_enrich_pre_ids_statement():
+    """Id dei record di job_posting_pre da arricchire: nuovi o con la descrizione cambiata."""
+    return select(JobPostingPre.id).where(tracked_condition(), ~up_to_date_condition()).order_by(JobPostingPre.id)
+
+
+def iter_new_pre_ids(session: Session, chunk_size: int = CHUNK_SIZE, include_changed: bool = False) -> Iterator[int]:
+    """
+    Id dei nuovi record (con include_changed anche di quelli con descrizione cambiata) in ordine crescente,
+    letti a blocchi con keyset pagination.
+    """
+    statement = to_enrich_pre_ids_statement() if include_changed else new_pre_ids_statement()
+    last_id = 0
+    while True:
+        ids = session.exec(statement.where(JobPostingPre.id > last_id).limit(chunk_size)).all()
+        if not ids:
+            return
+        yield from ids
+        last_id = ids[-1]
+
+
+def count_expired(session: Session) -> int:
+    return session.exec(select(func.count()).select_from(JobPostings).where(expired_posting_condition())).one()
+
+
+def sample_expired(session: Session, limit: int = 50) -> List[JobPostings]:
+    """Primi record scaduti (per il report), senza caricare gli altri."""
+    statement = select(JobPostings).where(expired_posting_condition()).order_by(JobPostings.id).limit(limit)
+    return list(session.exec(statement).all())
+
+
+def delete_expired(session: Session, deleted_at: datetime, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Elimina a blocchi i record scaduti da job_postings registrando un tombstone per ciascuno.
+    Ogni blocco è un INSERT ... SELECT dei tombstone più un DELETE ... WHERE NOT EXISTS sugli stessi id,
+    con un commit per blocco.
+    """
+    removed = 0
+    last_id = 0
+    while True:
+        ids = session.exec(
+            select(JobPostings.id)
+            .where(expired_posting_condition())
+            .where(JobPostings.id > last_id)
+            .order_by(JobPostings.id)
+            .limit(chunk_size)
+        ).all()
+        if not ids:
+            return removed
+        last_id = ids[-1]
+        session.execute(
+            insert(JobPostingTombstone).from_select(
+                ["partner_job_id", "deleted_at", "posting_id"],
+                select(JobPostings.partner_job_id, literal(deleted_at), JobPostings.id)
+                .where(JobPostings.id.in_(ids))
+                .where(expired_posting_condition()),
+            )
+        )
+        result = session.execute(
+            delete(JobPostings)
+            .where(JobPostings.id.in_(ids))
+            .where(expired_posting_condition())
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        removed += result.rowcount or 0
+
+
+def count_missing(session: Session) -> int:
+    """partner_job_id distinti di job_posting_pre che non hanno un corrispondente in job_postings."""
+    statement = select(func.count(func.distinct(JobPostingPre.partner_job_id))).where(
+        tracked_condition(), ~published_condition()
+    )
+    return session.exec(statement).one()
+
+
+def sample_missing(session: Session, limit: int = 10) -> List[str]:
+    statement = (
+        select(JobPostingPre.partner_job_id)
+        .where(tracked_condition(), ~published_condition())
+        .distinct()
+        .order_by(JobPostingPre.partner_job_id)
+        .limit(limit)
+    )
+    return list(session.exec(statement).all())
+
+
+# Campi pubblicati nel feed oltre alla descrizione: una loro modifica non richiede una chiamata OpenAI
+METADATA_FIELDS = (
+    "position",
+    "company",
+    "apply_url",
+    "company_id",
+    "location",
+    "workplace_types",
+    "experience_level",
+    "jobtype",
+)
+
+
+def description_fingerprint(job_description: str | None) -> str:
+    """sha256 della descrizione normalizzata (come la chiave della cache di arricchimento)."""
+    return hashlib.sha256(normalize_description(job_description or "").encode("utf-8")).hexdigest()
+
+
+def fingerprints(job_data: Mapping) -> Tuple[str, str]:
+    """(description_hash, content_hash) di un record di job_posting_pre; content_hash copre anche la descrizione."""
+    description_hash = description_fingerprint(job_data["job_description"])
+    content = [job_data[field] for field in METADATA_FIELDS] + [description_hash]
+    content_hash = hashlib.sha256(json.dumps(content, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return description_hash, content_hash
+
+
+def refresh_pre_fingerprints(session: Session, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Calcola le impronte di job_posting_pre a blocchi (keyset su id), scrivendo solo quelle cambiate.
+    Gli hash sono calcolati in Python perché sha256 non è disponibile in modo portabile in SQL.
+    """
+    columns = [JobPostingPre.id, JobPostingPre.job_description, JobPostingPre.description_hash, JobPostingPre.content_hash]
+    columns += [getattr(JobPostingPre, field) for field in METADATA_FIELDS]
+    updated = 0
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select(*columns).where(JobPostingPre.id > last_id).order_by(JobPostingPre.id).limit(chunk_size)
+        ).mappings().all()
+        if not rows:
+            return updated
+        last_id = rows[-1]["id"]
+        changes = []
+        for row in rows:
+            description_hash, content_hash = fingerprints(row)
+            if (description_hash, content_hash) != (row["description_hash"], row["content_hash"]):
+                changes.append({"id": row["id"], "description_hash": description_hash, "content_hash": content_hash})
+        if changes:
+            session.execute(update(JobPostingPre), changes)
+            session.commit()
+            updated += len(changes)
+
+
+def adopt_baseline_fingerprints(session: Session) -> int:
+    """
+    I record di job_postings senza impronte (scritti prima della migrazione 0011) adottano quelle attuali
+    di job_posting_pre: vengono considerati invariati invece di essere arricchiti di nuovo.
+    """
+    pre = select(JobPostingPre).where(JobPostingPre.partner_job_id == JobPostings.partner_job_id)
+    result = session.execute(
+        update(JobPostings)
+        .where(JobPostings.description_hash.is_(None), pre.exists())
+        .values(
+            description_hash=pre.with_only_columns(JobPostingPre.description_hash).scalar_subquery(),
+            content_hash=pre.with_only_columns(JobPostingPre.content_hash).scalar_subquery(),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+    return result.rowcount or 0
+
+
+def up_to_date_condition():
+    """
+    Condizione correlata: il record di job_posting_pre ha un corrispondente in job_postings arricchito
+    dalla stessa descrizione (un'impronta non ancora calcolata conta come uguale).
+    """
+    return (
+        select(JobPostings.id)
+        .where(JobPostings.partner_job_id == JobPostingPre.partner_job_id)
+        .where(or_(
+            JobPostingPre.description_hash.is_(None),
+            JobPostings.description_hash.is_(None),
+            JobPostings.description_hash == JobPostingPre.description_hash,
+        ))
+        .exists()
+    )
+
+
+def _metadata_changed():
+    return and_(
+        JobPostings.description_hash == JobPostingPre.description_hash,
+        JobPostings.content_hash != JobPostingPre.content_hash,
+    )
+
+
+class DiffSummary(NamedTuple):
+    new: int
+    changed: int
+    metadata_changed: int
+    unchanged: int
+    expired: int
+
+
+def classify(session: Session) -> DiffSummary:
+    """
+    Classifica i record in un solo passaggio (LEFT JOIN di job_posting_pre su job_postings per partner_job_id):
+    nuovi, descrizione cambiata, solo metadati cambiati, invariati; più i record scaduti di job_postings.
+    """
+    missing = JobPostings.id.is_(None)
+    changed = and_(
+        JobPostings.description_hash.is_not(None),
+        JobPostingPre.description_hash.is_not(None),
+        JobPostings.description_hash != JobPostingPre.description_hash,
+    )
+    bucket = case((missing, "new"), (changed, "changed"), (_metadata_changed(), "metadata_changed"), else_="unchanged")
+    statement = (
+        select(bucket, func.count())
+        .select_from(JobPostingPre)
+        .outerjoin(JobPostings, JobPostings.partner_job_id == JobPostingPre.partner_job_id)
+        .where(tracked_condition())
+        .group_by(bucket)
+    )
+    counts = dict.fromkeys(("new", "changed", "metadata_changed", "unchanged"), 0)
+    counts.update(session.execute(statement).all())
+    return DiffSummary(expired=count_expired(session), **counts)
+
+
+def iter_metadata_changed(session: Session, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[JobPostingPre, str | None]]:
+    """Coppie (record di job_posting_pre, descrizione già migliorata) dei record con soli metadati cambiati."""
+    last_id = 0
+    while True:
+        rows = session.exec(
+            select(JobPostingPre, JobPostings.description)
+            .join(JobPostings, JobPostings.partner_job_id == JobPostingPre.partner_job_id)
+            .where(_metadata_changed(), JobPostingPre.id > last_id)
+            .order_by(JobPostingPre.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1][0].id
@@ -0,0 +1,127 @@
+"""
+Motore di arricchimento concorrente per le job descriptions.
+Esegue le chiamate OpenAI su un pool di thread con parallelismo limitato e rate limit
+su richieste e token al minuto, restituendo i risultati al writer del database man mano
+che sono pronti (in ordine di input oppure di completamento).
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, Iterator, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def estimate_tokens(text: str | None) -> int:
+    """Stima grossolana dei token (circa 4 caratteri per token), sufficiente per il rate limit."""
+    if not text:
+        return 1
+    return max(1, len(text) // 4)
+
+
+class RateLimiter:
+    """
+    Token bucket thread-safe su due dimensioni: richieste al minuto e token al minuto.
+    acquire() blocca finché entrambi i bucket hanno capacità sufficiente.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep) -> None:
+        self._rpm = requests_per_minute
+        self._tpm = tokens_per_minute
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._requests = float(requests_per_minute or 0)
+        self._tokens = float(tokens_per_minute or 0)
+        self._updated = clock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._updated = now
+        if self._rpm:
+            self._requests = min(self._rpm, self._requests + elapsed * self._rpm / 60.0)
+        if self._tpm:
+            self._tokens = min(self._tpm, self._tokens + elapsed * self._tpm / 60.0)
+
+    def acquire(self, tokens: int = 1) -> None:
+        if not self._rpm and not self._tpm:
+            return
+        if self._tpm:
+            # Una singola richiesta più grande del bucket non deve bloccare per sempre
+            tokens = min(tokens, self._tpm)
+        while True:
+            with self._lock:
+                self._refill(self._clock())
+                wait_s = 0.0
+                if self._rpm and self._requests < 1:
+                    wait_s = max(wait_s, (1 - self._requests) * 60.0 / self._rpm)
+                if self._tpm and self._tokens < tokens:
+                    wait_s = max(wait_s, (tokens - self._tokens) * 60.0 / self._tpm)
+                if wait_s == 0.0:
+                    if self._rpm:
+                        self._requests -= 1
+                    if self._tpm:
+                        self._tokens -= tokens
+                    return
+            self._sleep(wait_s)
+
+
+def enrich_concurrently(
+    items: Iterable[T],
+    enrich: Callable[[T], R],
+    concurrency: int = 8,
+    rate_limiter: Optional[RateLimiter] = None,
+    cost: Callable[[T], int] = lambda item: 1,
+    ordered: bool = False,
+    idle: Optional[Callable[[], None]] = None,
+    idle_interval_s: float = 1.0,
+) -> Iterator[Tuple[T, R]]:
+    """
+    Applica enrich a ogni item con al massimo concurrency chiamate in volo.
+    Restituisce coppie (item, risultato): in ordine di input se ordered, altrimenti appena pronte.
+    Gli item vengono consumati in modo lazy, quindi in memoria restano solo quelli in volo.
+    Un'eccezione di enrich viene propagata al consumer quando arriva il suo risultato.
+    idle, se presente, viene chiamato nel thread del consumer ogni idle_interval_s secondi passati ad
+    attendere un risultato (ad esempio per il flush a tempo del BatchWriter).
+    """
+    concurrency = max(1, concurrency)
+
+    def _run(item: T) -> R:
+        if rate_limiter is not None:
+            rate_limiter.acquire(cost(item))
+        return enrich(item)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="enrich") as executor:
+        source = iter(items)
+        in_flight: "deque[Tuple[T, Future]]" = deque()
+
+        def _fill() -> None:
+            while len(in_flight) < concurrency:
+                try:
+                    item = next(source)
+                except StopIteration:
+                    return
+                in_flight.append((item, executor.submit(_run, item)))
+
+        _fill()
+        while in_flight:
+            awaited = [in_flight[0][1]] if ordered else [future for _, future in in_flight]
+            while idle is not None and not wait(awaited, timeout=idle_interval_s, return_when=FIRST_COMPLETED).done:
+                idle()
+            if ordered:
+                item, future = in_flight.popleft()
+                result = future.result()
+            else:
+                wait([future for _, future in in_flight], return_when=FIRST_COMPLETED)
+                index = next(i for i, (_, future) in enumerate(in_flight) if future.done())
+                item, future = in_flight[index]
+                del in_flight[index]
+                result = future.result()
+            _fill()
+            yield item, result
@@ -0,0 +1,201 @@
+"""
+Cache persistente delle descrizioni migliorate da OpenAI.
+La chiave è lo sha256 di (prompt, modello, job_description normalizzata): un annuncio che scade e
+ricompare, o la stessa descrizione condivisa da più annunci, non viene inviato a OpenAI due volte.
+Le voci sono salvate nella tabella enrichment_cache con davanti una LRU in memoria; prune() applica
+TTL e numero massimo di voci in base a last_used_at. Gli hit serviti dalla memoria aggiornano
+last_used_at al più una volta ogni touch_interval_s per chiave; gli altri vengono scritti da flush().
+"""
+
+from __future__ import annotations
+
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from sqlalchemy import delete, update
+from sqlmodel import Session, func, select
+
+from api.wrapping.models import EnrichmentCacheEntry, utc_now
+
+
+def normalize_description(text: str) -> str:
+    """Normalizza gli spazi (compresi a capo e CRLF) così che differenze solo di whitespace producano la stessa chiave."""
+    return " ".join(text.split())
+
+
+def make_cache_key(prompt: str, model: str, job_description: str) -> str:
+    digest = hashlib.sha256()
+    for part in (prompt, model, normalize_description(job_description)):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class EnrichmentCache:
+    """Cache thread-safe: LRU in memoria (memory_entries) davanti alla tabella enrichment_cache."""
+
+    def __init__(
+        self,
+        engine,
+        prompt: str,
+        model: str,
+        ttl_days: int = 90,
+        max_entries: int = 50000,
+        memory_entries: int = 1000,
+        touch_interval_s: float = 3600.0,
+        clock: Callable[[], datetime] = utc_now,
+    ) -> None:
+        self._engine = engine
+        self._prompt = prompt
+        self._model = model
+        self._ttl = timedelta(days=ttl_days)
+        self._max_entries = max_entries
+        self._memory_entries = memory_entries
+        self._touch_interval = timedelta(seconds=touch_interval_s)
+        self._clock = clock
+        # chiave -> (descrizione migliorata, last_used_at scritto nella tabella)
+        self._memory: "OrderedDict[str, Tuple[str, datetime]]" = OrderedDict()
+        # Hit serviti dalla memoria non ancora scritti nella tabella
+        self._pending_hits: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key_for(self, job_description: str) -> str:
+        return make_cache_key(self._prompt, self._model, job_description)
+
+    def _remember(self, key: str, value: str, touched_at: datetime) -> None:
+        with self._lock:
+            self._memory[key] = (value, touched_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self._memory_entries:
+                self._memory.popitem(last=False)
+
+    def _touch(self, session: Session, key: str, hits: int, now: datetime) -> None:
+        """Aggiorna last_used_at (per TTL ed eviction LRU persistente) e il contatore di hit di una voce."""
+        session.execute(
+            update(EnrichmentCacheEntry)
+            .where(EnrichmentCacheEntry.cache_key == key)
+            .values(last_used_at=now, hits=EnrichmentCacheEntry.hits + hits)
+        )
+
+    def get(self, job_description: str) -> Optional[str]:
+        """Descrizione migliorata in cache per job_description, o None. Le voci scadute (TTL) sono ignorate."""
+        key = self.key_for(job_description)
+        now = self._clock()
+        value = None
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                value, touched_at = cached
+                if touched_at < now - self._ttl:
+                    # Scaduta anche nella tabella, salvo che un altro worker l'abbia usata nel frattempo
+                    del self._memory[key]
+                    value = None
+                elif now - touched_at < self._touch_interval:
+                    self._memory.move_to_end(key)
+                    self._pending_hits[key] = self._pending_hits.get(key, 0) + 1
+                    self.hits += 1
+                    return value
+
+        with Session(self._engine) as session:
+            if value is None:
+                entry = session.get(EnrichmentCacheEntry, key)
+                if entry is not None and entry.last_used_at >= now - self._ttl:
+                    value = entry.improved_description
+            if value is not None:
+                with self._lock:
+                    hits = self._pending_hits.pop(key, 0) + 1
+                self._touch(session, key, hits, now)
+                session.commit()
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is not None:
+            self._remember(key, value, now)
+        return value
+
+    def flush(self) -> int:
+        """Scrive nella tabella gli hit serviti dalla memoria non ancora registrati; restituisce le voci aggiornate."""
+        with self._lock:
+            pending, self._pending_hits = self._pending_hits, {}
+        if not pending:
+            return 0
+        now = self._clock()
+        with Session(self._engine) as session:
+            for key, hits in pending.items():
+                self._touch(session, key, hits, now)
+            session.commit()
+        with self._lock:
+            for key in pending:
+                cached = self._memory.get(key)
+                if cached is not None:
+                    self._memory[key] = (cached[0], now)
+        return len(pending)
+
+    def put(self, job_description: str, improved_description: str) -> None:
+        key = self.key_for(job_description)
+        now = self._clock()
+        with Session(self._engine) as session:
+            entry = session.get(EnrichmentCacheEntry, key)
+            if entry is None:
+                entry = EnrichmentCacheEntry(
+                    cache_key=key,
+                    improved_description=improved_description,
+                    created_at=now,
+                    last_used_at=now,
+                )
+            else:
+                entry.improved_description = improved_description
+                entry.last_used_at = now
+            session.add(entry)
+            try:
+                session.commit()
+            except Exception:
+                # Un altro worker ha inserito la stessa chiave nel frattempo
+                session.rollback()
+        self._remember(key, improved_description, now)
+
+    def prune(self) -> int:
+        """Elimina le voci non usate da più del TTL e, oltre max_entries, quelle usate meno di recente."""
+        self.flush()
+        removed = 0
+        with Session(self._engine) as session:
+            result = session.execute(
+                delete(EnrichmentCacheEntry).where(EnrichmentCacheEntry.last_used_at < self._clock() - self._ttl)
+            )
+            removed += result.rowcount or 0
+            count = session.exec(select(func.count()).select_from(EnrichmentCacheEntry)).one()
+            excess = count - self._max_entries
+            if excess > 0:
+                oldest = session.exec(
+                    select(EnrichmentCacheEntry.cache_key)
+                    .order_by(EnrichmentCacheEntry.last_used_at)
+                    .limit(excess)
+                ).all()
+                for i in range(0, len(oldest), 500):
+                    result = session.execute(
+                        delete(EnrichmentCacheEntry).where(EnrichmentCacheEntry.cache_key.in_(oldest[i:i + 500]))
+                    )
+                    removed += result.rowcount or 0
+            session.commit()
+        with self._lock:
+            self._memory.clear()
+        return removed
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def print_summary(self) -> None:
+        total = self.hits + self.misses
+        if not total:
+            return
+        print(f"\n🗃️  Cache arricchimento: {self.hits} hit, {self.misses} miss (hit rate {self.hit_rate:.1%})")
@@ -3,19 +3,33 @@
 Script per migliorare le job descriptions usando OpenAI e copiarle da job_posting_pre a job_postings.
 """
 
+import argparse
+import multiprocessing
 import os
 import sys
+import threading
+import time
 from pathlib import Path
 from typing import List
 from dotenv import load_dotenv
-from sqlalchemy import text
+from datetime import timedelta
+from sqlalchemy import delete, text
 from sqlmodel import SQLModel, create_engine, Session, select
 
 # Aggiungi il path del progetto per gli import
 project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
-from api.wrapping.models import JobPostings, JobPostingPre
+from api.wrapping.models import JobPostings, JobPostingPre, JobPostingTombstone, utc_now
+from api.wrapping.wrapping import materialize_job_fragment
+from scripts import diff_engine
+from scripts.batch_enrichment import build_batch_file, fetch_batch_results, submit_batch, wait_for_batch
+from scripts.enrichment import RateLimiter, enrich_concurrently, estimate_tokens
+from scripts.enrichment_cache import EnrichmentCache
+from scripts.openai_client import LatencyRecorder, create_openai_client
+from scripts.pipeline_state import PipelineQueue, default_worker_id
+from scripts.upsert import BatchWriter
+from utils.metrics import Gauge, Histogram, Registry, export_enabled, export_metrics
 
 # Carica variabili d'ambiente
 env_path = project_root / ".env"
@@ -24,7 +38,41 @@ if env_path.exists():
 
 # Configurazione (caricate all'import, verificate in main())
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_MODEL = "gpt-4.1-mini"
+# Endpoint OpenAI alternativo (ad esempio un server stub per i test); None = API ufficiale
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Chiamate OpenAI in parallelo e limiti di rate (richieste e token al minuto, 0 = nessun limite)
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "8"))
+OPENAI_MAX_RPM = int(os.getenv("OPENAI_MAX_RPM", "500"))
+OPENAI_MAX_TPM = int(os.getenv("OPENAI_MAX_TPM", "200000"))
+# Cache delle descrizioni migliorate: giorni di validità dall'ultimo uso e numero massimo di voci
+ENRICHMENT_CACHE_TTL_DAYS = int(os.getenv("ENRICHMENT_CACHE_TTL_DAYS", "90"))
+ENRICHMENT_CACHE_MAX_ENTRIES = int(os.getenv("ENRICHMENT_CACHE_MAX_ENTRIES", "50000"))
+# Modalità bulk (Batch API): richieste per batch e intervallo di polling
+BATCH_MAX_REQUESTS = int(os.getenv("OPENAI_BATCH_MAX_REQUESTS", "5000"))
+BATCH_POLL_INTERVAL_S = float(os.getenv("OPENAI_BATCH_POLL_INTERVAL_S", "60"))
+# Giorni di conservazione dei tombstone degli annunci rimossi (delta feed)
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
+# Coda persistente della pipeline (pipeline_jobs): tentativi massimi, backoff esponenziale dei record falliti,
+# timeout dopo cui un record in lavorazione da un altro worker viene considerato abbandonato, record per claim
+PIPELINE_WORKER_ID = os.getenv("PIPELINE_WORKER_ID") or None
+PIPELINE_MAX_ATTEMPTS = int(os.getenv("PIPELINE_MAX_ATTEMPTS", "5"))
+PIPELINE_BACKOFF_BASE_S = float(os.getenv("PIPELINE_BACKOFF_BASE_S", "60"))
+PIPELINE_BACKOFF_MAX_S = float(os.getenv("PIPELINE_BACKOFF_MAX_S", "3600"))
+PIPELINE_CLAIM_TIMEOUT_S = float(os.getenv("PIPELINE_CLAIM_TIMEOUT_S", "900"))
+PIPELINE_CLAIM_SIZE = int(os.getenv("PIPELINE_CLAIM_SIZE", "500"))
+# Processi worker locali (--workers) e intervallo dei report di avanzamento del coordinatore
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "1"))
+PIPELINE_PROGRESS_INTERVAL_S = float(os.getenv("PIPELINE_PROGRESS_INTERVAL_S", "30"))
+# Scrittura in job_postings: record per flush e secondi massimi tra due flush
+WRITER_BATCH_SIZE = int(os.getenv("WRITER_BATCH_SIZE", "200"))
+WRITER_FLUSH_INTERVAL_S = float(os.getenv("WRITER_FLUSH_INTERVAL_S", "5"))
+
+# Client OpenAI condiviso (vedi get_openai_client) e tempi delle chiamate
+_openai_client = None
+_openai_client_lock = threading.Lock()
+latency_recorder = LatencyRecorder()
 
 # Prompt OpenAI
 OPENAI_PROMPT = """ Il tuo compito è:
@@ -133,14 +181,19 @@ def truncate_job_postings(session: Session):
     print("Tabella job_postings troncata con successo.")
 
 
-def fetch_all_job_postings_pre(session: Session) -> List[JobPostingPre]:
-    """Legge tutti i record da job_posting_pre."""
-    print("Leggendo record da job_posting_pre...")
-    statement = select(JobPostingPre)
-    results = session.exec(statement)
-    job_postings = list(results.all())
-    print(f"Trovati {len(job_postings)} job postings in job_posting_pre.")
-    return job_postings
+def fetch_new_job_postings_pre(session: Session, include_changed: bool = False) -> List[JobPostingPre]:
+    """
+    Legge da job_posting_pre solo i record non ancora presenti in job_postings (con include_changed anche
+    quelli la cui descrizione è cambiata). Il filtro è un anti-join eseguito dal database: gli id vengono
+    letti a blocchi e solo i record da processare vengono caricati in memoria.
+    """
+    new_job_postings = []
+    ids = list(diff_engine.iter_new_pre_ids(session, include_changed=include_changed))
+    for start in range(0, len(ids), diff_engine.CHUNK_SIZE):
+        chunk = ids[start:start + diff_engine.CHUNK_SIZE]
+        statement = select(JobPostingPre).where(JobPostingPre.id.in_(chunk)).order_by(JobPostingPre.id)
+        new_job_postings.extend(session.exec(statement).all())
+    return new_job_postings
 
 
 def get_new_job_postings_to_process(session: Session) -> List[JobPostingPre]:
@@ -152,38 +205,23 @@ def get_new_job_postings_to_process(session: Session) -> List[JobPostingPre]:
     print("ANALISI RECORD DA PROCESSARE")
     print("=" * 60)
     
-    # 1. Leggi tutti i record da job_posting_pre
-    all_pre = fetch_all_job_postings_pre(session)
+    # 1. Conta i record in job_posting_pre
+    pre_records_count = diff_engine.count_rows(session, JobPostingPre)
     
-    if not all_pre:
+    if not pre_records_count:
         print("Nessun record trovato in job_posting_pre.")
         return []
     
-    # 2. Ottieni tutti i partner_job_id già presenti in job_postings
+    # 2. Anti-join nel database: solo i record non ancora presenti in job_postings o con la descrizione cambiata
     print("Verificando quali record sono già stati processati...")
-    existing_partner_ids = set()
-    existing_postings = session.exec(select(JobPostings.partner_job_id)).all()
-    for partner_id in existing_postings:
-        if partner_id:
-            existing_partner_ids.add(partner_id)
-    
-    print(f"Trovati {len(existing_partner_ids)} partner_job_id già presenti in job_postings.")
-    
-    # 3. Filtra solo i nuovi record (non ancora presenti)
-    new_job_postings = []
-    skipped_count = 0
-    
-    for job_pre in all_pre:
-        if job_pre.partner_job_id not in existing_partner_ids:
-            # Nuovo record: da processare
-            new_job_postings.append(job_pre)
-        else:
-            # Già presente: skip
-            skipped_count += 1
+    new_job_postings = fetch_new_job_postings_pre(session, include_changed=True)
+    untracked_count = diff_engine.count_untracked(session)
+    skipped_count = pre_records_count - len(new_job_postings) - untracked_count
     
     print(f"\n📊 Riepilogo:")
-    print(f"  - Totali record in job_posting_pre: {len(all_pre)}")
+    print(f"  - Totali record in job_posting_pre: {pre_records_count}")
     print(f"  - Record già processati (da saltare): {skipped_count}")
+    print(f"  - Record senza partner_job_id (saltati): {untracked_count}")
     print(f"  - Nuovi record da processare: {len(new_job_postings)}")
     
     if len(new_job_postings) == 0:
@@ -196,6 +234,58 @@ def get_new_job_postings_to_process(session: Session) -> List[JobPostingPre]:
     return new_job_postings
 
 
+def detect_changes(session: Session) -> diff_engine.DiffSummary:
+    """
+    Aggiorna le impronte di job_posting_pre e classifica i record in nuovi, con descrizione cambiata,
+    con soli metadati cambiati, invariati e scaduti.
+    """
+    print("\n" + "=" * 60)
+    print("RILEVAMENTO MODIFICHE")
+    print("=" * 60)
+    
+    refreshed = diff_engine.refresh_pre_fingerprints(session)
+    adopted = diff_engine.adopt_baseline_fingerprints(session)
+    if adopted:
+        print(f"Impronte di riferimento adottate per {adopted} record esistenti di job_postings.")
+    summary = diff_engine.classify(session)
+    
+    print(f"\n📊 Impronte aggiornate in job_posting_pre: {refreshed}")
+    print(f"  - Nuovi: {summary.new}")
+    print(f"  - Descrizione cambiata (da arricchire di nuovo): {summary.changed}")
+    print(f"  - Solo metadati cambiati (senza OpenAI): {summary.metadata_changed}")
+    print(f"  - Invariati: {summary.unchanged}")
+    print(f"  - Scaduti: {summary.expired}")
+    print("=" * 60 + "\n")
+    return summary
+
+
+def apply_metadata_changes(engine, batch_size: int = WRITER_BATCH_SIZE) -> int:
+    """
+    Aggiorna in job_postings i record con soli metadati cambiati (posizione, azienda, location, URL, ...),
+    mantenendo la descrizione già migliorata: nessuna chiamata OpenAI.
+    """
+    with Session(engine) as session, BatchWriter(engine, max_rows=batch_size, max_interval_s=float("inf")) as writer:
+        for job_pre, improved_description in diff_engine.iter_metadata_changed(session):
+            writer.add(build_job_posting(_extract_job_data(job_pre), improved_description))
+    if writer.written:
+        print(f"✏️  Aggiornati {writer.written} record con soli metadati cambiati (senza chiamate OpenAI).")
+    return writer.written
+
+
+def prune_tombstones(session: Session, retention_days: int = TOMBSTONE_RETENTION_DAYS) -> int:
+    """Elimina i tombstone più vecchi di retention_days: i consumer del delta feed devono sincronizzarsi entro tale periodo."""
+    cutoff = utc_now() - timedelta(days=retention_days)
+    result = session.execute(delete(JobPostingTombstone).where(JobPostingTombstone.deleted_at < cutoff))
+    session.commit()
+    if result.rowcount:
+        print(f"Eliminati {result.rowcount} tombstone più vecchi di {retention_days} giorni.")
+    return result.rowcount
+
+
+# Numero massimo di annunci scaduti mostrati nella tabella di riepilogo
+EXPIRED_REPORT_LIMIT = 50
+
+
 def remove_expired_job_postings(session: Session):
     """
     Rimuove i record scaduti da job_postings.
@@ -205,253 +295,687 @@ def remove_expired_job_postings(session: Session):
     print("RIMOZIONE ANNUNCI SCADUTI")
     print("=" * 60)
     
-    # 1. Ottieni tutti i partner_job_id da job_posting_pre
-    pre_partner_ids = set()
-    pre_records = session.exec(select(JobPostingPre)).all()
+    # 0. Elimina i tombstone più vecchi del periodo di retention
+    prune_tombstones(session)
+    
+    pre_records_count = diff_engine.count_rows(session, JobPostingPre)
     
     # SICUREZZA: Verifica che job_posting_pre non sia vuoto
-    if not pre_records:
+    if not pre_records_count:
         print("⚠️  ATTENZIONE: job_posting_pre è vuota!")
         print("   Non rimuoverò nessun record per sicurezza.")
         print("   Assicurati di aver caricato i dati correttamente.")
         print("=" * 60 + "\n")
         return 0
     
-    for pre in pre_records:
-        if pre.partner_job_id:
-            pre_partner_ids.add(pre.partner_job_id)
+    print(f"Trovati {pre_records_count} record in job_posting_pre.")
+    print(f"Trovati {diff_engine.count_distinct_partner_ids(session, JobPostingPre)} partner_job_id attivi in job_posting_pre.")
     
-    print(f"Trovati {len(pre_records)} record in job_posting_pre.")
-    print(f"Trovati {len(pre_partner_ids)} partner_job_id attivi in job_posting_pre.")
+    # 1. Conta i record in job_postings che non sono più in job_posting_pre (anti-join nel database)
+    expired_count = diff_engine.count_expired(session)
     
-    # 2. Trova i record in job_postings che non sono più in job_posting_pre
-    all_postings = session.exec(select(JobPostings)).all()
-    expired_postings = []
-    
-    for posting in all_postings:
-        # Se il partner_job_id non è più in job_posting_pre, il record è scaduto
-        if posting.partner_job_id and posting.partner_job_id not in pre_partner_ids:
-            expired_postings.append(posting)
-    
-    if not expired_postings:
+    if not expired_count:
         print("\n✅ Nessun annuncio scaduto da rimuovere.")
         print("=" * 60 + "\n")
         return 0
     
-    # 3. Mostra informazioni dettagliate sugli annunci scaduti
-    print(f"\n⚠️  Trovati {len(expired_postings)} annunci scaduti da rimuovere.")
+    # 2. Mostra informazioni sui primi annunci scaduti
+    expired_sample = diff_engine.sample_expired(session, EXPIRED_REPORT_LIMIT)
+    print(f"\n⚠️  Trovati {expired_count} annunci scaduti da rimuovere.")
     print("\n" + "-" * 100)
     print(f"{'ID':<6} | {'partner_job_id':<15} | {'Position':<40} | {'Company':<20}")
     print("-" * 100)
     
-    # Mostra tutti i record scaduti in formato tabella
-    for posting in expired_postings:
+    for posting in expired_sample:
         position_short = (posting.position[:38] + '..') if posting.position and len(posting.position) > 40 else (posting.position or 'N/A')
         company_short = (posting.company[:18] + '..') if posting.company and len(posting.company) > 20 else (posting.company or 'N/A')
         print(f"{str(posting.id):<6} | {str(posting.partner_job_id):<15} | {position_short:<40} | {company_short:<20}")
     
+    if expired_count > len(expired_sample):
+        print(f"... e altri {expired_count - len(expired_sample)} annunci scaduti")
     print("-" * 100)
     
     # Mostra dettagli completi dei primi 5 record
-    if len(expired_postings) > 0:
-        print(f"\n📋 Dettagli completi dei primi 5 record scaduti:")
-        for i, posting in enumerate(expired_postings[:5], 1):
-            print(f"\n  {i}. Record ID: {posting.id}")
-            print(f"     partner_job_id: {posting.partner_job_id}")
-            print(f"     Position: {posting.position or 'N/A'}")
-            print(f"     Company: {posting.company or 'N/A'}")
-            print(f"     Location: {posting.location or 'N/A'}")
-            print(f"     Created at: {posting.created_at or 'N/A'}")
-        
-        if len(expired_postings) > 5:
-            print(f"\n  ... e altri {len(expired_postings) - 5} record scaduti")
+    print(f"\n📋 Dettagli completi dei primi 5 record scaduti:")
+    for i, posting in enumerate(expired_sample[:5], 1):
+        print(f"\n  {i}. Record ID: {posting.id}")
+        print(f"     partner_job_id: {posting.partner_job_id}")
+        print(f"     Position: {posting.position or 'N/A'}")
+        print(f"     Company: {posting.company or 'N/A'}")
+        print(f"     Location: {posting.location or 'N/A'}")
+        print(f"     Created at: {posting.created_at or 'N/A'}")
     
-    # 4. Rimuovi i record scaduti
-    print(f"\n🗑️  Rimuovendo {len(expired_postings)} annunci scaduti da job_postings...")
+    if expired_count > 5:
+        print(f"\n  ... e altri {expired_count - 5} record scaduti")
     
-    for posting in expired_postings:
-        session.delete(posting)
-    
-    session.commit()
+    # 3. Rimuovi i record scaduti a blocchi, registrando i tombstone per il delta feed (/wrapping?since=...)
+    print(f"\n🗑️  Rimuovendo {expired_count} annunci scaduti da job_postings...")
+    removed_count = diff_engine.delete_expired(session, deleted_at=utc_now())
     
-    print(f"✅ Rimossi {len(expired_postings)} annunci scaduti con successo.")
+    print(f"✅ Rimossi {removed_count} annunci scaduti con successo.")
     print("=" * 60 + "\n")
     
-    return len(expired_postings)
+    return removed_count
 
 
-def improve_job_description_with_openai(job_description: str | None) -> str | None:
-    """Migliora una job description usando OpenAI."""
+def build_job_posting(job_data: dict, improved_description: str | None) -> JobPostings:
+    """Crea il JobPostings da inserire copiando i campi di job_posting_pre con la descrizione migliorata."""
+    job_posting = JobPostings(
+        position=job_data['position'],
+        description=improved_description,
+        company=job_data['company'],
+        apply_url=job_data['apply_url'],
+        company_id=job_data['company_id'],
+        location=job_data['location'],
+        workplace_types=job_data['workplace_types'],
+        experience_level=job_data['experience_level'],
+        jobtype=job_data['jobtype'],
+        partner_job_id=job_data['partner_job_id'],
+        last_build_date=job_data['last_build_date'],
+        created_at=job_data['created_at'],
+        # updated_at indica l'ultima scrittura in job_postings: è il watermark del delta feed
+        updated_at=utc_now()
+    )
+    # Impronte del contenuto di origine: la prossima esecuzione rileva così le modifiche in job_posting_pre
+    job_posting.description_hash, job_posting.content_hash = diff_engine.fingerprints(job_data)
+    # Pre-renderizza il frammento XML servito da /wrapping
+    job_posting.xml_fragment = materialize_job_fragment(job_posting)
+    return job_posting
+
+
+def _enrichment_cost(job_description: str | None) -> int:
+    """Token stimati per una chiamata: prompt + descrizione in input e descrizione migliorata in output."""
+    return estimate_tokens(OPENAI_PROMPT) + 2 * estimate_tokens(job_description)
+
+
+def build_openai_request(job_description: str) -> dict:
+    """Parametri della chat completion per migliorare una job description (usati anche dalla Batch API)."""
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [
+            {
+                "role": "system",
+                "content": "Sei un assistente esperto nella formattazione di annunci di lavoro per LinkedIn. Il tuo compito è migliorare la formattazione mantenendo il testo originale."
+            },
+            {
+                "role": "user",
+                "content": f"{OPENAI_PROMPT}\n\nJob description originale:\n\n{job_description}"
+            }
+        ]
+    }
+
+
+def get_openai_client():
+    """Restituisce il client OpenAI condiviso dall'intera esecuzione, creandolo alla prima chiamata."""
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            _openai_client = create_openai_client(
+                OPENAI_API_KEY,
+                base_url=OPENAI_BASE_URL,
+                max_connections=max(OPENAI_CONCURRENCY, 1),
+                recorder=latency_recorder,
+            )
+    return _openai_client
+
+
+def improve_job_description_with_openai(
+    job_description: str | None,
+    client=None,
+    cache: EnrichmentCache | None = None,
+    rate_limiter: RateLimiter | None = None,
+    raise_errors: bool = False,
+) -> str | None:
+    """
+    Migliora una job description usando OpenAI (con il client condiviso se non ne viene passato uno).
+    Se è presente una cache viene consultata prima di qualsiasi chiamata di rete; il rate limiter
+    viene applicato solo alle chiamate effettive.
+    In caso di errore restituisce la descrizione originale, oppure rilancia l'eccezione se raise_errors.
+    """
     if not job_description:
         return None
     
+    if cache is not None:
+        try:
+            cached = cache.get(job_description)
+            if cached is not None:
+                return cached
+        except Exception as e:
+            print(f"  ⚠️  Errore leggendo la cache di arricchimento: {e}")
+    
     try:
-        from openai import OpenAI
-        
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        client = client or get_openai_client()
+        if rate_limiter is not None:
+            rate_limiter.acquire(_enrichment_cost(job_description))
         
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Sei un assistente esperto nella formattazione di annunci di lavoro per LinkedIn. Il tuo compito è migliorare la formattazione mantenendo il testo originale."
-                },
-                {
-                    "role": "user",
-                    "content": f"{OPENAI_PROMPT}\n\nJob description originale:\n\n{job_description}"
-                }
-            ]
-        )
+        with latency_recorder.measure():
+            response = client.chat.completions.create(**build_openai_request(job_description))
         
         improved_description = response.choices[0].message.content.strip()
-        return improved_description
     except Exception as e:
         print(f"Errore durante il miglioramento con OpenAI: {e}")
+        if raise_errors:
+            raise
         # In caso di errore, restituisci la descrizione originale
         return job_description
+    
+    if cache is not None:
+        try:
+            cache.put(job_description, improved_description)
+        except Exception as e:
+            print(f"  ⚠️  Errore scrivendo la cache di arricchimento: {e}")
+    return improved_description
 
 
-def check_if_already_processed(session: Session, partner_job_id: str | None) -> bool:
-    """Verifica se un job posting è già stato processato."""
-    if not partner_job_id:
-        return False
-    statement = select(JobPostings).where(JobPostings.partner_job_id == partner_job_id)
-    result = session.exec(statement).first()
-    return result is not None
+def _extract_job_data(job_pre: JobPostingPre) -> dict:
+    """Estrae i campi di un JobPostingPre in un dict (per evitare problemi con oggetti expired tra thread e sessioni)."""
+    return {
+        'id': job_pre.id,
+        'partner_job_id': job_pre.partner_job_id,
+        'position': job_pre.position,
+        'job_description': job_pre.job_description,
+        'company': job_pre.company,
+        'apply_url': job_pre.apply_url,
+        'company_id': job_pre.company_id,
+        'location': job_pre.location,
+        'workplace_types': job_pre.workplace_types,
+        'experience_level': job_pre.experience_level,
+        'jobtype': job_pre.jobtype,
+        'last_build_date': job_pre.last_build_date,
+        'created_at': job_pre.created_at,
+        'updated_at': job_pre.updated_at,
+    }
 
 
-def process_and_insert_incremental(engine, job_postings: List[JobPostingPre], batch_size: int = 20):
+def create_enrichment_cache(engine) -> EnrichmentCache:
+    """Crea la cache di arricchimento ed elimina le voci scadute o in eccesso."""
+    cache = EnrichmentCache(
+        engine,
+        prompt=OPENAI_PROMPT,
+        model=OPENAI_MODEL,
+        ttl_days=ENRICHMENT_CACHE_TTL_DAYS,
+        max_entries=ENRICHMENT_CACHE_MAX_ENTRIES,
+    )
+    try:
+        removed = cache.prune()
+        if removed:
+            print(f"Eliminate {removed} voci dalla cache di arricchimento.")
+    except Exception as e:
+        print(f"  ⚠️  Errore durante la pulizia della cache di arricchimento: {e}")
+    return cache
+
+
+def process_and_insert_incremental(
+    engine,
+    job_postings: List[JobPostingPre],
+    batch_size: int = 20,
+    concurrency: int = OPENAI_CONCURRENCY,
+    ordered: bool = False,
+    client=None,
+    cache: EnrichmentCache | None = None,
+    writer_batch_size: int = WRITER_BATCH_SIZE,
+    flush_interval_s: float = WRITER_FLUSH_INTERVAL_S,
+    queue: PipelineQueue | None = None,
+    max_rpm: int = OPENAI_MAX_RPM,
+    max_tpm: int = OPENAI_MAX_TPM,
+):
     """
     Processa e inserisce i job postings.
+    Le chiamate OpenAI sono eseguite in parallelo (al massimo concurrency alla volta, nei limiti
+    OPENAI_MAX_RPM / OPENAI_MAX_TPM) e il thread principale scrive i risultati con un BatchWriter
+    (upsert multi-riga ogni writer_batch_size record o flush_interval_s secondi, un commit per blocco);
+    batch_size determina solo la frequenza dei report di progresso.
+    Con queue i record devono essere stati reclamati dalla coda: vengono segnati done nella transazione
+    che li scrive e, se la chiamata OpenAI fallisce, failed con backoff (all'ultimo tentativo viene
+    pubblicata la descrizione originale).
     NOTA: Questa funzione riceve già solo i nuovi record da processare
-    (filtrati in get_new_job_postings_to_process), quindi non salta più record.
+    (filtrati in get_new_job_postings_to_process o reclamati dalla coda), quindi non salta più record.
     """
-    print(f"Processando {len(job_postings)} nuovi job postings in batch di {batch_size}...")
+    print(f"Processando {len(job_postings)} nuovi job postings con concorrenza {concurrency}...")
     
     total_processed = 0
-    total_inserted = 0
+    started_at = time.monotonic()
     
-    for i in range(0, len(job_postings), batch_size):
-        batch = job_postings[i:i + batch_size]
-        batch_num = (i // batch_size) + 1
-        total_batches = (len(job_postings) + batch_size - 1) // batch_size
-        
-        print(f"\nProcessando batch {batch_num}/{total_batches} ({len(batch)} job postings)...")
-        
-        improved_job_postings = []
-        
-        # Estrai tutti i dati necessari prima di processare (per evitare problemi con oggetti expired)
-        batch_data = []
-        for job_pre in batch:
-            try:
-                # Estrai tutti i dati necessari subito
-                batch_data.append({
-                    'id': job_pre.id,
-                    'partner_job_id': job_pre.partner_job_id,
-                    'position': job_pre.position,
-                    'job_description': job_pre.job_description,
-                    'company': job_pre.company,
-                    'apply_url': job_pre.apply_url,
-                    'company_id': job_pre.company_id,
-                    'location': job_pre.location,
-                    'workplace_types': job_pre.workplace_types,
-                    'experience_level': job_pre.experience_level,
-                    'jobtype': job_pre.jobtype,
-                    'last_build_date': job_pre.last_build_date,
-                    'created_at': job_pre.created_at,
-                    'updated_at': job_pre.updated_at,
-                })
-            except Exception as e:
-                print(f"  ⚠️  Errore nell'estrazione dati per Job ID {job_pre.id}: {e}")
-                continue
-        
-        # Processa ogni job con una nuova sessione per ogni record (per evitare che errori blocchino il batch)
-        for job_data in batch_data:
+    # Estrai tutti i dati necessari prima di processare (per evitare problemi con oggetti expired)
+    jobs_data = []
+    for job_pre in job_postings:
+        try:
+            jobs_data.append(_extract_job_data(job_pre))
+        except Exception as e:
+            print(f"  ⚠️  Errore nell'estrazione dati per Job ID {job_pre.id}: {e}")
+            continue
+    
+    # Un solo client (e pool di connessioni) per tutta l'esecuzione
+    client = client or get_openai_client()
+    if cache is None:
+        cache = create_enrichment_cache(engine)
+    rate_limiter = RateLimiter(requests_per_minute=max_rpm, tokens_per_minute=max_tpm)
+    
+    def enrich(job_data):
+        # Con la coda gli errori OpenAI vengono restituiti (non propagati) per segnare l'item failed
+        try:
+            return improve_job_description_with_openai(
+                job_data['job_description'], client=client, cache=cache, rate_limiter=rate_limiter,
+                raise_errors=queue is not None,
+            )
+        except Exception as e:
+            return e
+    
+    before_commit = None
+    if queue is not None:
+        before_commit = lambda session, batch: queue.mark_done(
+            session, [posting.partner_job_id for posting in batch if posting.partner_job_id]
+        )
+    
+    # Il writer resta single-thread: i record arricchiti vengono scritti a blocchi (per numero e per tempo)
+    with BatchWriter(
+        engine, max_rows=writer_batch_size, max_interval_s=flush_interval_s, before_commit=before_commit
+    ) as writer:
+        # Mentre si attendono le risposte OpenAI il buffer viene comunque scritto ogni flush_interval_s
+        enriched = enrich_concurrently(
+            jobs_data, enrich, concurrency=concurrency, ordered=ordered, idle=writer.flush_if_due,
+        )
+        for job_data, improved_description in enriched:
             try:
-                # Crea una nuova sessione per ogni record per evitare problemi di connessione
-                with Session(engine) as session:
-                    # Migliora la job_description
-                    print(f"  🔄 Processando Job ID {job_data['id']} (partner_job_id: {job_data['partner_job_id']})...")
-                    improved_description = improve_job_description_with_openai(job_data['job_description'])
-                    
-                    # Crea nuovo JobPostings con tutti i campi copiati
-                    job_posting = JobPostings(
-                        position=job_data['position'],
-                        description=improved_description,
-                        company=job_data['company'],
-                        apply_url=job_data['apply_url'],
-                        company_id=job_data['company_id'],
-                        location=job_data['location'],
-                        workplace_types=job_data['workplace_types'],
-                        experience_level=job_data['experience_level'],
-                        jobtype=job_data['jobtype'],
-                        partner_job_id=job_data['partner_job_id'],
-                        last_build_date=job_data['last_build_date'],
-                        created_at=job_data['created_at'],
-                        updated_at=job_data['updated_at']
-                    )
-                    
-                    # Inserisci immediatamente il record
-                    try:
-                        session.add(job_posting)
-                        session.commit()
-                        improved_job_postings.append(job_posting)
-                        total_processed += 1
-                        total_inserted += 1
-                    except Exception as e:
-                        print(f"  ⚠️  Errore inserendo Job ID {job_data['id']}: {e}")
-                        session.rollback()
-                        # Prova a inserire con una nuova sessione
-                        try:
-                            with Session(engine) as retry_session:
-                                retry_session.add(job_posting)
-                                retry_session.commit()
-                                improved_job_postings.append(job_posting)
-                                total_processed += 1
-                                total_inserted += 1
-                        except Exception as retry_e:
-                            print(f"  ⚠️  Impossibile inserire Job ID {job_data['id']} anche dopo retry: {retry_e}")
-                            continue
-                    
+                if (
+                    isinstance(improved_description, Exception)
+                    and queue is not None
+                    and not queue.is_last_attempt(job_data['partner_job_id'])
+                ):
+                    queue.mark_failed(job_data['partner_job_id'], improved_description)
+                else:
+                    if isinstance(improved_description, Exception):
+                        # Senza coda o a tentativi esauriti: pubblica la descrizione originale
+                        improved_description = job_data['job_description']
+                    writer.add(build_job_posting(job_data, improved_description))
             except Exception as e:
                 print(f"  ⚠️  Errore processando Job ID {job_data['id']}: {e}")
-                continue
-        
-        # Mostra riepilogo del batch
-        if improved_job_postings:
-            print(f"  ✅ Batch {batch_num}/{total_batches} completato. Inseriti {len(improved_job_postings)} record.")
-        else:
-            print(f"  ✅ Batch {batch_num}/{total_batches} completato (nessun nuovo record da inserire).")
-        
-        print(f"  📊 Progresso: {total_processed} processati, {total_inserted} inseriti")
+                if queue is not None and job_data['partner_job_id']:
+                    queue.mark_failed(job_data['partner_job_id'], e)
+            
+            total_processed += 1
+            if total_processed % batch_size == 0 or total_processed == len(jobs_data):
+                elapsed = time.monotonic() - started_at
+                rate = total_processed / elapsed * 60 if elapsed > 0 else 0.0
+                print(f"  📊 Progresso: {total_processed}/{len(jobs_data)} processati, {writer.written} scritti ({rate:.1f}/min)")
+    total_inserted = writer.written
+    if queue is not None:
+        for posting, error in writer.failed:
+            if posting.partner_job_id:
+                queue.mark_failed(posting.partner_job_id, error)
     
     print(f"\n{'='*60}")
     print(f"Riepilogo processamento:")
     print(f"  - Totali processati: {total_processed}")
-    print(f"  - Totali inseriti: {total_inserted}")
+    print(f"  - Totali inseriti: {total_inserted} ({writer.flushes} commit)")
+    print(f"  - Totali scartati (errore di scrittura): {len(writer.failed)}")
     print(f"{'='*60}")
+    latency_recorder.print_summary()
+    cache.flush()
+    cache.print_summary()
     
     return total_inserted
 
 
-def insert_job_postings_batch(session: Session, job_postings: List[JobPostings], batch_size: int = 100):
-    """Inserisce i job postings in batch nel database."""
-    print(f"Inserendo {len(job_postings)} job postings in batch di {batch_size}...")
+def create_pipeline_queue(engine, worker_id: str | None = PIPELINE_WORKER_ID) -> PipelineQueue:
+    return PipelineQueue(
+        engine,
+        worker_id=worker_id,
+        max_attempts=PIPELINE_MAX_ATTEMPTS,
+        backoff_base_s=PIPELINE_BACKOFF_BASE_S,
+        backoff_max_s=PIPELINE_BACKOFF_MAX_S,
+        claim_timeout_s=PIPELINE_CLAIM_TIMEOUT_S,
+    )
+
+
+def drain_queue(
+    engine,
+    queue: PipelineQueue,
+    claim_size: int = PIPELINE_CLAIM_SIZE,
+    client=None,
+    cache: EnrichmentCache | None = None,
+    **kwargs,
+) -> int:
+    """
+    Reclama ed elabora claim_size item alla volta finché la coda non ha più item pronti.
+    Può girare in più processi (o pod) contemporaneamente sulla stessa coda: il claim garantisce
+    che ogni item sia elaborato da un solo worker.
+    """
+    client = client or get_openai_client()
+    if cache is None:
+        cache = create_enrichment_cache(engine)
+    total_inserted = 0
     
-    for i in range(0, len(job_postings), batch_size):
-        batch = job_postings[i:i + batch_size]
-        batch_num = (i // batch_size) + 1
-        total_batches = (len(job_postings) + batch_size - 1) // batch_size
-        
-        print(f"Inserendo batch {batch_num}/{total_batches} ({len(batch)} job postings)...")
-        
-        session.add_all(batch)
-        session.commit()
+    while True:
+        claimed = queue.claim(claim_size)
+        if not claimed:
+            break
+        with Session(engine) as session:
+            job_postings = []
+            for i in range(0, len(claimed), diff_engine.CHUNK_SIZE):
+                statement = select(JobPostingPre).where(
+                    JobPostingPre.partner_job_id.in_(claimed[i:i + diff_engine.CHUNK_SIZE])
+                )
+                job_postings.extend(session.exec(statement).all())
+        # Record rimossi da job_posting_pre dopo l'accodamento
+        queue.forget(set(claimed) - {job_pre.partner_job_id for job_pre in job_postings})
+        total_inserted += process_and_insert_incremental(
+            engine, job_postings, client=client, cache=cache, queue=queue, **kwargs
+        )
+    return total_inserted
+
+
+def report_untracked(engine) -> int:
+    """
+    Segnala i record di job_posting_pre senza partner_job_id: senza chiave non si può sapere se sono già
+    pubblicati (verrebbero arricchiti e inseriti di nuovo a ogni esecuzione), quindi vengono saltati.
+    """
+    with Session(engine) as session:
+        untracked = diff_engine.count_untracked(session)
+    if untracked:
+        print(f"  ⚠️  {untracked} record di job_posting_pre senza partner_job_id saltati.")
+    return untracked
+
+
+def process_queue(
+    engine,
+    queue: PipelineQueue,
+    claim_size: int = PIPELINE_CLAIM_SIZE,
+    client=None,
+    cache: EnrichmentCache | None = None,
+    **kwargs,
+) -> int:
+    """
+    Processa i nuovi record tramite la coda persistente pipeline_jobs: accoda i partner_job_id nuovi,
+    recupera gli item rimasti in lavorazione da un'esecuzione interrotta e poi li elabora in un solo processo.
+    I record falliti il cui backoff non è ancora scaduto restano in coda per l'esecuzione successiva.
+    """
+    queued = queue.sync()
+    recovered = queue.recover()
+    print(f"🗂️  Coda pipeline: {queued} record accodati, {recovered} ripresi da un'esecuzione interrotta.")
+    
+    client = client or get_openai_client()
+    if cache is None:
+        cache = create_enrichment_cache(engine)
+    total_inserted = drain_queue(engine, queue, claim_size, client=client, cache=cache, **kwargs)
+    report_untracked(engine)
+    
+    queue.print_summary()
+    return total_inserted
+
+
+def run_worker(worker_id: str, claim_size: int = PIPELINE_CLAIM_SIZE, **kwargs) -> int:
+    """
+    Entry point di un worker (processo locale avviato dal coordinatore o pod con --role worker):
+    riprende gli item lasciati in enriching da una sua esecuzione precedente e svuota la coda.
+    """
+    engine = create_database_engine()
+    queue = create_pipeline_queue(engine, worker_id)
+    recovered = queue.recover()
+    print(f"👷 Worker {worker_id} avviato ({recovered} item ripresi).")
+    inserted = drain_queue(engine, queue, claim_size, **kwargs)
+    print(f"👷 Worker {worker_id} terminato: {inserted} record scritti.")
+    return inserted
+
+
+def print_queue_progress(queue: PipelineQueue, done_at_start: int, started_at: float) -> int:
+    """Stampa l'avanzamento aggregato di tutti i worker e restituisce i record completati in questa esecuzione."""
+    counts = queue.counts()
+    done = counts["done"] - done_at_start
+    elapsed = time.monotonic() - started_at
+    rate = done / elapsed * 60 if elapsed > 0 else 0.0
+    workers = ", ".join(f"{worker}: {count}" for worker, count in sorted(queue.done_by_worker().items()))
+    print(
+        f"  📊 Coda: {done} completati ({rate:.1f}/min) | {counts['pending']} pending, "
+        f"{counts['enriching']} enriching, {counts['failed']} failed | done per worker: {workers or '-'}"
+    )
+    return done
+
+
+def coordinate_workers(
+    engine,
+    queue: PipelineQueue,
+    workers: int,
+    claim_size: int = PIPELINE_CLAIM_SIZE,
+    interval_s: float = PIPELINE_PROGRESS_INTERVAL_S,
+    sleep=time.sleep,
+) -> int:
+    """
+    Coordinatore: accoda i nuovi record, avvia workers processi worker locali (0 = i worker girano altrove,
+    ad es. in altri pod con --role worker) e stampa l'avanzamento aggregato finché la coda non è vuota.
+    I limiti OPENAI_MAX_RPM / OPENAI_MAX_TPM sono suddivisi tra i worker locali.
+    Restituisce i record completati in questa esecuzione.
+    """
+    queued = queue.sync()
+    recovered = queue.recover()
+    print(f"🗂️  Coda pipeline: {queued} record accodati, {recovered} ripresi da worker non più attivi.")
+    done_at_start = queue.counts()["done"]
+    started_at = time.monotonic()
+    
+    # Quota dei limiti di rate per worker (0 resta "nessun limite")
+    share = lambda limit: max(1, limit // workers) if limit else 0
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(f"{queue.worker_id}-{i}", claim_size),
+            kwargs={"max_rpm": share(OPENAI_MAX_RPM), "max_tpm": share(OPENAI_MAX_TPM)},
+            name=f"enrichment-worker-{i}",
+        )
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    
+    def running() -> bool:
+        if processes:
+            return any(process.is_alive() for process in processes)
+        return queue.remaining() > 0
+    
+    try:
+        while running():
+            print_queue_progress(queue, done_at_start, started_at)
+            sleep(interval_s)
+    finally:
+        for process in processes:
+            process.join()
+    
+    for process in processes:
+        if process.exitcode:
+            print(f"  ⚠️  {process.name} terminato con codice {process.exitcode}.")
+    done = print_queue_progress(queue, done_at_start, started_at)
+    report_untracked(engine)
+    queue.print_summary()
+    return done
+
+
+def _insert_enriched_bulk(
+    engine, enriched: List[tuple], queue: PipelineQueue | None = None, chunk_size: int = WRITER_BATCH_SIZE
+) -> int:
+    """
+    Scrive in blocco le coppie (job_data, descrizione migliorata) con un upsert, un commit ogni chunk_size record.
+    I partner_job_id già presenti in job_postings vengono aggiornati, così un import ripetuto è idempotente.
+    Con queue gli item vengono segnati done nella transazione che li scrive (failed se la scrittura fallisce).
+    """
+    before_commit = None
+    if queue is not None:
+        before_commit = lambda session, batch: queue.mark_done(
+            session, [posting.partner_job_id for posting in batch if posting.partner_job_id]
+        )
+    with BatchWriter(engine, max_rows=chunk_size, max_interval_s=float("inf"), before_commit=before_commit) as writer:
+        for job_data, improved in enriched:
+            writer.add(build_job_posting(job_data, improved))
+    if queue is not None:
+        for posting, error in writer.failed:
+            if posting.partner_job_id:
+                queue.mark_failed(posting.partner_job_id, error)
+    return writer.written
+
+
+def batch_custom_id(job_data: dict) -> str:
+    """
+    custom_id di una richiesta della Batch API: partner_job_id e impronta della descrizione inviata.
+    job_posting_pre viene rigenerato durante le fino a 24h di un batch, quindi al momento dell'import
+    il risultato vale solo se il record ha ancora la stessa descrizione.
+    """
+    return f"{job_data['partner_job_id']}|{diff_engine.description_fingerprint(job_data['job_description'])}"
+
+
+def _load_job_data_by_partner_ids(engine, partner_job_ids: List[str]) -> dict:
+    """Rilegge da job_posting_pre i record indicati, a blocchi di 500: partner_job_id -> job_data."""
+    partner_job_ids = sorted(partner_job_ids)
+    jobs_data = {}
+    with Session(engine) as session:
+        for i in range(0, len(partner_job_ids), 500):
+            statement = select(JobPostingPre).where(JobPostingPre.partner_job_id.in_(partner_job_ids[i:i + 500]))
+            for job_pre in session.exec(statement):
+                jobs_data[job_pre.partner_job_id] = _extract_job_data(job_pre)
+    return jobs_data
+
+
+def _load_job_data_for_results(engine, custom_ids: List[str]) -> dict:
+    """
+    Rilegge da job_posting_pre i record dei risultati di un batch, per custom_id.
+    Sono restituiti solo i record ancora presenti con la stessa descrizione inviata: gli altri (rimossi,
+    modificati o custom_id in formato non riconosciuto) vengono scartati e ripresi dalla coda.
+    """
+    partner_job_ids = {custom_id.rpartition("|")[0] for custom_id in custom_ids if "|" in custom_id}
+    wanted = set(custom_ids)
+    jobs_data = {}
+    for job_data in _load_job_data_by_partner_ids(engine, list(partner_job_ids)).values():
+        custom_id = batch_custom_id(job_data)
+        if custom_id in wanted:
+            jobs_data[custom_id] = job_data
+    return jobs_data
+
+
+def _submit_bulk(engine, queue: PipelineQueue, client, cache: EnrichmentCache, max_requests_per_batch: int) -> int:
+    """
+    Reclama dalla coda blocchi di max_requests_per_batch item e invia un batch OpenAI per ciascuno:
+    in memoria resta un solo blocco di record alla volta. I record senza descrizione o già in cache
+    vengono scritti subito. Restituisce i record scritti senza chiamate OpenAI.
+    """
+    inserted = 0
+    while True:
+        claimed = queue.claim(max_requests_per_batch)
+        if not claimed:
+            return inserted
+        jobs_data = _load_job_data_by_partner_ids(engine, claimed)
+        queue.forget(set(claimed) - set(jobs_data))
+        ready = []
+        to_submit = []
+        for job_data in jobs_data.values():
+            description = job_data['job_description']
+            if not description:
+                ready.append((job_data, None))
+                continue
+            cached = cache.get(description)
+            if cached is not None:
+                ready.append((job_data, cached))
+            else:
+                to_submit.append(job_data)
         
-        print(f"Batch {batch_num}/{total_batches} inserito con successo.")
+        # I record senza descrizione o già in cache non richiedono chiamate
+        if ready:
+            written = _insert_enriched_bulk(engine, ready, queue)
+            inserted += written
+            print(f"  ✅ Inseriti {written} record senza chiamate OpenAI (cache o descrizione vuota).")
+        if to_submit:
+            payload = build_batch_file(
+                (batch_custom_id(job_data), build_openai_request(job_data['job_description'])) for job_data in to_submit
+            )
+            batch_id = submit_batch(client, payload, metadata={"source": "improve_job_descriptions"})
+            queue.assign_batch([job_data['partner_job_id'] for job_data in to_submit], batch_id)
+            print(f"  📤 Inviato batch {batch_id} con {len(to_submit)} richieste.")
+
+
+def _ingest_bulk(
+    engine, queue: PipelineQueue, client, cache: EnrichmentCache, batch_id: str, poll_interval_s: float, sleep
+) -> int:
+    """
+    Attende un batch OpenAI e ne importa i risultati ancora validi; gli item del batch senza risultato
+    (errore, record cambiato o rimosso) vengono segnati failed, o pubblicati con la descrizione originale
+    se erano all'ultimo tentativo. Restituisce i record inseriti.
+    """
+    items = queue.batch_items(batch_id)
+    batch = wait_for_batch(client, batch_id, poll_interval_s=poll_interval_s, sleep=sleep)
+    results, errors = fetch_batch_results(client, batch)
+    
+    jobs_data = _load_job_data_for_results(engine, list(results))
+    enriched = []
+    for custom_id, improved in results.items():
+        job_data = jobs_data.get(custom_id)
+        if job_data is None or job_data['partner_job_id'] not in items:
+            # Annuncio rimosso o con la descrizione cambiata durante il batch
+            continue
+        cache.put(job_data['job_description'], improved)
+        enriched.append((job_data, improved))
+    inserted = _insert_enriched_bulk(engine, enriched, queue)
+    
+    errors_by_partner = {custom_id.rpartition("|")[0]: error for custom_id, error in errors.items()}
+    unresolved = set(items) - {job_data['partner_job_id'] for job_data, _ in enriched}
+    last_attempts = [partner_job_id for partner_job_id in unresolved if queue.is_last_attempt(partner_job_id)]
+    for partner_job_id in unresolved.difference(last_attempts):
+        queue.mark_failed(
+            partner_job_id, errors_by_partner.get(partner_job_id, f"Nessun risultato valido nel batch {batch_id}")
+        )
+    if last_attempts:
+        # Tentativi esauriti: pubblica la descrizione originale come nella modalità incrementale
+        originals = _load_job_data_by_partner_ids(engine, last_attempts)
+        queue.forget(set(last_attempts) - set(originals))
+        inserted += _insert_enriched_bulk(
+            engine, [(job_data, job_data['job_description']) for job_data in originals.values()], queue
+        )
     
-    print(f"Tutti i {len(job_postings)} job postings sono stati inseriti con successo.")
+    print(
+        f"  ✅ Batch {batch_id} ({batch.status}): {inserted} inseriti, "
+        f"{len(results) - len(enriched)} scartati (record cambiati), {len(errors)} errori."
+    )
+    for custom_id, error in list(errors.items())[:5]:
+        print(f"     - {custom_id}: {error}")
+    return inserted
+
+
+def process_bulk(
+    engine,
+    queue: PipelineQueue,
+    client=None,
+    cache: EnrichmentCache | None = None,
+    max_requests_per_batch: int = BATCH_MAX_REQUESTS,
+    poll_interval_s: float = BATCH_POLL_INTERVAL_S,
+    sleep=time.sleep,
+) -> int:
+    """
+    Modalità bulk: invia le job descriptions da migliorare alla Batch API di OpenAI, attende i risultati
+    e li inserisce in blocco in job_postings. Pensata per i rebuild completi, dove il throughput conta più della latenza.
+    Gli item vengono reclamati dalla coda pipeline_jobs e restano in enriching con il batch_id del loro batch:
+    se il processo (o il pod) si interrompe, la successiva esecuzione riprende il polling e l'import di quei
+    batch invece di inviarne di nuovi.
+    """
+    client = client or get_openai_client()
+    if cache is None:
+        cache = create_enrichment_cache(engine)
+    total_inserted = 0
+    
+    pending = queue.pending_batches()
+    if pending:
+        print(f"🔁 Ripresa di {len(pending)} batch in corso (nessun nuovo invio).")
+    else:
+        queued = queue.sync()
+        recovered = queue.recover()
+        print(f"🗂️  Coda pipeline: {queued} record accodati, {recovered} ripresi da un'esecuzione interrotta.")
+        total_inserted += _submit_bulk(engine, queue, client, cache, max_requests_per_batch)
+    
+    for batch_id in queue.pending_batches():
+        total_inserted += _ingest_bulk(engine, queue, client, cache, batch_id, poll_interval_s, sleep)
+    
+    # I record falliti verranno ripresi dalla coda alla prossima esecuzione
+    report_untracked(engine)
+    cache.flush()
+    cache.print_summary()
+    queue.print_summary()
+    print(f"\n📊 Modalità bulk: inseriti {total_inserted} record.")
+    return total_inserted
 
 
 def verify_all_processed(engine):
@@ -461,46 +985,110 @@ def verify_all_processed(engine):
     print("=" * 60)
     
     with Session(engine) as session:
-        # Ottieni tutti i partner_job_id da job_posting_pre (escludendo null)
-        pre_partner_ids = set()
-        pre_records = session.exec(select(JobPostingPre)).all()
-        for pre in pre_records:
-            if pre.partner_job_id:
-                pre_partner_ids.add(pre.partner_job_id)
-        
-        # Ottieni tutti i partner_job_id da job_postings (escludendo null)
-        postings_partner_ids = set()
-        postings_records = session.exec(select(JobPostings)).all()
-        for posting in postings_records:
-            if posting.partner_job_id:
-                postings_partner_ids.add(posting.partner_job_id)
-        
-        # Trova i partner_job_id mancanti
-        missing_partner_ids = pre_partner_ids - postings_partner_ids
+        # Conteggi e anti-join calcolati dal database
+        pre_records_count = diff_engine.count_rows(session, JobPostingPre)
+        postings_records_count = diff_engine.count_rows(session, JobPostings)
+        pre_partner_count = diff_engine.count_distinct_partner_ids(session, JobPostingPre)
+        postings_partner_count = diff_engine.count_distinct_partner_ids(session, JobPostings)
+        missing_count = diff_engine.count_missing(session)
         
         # Statistiche
         print(f"\n📊 Statistiche:")
-        print(f"  - Totali record in job_posting_pre: {len(pre_records)}")
-        print(f"  - Totali record in job_postings: {len(postings_records)}")
-        print(f"  - Partner_job_id unici in job_posting_pre: {len(pre_partner_ids)}")
-        print(f"  - Partner_job_id unici in job_postings: {len(postings_partner_ids)}")
-        print(f"  - Partner_job_id mancanti: {len(missing_partner_ids)}")
+        print(f"  - Totali record in job_posting_pre: {pre_records_count}")
+        print(f"  - Totali record in job_postings: {postings_records_count}")
+        print(f"  - Partner_job_id unici in job_posting_pre: {pre_partner_count}")
+        print(f"  - Partner_job_id unici in job_postings: {postings_partner_count}")
+        print(f"  - Partner_job_id mancanti: {missing_count}")
         
-        if missing_partner_ids:
-            print(f"\n⚠️  ATTENZIONE: {len(missing_partner_ids)} record non sono stati processati!")
+        if missing_count:
+            print(f"\n⚠️  ATTENZIONE: {missing_count} record non sono stati processati!")
             print(f"   Partner_job_id mancanti (primi 10):")
-            for i, partner_id in enumerate(list(missing_partner_ids)[:10], 1):
+            for i, partner_id in enumerate(diff_engine.sample_missing(session, 10), 1):
                 print(f"     {i}. {partner_id}")
-            if len(missing_partner_ids) > 10:
-                print(f"     ... e altri {len(missing_partner_ids) - 10}")
+            if missing_count > 10:
+                print(f"     ... e altri {missing_count - 10}")
             return False
         else:
             print(f"\n✅ VERIFICA COMPLETATA: Tutti i partner_job_id sono presenti in job_postings!")
             return True
 
 
-def main():
+def build_run_metrics(
+    records: dict,
+    duration_s: float,
+    queue_counts: dict | None = None,
+    all_processed: bool | None = None,
+) -> Registry:
+    """Metriche dell'esecuzione in formato Prometheus: record per esito, durata, stato della coda e latenze OpenAI."""
+    registry = Registry()
+    records_gauge = Gauge("enrichment_run_records", "Record gestiti nell'ultima esecuzione, per esito", ["outcome"], registry=registry)
+    for outcome, count in records.items():
+        records_gauge.labels(outcome).set(count)
+    Gauge("enrichment_run_duration_seconds", "Durata dell'ultima esecuzione", registry=registry).set(duration_s)
+    Gauge("enrichment_last_run_timestamp_seconds", "Fine dell'ultima esecuzione (epoch)", registry=registry).set(time.time())
+    if all_processed is not None:
+        Gauge(
+            "enrichment_all_processed", "1 se tutti i partner_job_id risultano processati", registry=registry
+        ).set(1 if all_processed else 0)
+    if queue_counts is not None:
+        jobs = Gauge("pipeline_jobs", "Item della coda pipeline_jobs per stato", ["status"], registry=registry)
+        for status, count in queue_counts.items():
+            jobs.labels(status).set(count)
+    calls = Histogram(
+        "enrichment_openai_call_seconds", "Durata delle chiamate OpenAI per fase", ["phase"], registry=registry
+    )
+    phases = {phase: calls.labels(phase) for phase in ("connect", "wait", "total")}
+    for call in latency_recorder.calls:
+        phases["connect"].observe(call.connect_s)
+        phases["wait"].observe(call.wait_s)
+        phases["total"].observe(call.total_s)
+    return registry
+
+
+def export_run_metrics(build_registry, grouping: dict | None = None) -> None:
+    """
+    Esporta le metriche dell'esecuzione (textfile per node_exporter e/o Pushgateway, vedi METRICS_TEXTFILE_PATH
+    e METRICS_PUSHGATEWAY_URL). build_registry viene chiamata solo se l'export è configurato;
+    un errore di export non fa fallire lo script.
+    """
+    if not export_enabled():
+        return
+    try:
+        export_metrics(build_registry(), "improve_job_descriptions", grouping)
+        print("📈 Metriche dell'esecuzione esportate.")
+    except Exception as e:
+        print(f"⚠️  Export delle metriche non riuscito: {e}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Migliora le job descriptions con OpenAI e le copia in job_postings.")
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Usa la Batch API di OpenAI (rebuild completi: più throughput, più latenza; riprende i batch in corso)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=PIPELINE_WORKERS,
+        help="Processi worker locali che si dividono la coda (default: PIPELINE_WORKERS o 1)",
+    )
+    parser.add_argument(
+        "--role",
+        choices=("all", "coordinator", "worker"),
+        default="all",
+        help=(
+            "all: esecuzione completa; coordinator: rimozione scaduti, accodamento e report di avanzamento "
+            "(i worker girano altrove); worker: solo elaborazione della coda (per più pod)"
+        ),
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     """Funzione principale."""
+    args = parse_args(argv)
+    started_at = time.monotonic()
     print("=" * 60)
     print("Script di miglioramento job descriptions")
     print("=" * 60)
@@ -512,6 +1100,15 @@ def main():
         raise ValueError("DATABASE_URL non trovata nel file .env")
     
     try:
+        if args.role == "worker":
+            worker_id = PIPELINE_WORKER_ID or default_worker_id()
+            inserted = run_worker(worker_id)
+            export_run_metrics(
+                lambda: build_run_metrics({"processed": inserted}, time.monotonic() - started_at),
+                grouping={"worker": worker_id},
+            )
+            return
+        
         # Crea engine e sessione
         engine = create_database_engine()
         
@@ -519,44 +1116,52 @@ def main():
             # 1. Rimuovi gli annunci scaduti (presenti in job_postings ma non in job_posting_pre)
             expired_count = remove_expired_job_postings(session)
             
-            # 2. Identifica i nuovi record da processare
-            # (solo quelli presenti in job_posting_pre ma non in job_postings)
-            new_job_postings = get_new_job_postings_to_process(session)
-            new_records_count = len(new_job_postings)
-            
-            if not new_job_postings:
-                print("Nessun nuovo record da processare.")
-                # Esegui comunque la verifica finale
-                all_processed = verify_all_processed(engine)
-                if all_processed:
-                    print("\n✅ Tutti i record sono già stati processati correttamente.")
-                
-                # Mostra riepilogo finale
-                print("\n" + "=" * 60)
-                print("RIEPILOGO FINALE")
-                print("=" * 60)
-                print(f"  📊 Record scaduti eliminati: {expired_count}")
-                print(f"  📊 Nuovi record trovati: {new_records_count}")
-                print(f"  📊 Nuovi record processati: 0")
-                print("=" * 60)
-                return
+            # 2. Classifica i record per impronta del contenuto e applica le modifiche ai soli metadati
+            changes = detect_changes(session)
+            metadata_count = apply_metadata_changes(engine)
             
-            # 3. Processa e inserisci solo i nuovi record
-            # Passa engine invece di session per creare nuove sessioni per ogni batch
-            processed_count = process_and_insert_incremental(engine, new_job_postings, batch_size=20)
+            # 3. Identifica i record da arricchire
+            # (presenti in job_posting_pre ma non in job_postings, o con la descrizione cambiata)
+            new_records_count = changes.new + changes.changed
+            print(f"\n🚀 Record da arricchire: {new_records_count}")
         
-        # 4. Verifica finale che tutti i partner_job_id siano stati processati
+        # 4. Processa e inserisci solo i nuovi record
+        # Passa engine invece di session per creare nuove sessioni per ogni batch
+        if args.bulk:
+            # Anche senza nuovi record possono esserci batch inviati da un'esecuzione interrotta
+            processed_count = process_bulk(engine, create_pipeline_queue(engine))
+        elif args.role == "coordinator" or args.workers > 1:
+            workers = 0 if args.role == "coordinator" else args.workers
+            processed_count = coordinate_workers(engine, create_pipeline_queue(engine), workers)
+        else:
+            # Anche senza nuovi record la coda può contenere item falliti da ritentare
+            processed_count = process_queue(engine, create_pipeline_queue(engine), batch_size=20)
+        
+        # 5. Verifica finale che tutti i partner_job_id siano stati processati
         all_processed = verify_all_processed(engine)
         
-        # 5. Mostra riepilogo finale
+        # 6. Mostra riepilogo finale
         print("\n" + "=" * 60)
         print("RIEPILOGO FINALE")
         print("=" * 60)
         print(f"  📊 Record scaduti eliminati: {expired_count}")
+        print(f"  📊 Record aggiornati senza OpenAI (solo metadati): {metadata_count}")
         print(f"  📊 Nuovi record trovati: {new_records_count}")
         print(f"  📊 Nuovi record processati: {processed_count}")
         print("=" * 60)
         
+        export_run_metrics(lambda: build_run_metrics(
+            {
+                "expired": expired_count,
+                "metadata_updated": metadata_count,
+                "new": new_records_count,
+                "processed": processed_count,
+            },
+            time.monotonic() - started_at,
+            queue_counts=create_pipeline_queue(engine).counts(),
+            all_processed=all_processed,
+        ))
+        
         if all_processed:
             print("\n✅ Script completato con successo! Tutti i record sono stati processati.")
         else:
@@ -8,7 +8,7 @@ import sys
 import time
 from pathlib import Path
 from dotenv import load_dotenv
-from sqlmodel import Session, select, create_engine
+from sqlmodel import Session, select, create_engine, func
 
 # Aggiungi il path del progetto per gli import
 project_root = Path(__file__).parent.parent
@@ -60,10 +60,10 @@ def monitor_progress():
         while True:
             with Session(engine) as session:
                 # Conta record in job_posting_pre (totali da processare)
-                total_to_process = len(session.exec(select(JobPostingPre)).all())
+                total_to_process = session.exec(select(func.count()).select_from(JobPostingPre)).one()
                 
                 # Conta record in job_postings (già processati)
-                processed_count = len(session.exec(select(JobPostings)).all())
+                processed_count = session.exec(select(func.count()).select_from(JobPostings)).one()
                 
                 # Calcola percentuale
                 if total_to_process > 0:
@@ -0,0 +1,132 @@
+"""
+Client OpenAI condiviso per la pipeline di arricchimento.
+Un solo client (e quindi un solo pool di connessioni httpx con keep-alive) viene creato per
+esecuzione e iniettato nelle chiamate, evitando un handshake TCP/TLS per ogni annuncio.
+LatencyRecorder misura per ogni chiamata il tempo di connessione, di attesa della risposta e totale.
+"""
+
+from __future__ import annotations
+
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+import httpx
+
+
+class CallTimings(NamedTuple):
+    """Tempi di una chiamata in secondi: connect (TCP + TLS, 0 se la connessione è riusata), wait (attesa degli header di risposta), total."""
+    connect_s: float
+    wait_s: float
+    total_s: float
+
+
+class LatencyRecorder:
+    """
+    Raccoglie i tempi delle chiamate HTTP usando le trace extension di httpcore.
+    Le chiamate del client sincrono avvengono nel thread chiamante, quindi lo stato per chiamata è thread-local.
+    """
+
+    _CONNECT_EVENTS = ("connection.connect_tcp", "connection.start_tls")
+    _WAIT_EVENTS = ("http11.receive_response_headers", "http2.receive_response_headers")
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.calls: List[CallTimings] = []
+
+    def on_request(self, request: httpx.Request) -> None:
+        """Event hook httpx: aggancia il tracer alla richiesta."""
+        request.extensions["trace"] = self._trace
+
+    def _trace(self, event_name: str, info: Dict[str, Any]) -> None:
+        timings = getattr(self._local, "timings", None)
+        if timings is None:
+            return
+        prefix, _, phase = event_name.rpartition(".")
+        if phase == "started":
+            self._local.started[prefix] = time.perf_counter()
+        elif phase in ("complete", "failed"):
+            started = self._local.started.pop(prefix, None)
+            if started is None:
+                return
+            elapsed = time.perf_counter() - started
+            if prefix in self._CONNECT_EVENTS:
+                timings["connect"] += elapsed
+            elif prefix in self._WAIT_EVENTS:
+                timings["wait"] += elapsed
+
+    @contextmanager
+    def measure(self) -> Iterator[None]:
+        """Misura una chiamata (eventuali retry inclusi) e la registra al termine."""
+        self._local.timings = {"connect": 0.0, "wait": 0.0}
+        self._local.started = {}
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings = self._local.timings
+            self._local.timings = None
+            call = CallTimings(timings["connect"], timings["wait"], time.perf_counter() - started)
+            with self._lock:
+                self.calls.append(call)
+
+    def summary(self) -> Dict[str, Any]:
+        """Statistiche aggregate in millisecondi."""
+        with self._lock:
+            calls = list(self.calls)
+        if not calls:
+            return {"calls": 0}
+
+        def _stats(values: List[float]) -> Dict[str, float]:
+            values = sorted(v * 1000 for v in values)
+            p95 = values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))]
+            return {"avg": statistics.fmean(values), "p50": statistics.median(values), "p95": p95}
+
+        return {
+            "calls": len(calls),
+            "new_connections": sum(1 for c in calls if c.connect_s > 0),
+            "connect_ms": _stats([c.connect_s for c in calls]),
+            "wait_ms": _stats([c.wait_s for c in calls]),
+            "total_ms": _stats([c.total_s for c in calls]),
+        }
+
+    def print_summary(self) -> None:
+        summary = self.summary()
+        if not summary["calls"]:
+            return
+        print(f"\n⏱️  Latenza chiamate OpenAI ({summary['calls']} chiamate, {summary['new_connections']} nuove connessioni):")
+        for key, label in (("connect_ms", "connect"), ("wait_ms", "wait"), ("total_ms", "total")):
+            stats = summary[key]
+            print(f"  - {label:<8} avg {stats['avg']:.0f} ms | p50 {stats['p50']:.0f} ms | p95 {stats['p95']:.0f} ms")
+
+
+def create_openai_client(
+    api_key: Optional[str],
+    max_connections: int = 16,
+    connect_timeout_s: float = 10.0,
+    read_timeout_s: float = 120.0,
+    keepalive_expiry_s: float = 60.0,
+    max_retries: int = 2,
+    base_url: Optional[str] = None,
+    recorder: Optional[LatencyRecorder] = None,
+):
+    """
+    Crea il client OpenAI da riusare per tutta l'esecuzione.
+    Il pool httpx tiene aperte fino a max_connections connessioni keep-alive (una per chiamata concorrente);
+    il read timeout è ampio perché le risposte vengono generate per intero prima di essere restituite.
+    """
+    from openai import OpenAI
+
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry_s,
+        ),
+        timeout=httpx.Timeout(read_timeout_s, connect=connect_timeout_s),
+        event_hooks={"request": [recorder.on_request]} if recorder is not None else None,
+    )
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=max_retries)
@@ -0,0 +1,317 @@
+"""
+Stato persistente della pipeline di arricchimento (tabella pipeline_jobs).
+Ogni partner_job_id da processare è un work item pending -> enriching -> done | failed:
+il worker lo reclama prima della chiamata OpenAI e lo segna done nella stessa transazione in cui
+scrive il record in job_postings, così un'esecuzione interrotta riparte esattamente da dove si era fermata.
+I record falliti vengono ritentati con backoff esponenziale fino a max_attempts tentativi.
+In modalità bulk gli item reclamati restano in enriching con il batch_id del batch OpenAI che li contiene,
+così un processo riavviato riprende il polling di quei batch invece di inviarli (e pagarli) di nuovo.
+"""
+
+from __future__ import annotations
+
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List
+
+from sqlalchemy import delete, insert, literal, or_, update
+from sqlmodel import Session, func, select
+
+from api.wrapping.models import JobPostingPre, PipelineJob, utc_now
+from scripts import diff_engine
+
+PENDING = "pending"
+ENRICHING = "enriching"
+DONE = "done"
+FAILED = "failed"
+STATUSES = (PENDING, ENRICHING, DONE, FAILED)
+
+
+def default_worker_id() -> str:
+    return socket.gethostname()
+
+
+def supports_skip_locked(dialect) -> bool:
+    """FOR UPDATE SKIP LOCKED è disponibile su PostgreSQL, MySQL >= 8.0.1 e MariaDB >= 10.6."""
+    if dialect.name == "postgresql":
+        return True
+    if dialect.name == "mysql":
+        version = dialect.server_version_info or ()
+        return version >= ((10, 6) if getattr(dialect, "is_mariadb", False) else (8, 0, 1))
+    return False
+
+
+class PipelineQueue:
+    """Coda di lavoro della pipeline sopra pipeline_jobs."""
+
+    def __init__(
+        self,
+        engine,
+        worker_id: str | None = None,
+        max_attempts: int = 5,
+        backoff_base_s: float = 60.0,
+        backoff_max_s: float = 3600.0,
+        claim_timeout_s: float = 900.0,
+        clock: Callable[[], datetime] = utc_now,
+    ):
+        self.engine = engine
+        self.worker_id = worker_id or default_worker_id()
+        self.max_attempts = max_attempts
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.claim_timeout_s = claim_timeout_s
+        self.clock = clock
+        # partner_job_id -> (tentativo corrente, istante del claim) dei record reclamati da questo worker
+        self._claimed: Dict[str, tuple] = {}
+
+    def sync(self) -> int:
+        """
+        Allinea la coda a job_posting_pre: accoda i partner_job_id nuovi o con la descrizione cambiata,
+        rimette in pending quelli già completati ma di nuovo da arricchire (ripubblicati dopo la scadenza o
+        con descrizione modificata) ed elimina gli item non più presenti in job_posting_pre.
+        Restituisce il numero di item accodati o riattivati.
+        """
+        now = self.clock()
+        queued = select(PipelineJob.partner_job_id).where(PipelineJob.partner_job_id == JobPostingPre.partner_job_id)
+        in_pre = select(JobPostingPre.id).where(JobPostingPre.partner_job_id == PipelineJob.partner_job_id)
+        to_enrich = in_pre.where(~diff_engine.up_to_date_condition())
+        with Session(self.engine) as session:
+            new_ids = (
+                select(
+                    JobPostingPre.partner_job_id,
+                    literal(PENDING),
+                    literal(0),
+                    literal(now),
+                    literal(now),
+                )
+                .where(JobPostingPre.partner_job_id.is_not(None))
+                .where(~diff_engine.up_to_date_condition())
+                .where(~queued.exists())
+                .distinct()
+            )
+            added = session.execute(
+                insert(PipelineJob).from_select(
+                    ["partner_job_id", "status", "attempts", "created_at", "updated_at"], new_ids
+                )
+            ).rowcount or 0
+            reset = session.execute(
+                update(PipelineJob)
+                .where(PipelineJob.status == DONE, to_enrich.exists())
+                .values(status=PENDING, attempts=0, last_error=None, next_attempt_at=None, updated_at=now)
+                .execution_options(synchronize_session=False)
+            ).rowcount or 0
+            session.execute(
+                delete(PipelineJob).where(~in_pre.exists()).execution_options(synchronize_session=False)
+            )
+            session.commit()
+        return added + reset
+
+    def recover(self) -> int:
+        """
+        Rimette in coda gli item rimasti in enriching: quelli di questo worker (esecuzione precedente
+        interrotta) subito, quelli degli altri worker dopo claim_timeout_s secondi senza aggiornamenti.
+        Gli item inviati in un batch OpenAI restano in enriching finché il batch non viene importato.
+        """
+        now = self.clock()
+        stale_before = now - timedelta(seconds=self.claim_timeout_s)
+        with Session(self.engine) as session:
+            recovered = session.execute(
+                update(PipelineJob)
+                .where(PipelineJob.status == ENRICHING, PipelineJob.batch_id.is_(None))
+                .where(or_(PipelineJob.worker_id == self.worker_id, PipelineJob.claimed_at < stale_before))
+                .values(status=PENDING, claim_token=None, updated_at=now)
+                .execution_options(synchronize_session=False)
+            ).rowcount or 0
+            session.commit()
+        return recovered
+
+    def _claimable(self, now: datetime):
+        return (
+            PipelineJob.status.in_((PENDING, FAILED))
+            & (PipelineJob.attempts < self.max_attempts)
+            & or_(PipelineJob.next_attempt_at.is_(None), PipelineJob.next_attempt_at <= now)
+        )
+
+    def claim_candidates_statement(self, now: datetime, limit: int, skip_locked: bool):
+        """
+        SELECT degli item pronti. Con skip_locked le righe vengono bloccate (FOR UPDATE SKIP LOCKED) fino al commit
+        del claim e i worker concorrenti saltano quelle già bloccate invece di attendere o reclamarle due volte.
+        """
+        statement = (
+            select(PipelineJob.partner_job_id)
+            .where(self._claimable(now))
+            .order_by(PipelineJob.attempts, PipelineJob.partner_job_id)
+            .limit(limit)
+        )
+        return statement.with_for_update(skip_locked=True) if skip_locked else statement
+
+    def claim(self, limit: int) -> List[str]:
+        """
+        Reclama fino a limit item pronti (pending o failed con backoff scaduto), portandoli in enriching.
+        Su PostgreSQL e MySQL 8 i candidati sono letti con SELECT ... FOR UPDATE SKIP LOCKED; su SQLite
+        (che serializza le scritture) basta l'UPDATE condizionato sullo stato: in entrambi i casi due worker
+        non possono reclamare lo stesso item.
+        """
+        now = self.clock()
+        token = uuid.uuid4().hex
+        with Session(self.engine) as session:
+            candidates = session.exec(
+                self.claim_candidates_statement(now, limit, supports_skip_locked(session.get_bind().dialect))
+            ).all()
+            if not candidates:
+                return []
+            session.execute(
+                update(PipelineJob)
+                .where(PipelineJob.partner_job_id.in_(candidates), self._claimable(now))
+                .values(
+                    status=ENRICHING,
+                    attempts=PipelineJob.attempts + 1,
+                    worker_id=self.worker_id,
+                    claim_token=token,
+                    claimed_at=now,
+                    updated_at=now,
+                )
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+            claimed = session.exec(
+                select(PipelineJob.partner_job_id, PipelineJob.attempts).where(PipelineJob.claim_token == token)
+            ).all()
+        for partner_job_id, attempts in claimed:
+            self._claimed[partner_job_id] = (attempts, now)
+        return [partner_job_id for partner_job_id, _ in claimed]
+
+    def is_last_attempt(self, partner_job_id: str) -> bool:
+        attempts, _ = self._claimed.get(partner_job_id, (0, None))
+        return attempts >= self.max_attempts
+
+    def _duration_ms(self, partner_job_id: str, now: datetime) -> int | None:
+        _, claimed_at = self._claimed.pop(partner_job_id, (0, None))
+        return int((now - claimed_at).total_seconds() * 1000) if claimed_at else None
+
+    def mark_done(self, session: Session, partner_job_ids: Iterable[str]) -> None:
+        """Segna done gli item indicati; va chiamato nella transazione che scrive i record in job_postings."""
+        now = self.clock()
+        for partner_job_id in partner_job_ids:
+            session.execute(
+                update(PipelineJob)
+                .where(PipelineJob.partner_job_id == partner_job_id)
+                .values(
+                    status=DONE,
+                    last_error=None,
+                    next_attempt_at=None,
+                    claim_token=None,
+                    batch_id=None,
+                    finished_at=now,
+                    duration_ms=self._duration_ms(partner_job_id, now),
+                    updated_at=now,
+                )
+                .execution_options(synchronize_session=False)
+            )
+
+    def backoff(self, attempts: int) -> timedelta:
+        return timedelta(seconds=min(self.backoff_base_s * 2 ** max(attempts - 1, 0), self.backoff_max_s))
+
+    def mark_failed(self, partner_job_id: str, error: Exception | str) -> None:
+        """Segna failed l'item e ne pianifica il prossimo tentativo con backoff esponenziale."""
+        now = self.clock()
+        attempts, _ = self._claimed.get(partner_job_id, (1, None))
+        with Session(self.engine) as session:
+            session.execute(
+                update(PipelineJob)
+                .where(PipelineJob.partner_job_id == partner_job_id)
+                .values(
+                    status=FAILED,
+                    last_error=str(error)[:2000],
+                    next_attempt_at=now + self.backoff(attempts),
+                    claim_token=None,
+                    batch_id=None,
+                    finished_at=now,
+                    duration_ms=self._duration_ms(partner_job_id, now),
+                    updated_at=now,
+                )
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+
+    def assign_batch(self, partner_job_ids: Iterable[str], batch_id: str) -> None:
+        """Registra il batch OpenAI in cui sono stati inviati gli item reclamati."""
+        partner_job_ids = list(partner_job_ids)
+        with Session(self.engine) as session:
+            for i in range(0, len(partner_job_ids), 500):
+                session.execute(
+                    update(PipelineJob)
+                    .where(PipelineJob.partner_job_id.in_(partner_job_ids[i:i + 500]))
+                    .values(batch_id=batch_id, updated_at=self.clock())
+                    .execution_options(synchronize_session=False)
+                )
+            session.commit()
+
+    def pending_batches(self) -> List[str]:
+        """Batch OpenAI con item ancora in enriching, cioè non ancora importati."""
+        with Session(self.engine) as session:
+            return list(session.exec(
+                select(PipelineJob.batch_id)
+                .where(PipelineJob.status == ENRICHING, PipelineJob.batch_id.is_not(None))
+                .distinct()
+                .order_by(PipelineJob.batch_id)
+            ).all())
+
+    def batch_items(self, batch_id: str) -> Dict[str, int]:
+        """
+        partner_job_id -> tentativi degli item ancora in enriching nel batch indicato. Gli item vengono
+        presi in carico da questo worker (anche dopo un riavvio) per mark_done, mark_failed e is_last_attempt.
+        """
+        with Session(self.engine) as session:
+            rows = session.exec(
+                select(PipelineJob.partner_job_id, PipelineJob.attempts, PipelineJob.claimed_at)
+                .where(PipelineJob.status == ENRICHING, PipelineJob.batch_id == batch_id)
+            ).all()
+        for partner_job_id, attempts, claimed_at in rows:
+            self._claimed.setdefault(partner_job_id, (attempts, claimed_at))
+        return {partner_job_id: attempts for partner_job_id, attempts, _ in rows}
+
+    def forget(self, partner_job_ids: Iterable[str]) -> None:
+        """Elimina gli item (ad es. record spariti da job_posting_pre durante l'esecuzione)."""
+        partner_job_ids = list(partner_job_ids)
+        if not partner_job_ids:
+            return
+        with Session(self.engine) as session:
+            session.execute(delete(PipelineJob).where(PipelineJob.partner_job_id.in_(partner_job_ids)))
+            session.commit()
+        for partner_job_id in partner_job_ids:
+            self._claimed.pop(partner_job_id, None)
+
+    def counts(self) -> Dict[str, int]:
+        with Session(self.engine) as session:
+            rows = session.exec(select(PipelineJob.status, func.count()).group_by(PipelineJob.status)).all()
+        counts = dict.fromkeys(STATUSES, 0)
+        counts.update(rows)
+        return counts
+
+    def remaining(self) -> int:
+        """Item ancora da completare in questa esecuzione: pronti per il claim o in lavorazione."""
+        now = self.clock()
+        with Session(self.engine) as session:
+            return session.exec(
+                select(func.count()).select_from(PipelineJob).where(
+                    or_(self._claimable(now), PipelineJob.status == ENRICHING)
+                )
+            ).one()
+
+    def done_by_worker(self) -> Dict[str, int]:
+        with Session(self.engine) as session:
+            rows = session.exec(
+                select(PipelineJob.worker_id, func.count())
+                .where(PipelineJob.status == DONE, PipelineJob.worker_id.is_not(None))
+                .group_by(PipelineJob.worker_id)
+            ).all()
+        return dict(rows)
+
+    def print_summary(self) -> None:
+        counts = self.counts()
+        print(
+            f"  🗂️  Coda pipeline: {counts[PENDING]} pending, {counts[ENRICHING]} enriching, "
+            f"{counts[DONE]} done, {counts[FAILED]} failed"
+        )
@@ -8,6 +8,7 @@ import os
 import sys
 from pathlib import Path
 from dotenv import load_dotenv
+from sqlalchemy import delete
 from sqlmodel import Session, select, create_engine, func
 from collections import defaultdict
 
@@ -16,6 +17,7 @@ project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
 from api.wrapping.models import JobPostings
+from api.wrapping.service import iter_all
 
 # Carica variabili d'ambiente
 env_path = project_root / ".env"
@@ -55,17 +57,18 @@ def find_and_remove_duplicates():
     print("=" * 60)
     
     with Session(engine) as session:
-        # Leggi tutti i record
-        all_postings = session.exec(select(JobPostings)).all()
-        
-        # Raggruppa per partner_job_id
+        # Leggi tutti i record a blocchi, conservando solo i campi necessari
+        # al confronto (senza description) per non caricare l'intera tabella
         grouped = defaultdict(list)
-        for posting in all_postings:
+        total_count = 0
+        for posting in iter_all(session, JobPostings):
+            total_count += 1
+            entry = (posting.id, posting.partner_job_id, posting.updated_at, posting.created_at)
             if posting.partner_job_id:
-                grouped[posting.partner_job_id].append(posting)
+                grouped[posting.partner_job_id].append(entry)
             else:
                 # Record senza partner_job_id li teniamo tutti (non possiamo deduplicare)
-                grouped[None].append(posting)
+                grouped[None].append(entry)
         
         # Trova duplicati
         duplicates_to_remove = []
@@ -80,7 +83,7 @@ def find_and_remove_duplicates():
             if len(postings_list) > 1:
                 # Ci sono duplicati, mantieni il più recente (basato su updated_at o id)
                 # Ordina per updated_at (più recente prima) o id (più grande = più recente)
-                postings_list.sort(key=lambda x: (x.updated_at or x.created_at or x.id or 0), reverse=True)
+                postings_list.sort(key=lambda x: (x[2] or x[3] or x[0] or 0), reverse=True)
                 
                 # Mantieni il primo (più recente)
                 kept = postings_list[0]
@@ -94,7 +97,7 @@ def find_and_remove_duplicates():
                 kept_count += 1
         
         print(f"\n📊 Analisi:")
-        print(f"  - Totali record in job_postings: {len(all_postings)}")
+        print(f"  - Totali record in job_postings: {total_count}")
         print(f"  - Record da mantenere: {kept_count}")
         print(f"  - Record duplicati da rimuovere: {len(duplicates_to_remove)}")
         
@@ -104,21 +107,22 @@ def find_and_remove_duplicates():
         
         # Mostra alcuni esempi
         print(f"\n📋 Esempi di duplicati da rimuovere (primi 5):")
-        for i, posting in enumerate(duplicates_to_remove[:5], 1):
-            print(f"  {i}. ID: {posting.id}, partner_job_id: {posting.partner_job_id}, updated_at: {posting.updated_at}")
+        for i, (posting_id, partner_id, updated_at, _) in enumerate(duplicates_to_remove[:5], 1):
+            print(f"  {i}. ID: {posting_id}, partner_job_id: {partner_id}, updated_at: {updated_at}")
         
         # Conferma e rimuovi
         print(f"\n🗑️  Rimuovendo {len(duplicates_to_remove)} record duplicati...")
         
-        for posting in duplicates_to_remove:
-            session.delete(posting)
+        ids_to_remove = [entry[0] for entry in duplicates_to_remove]
+        for i in range(0, len(ids_to_remove), 500):
+            session.execute(delete(JobPostings).where(JobPostings.id.in_(ids_to_remove[i:i + 500])))
         
         session.commit()
         
         print(f"✅ Rimossi {len(duplicates_to_remove)} record duplicati con successo!")
         
         # Verifica finale
-        remaining_count = len(session.exec(select(JobPostings)).all())
+        remaining_count = session.exec(select(func.count()).select_from(JobPostings)).one()
         print(f"\n📊 Verifica finale:")
         print(f"  - Record rimanenti in job_postings: {remaining_count}")
         print(f"  - Record attesi: {kept_count}")
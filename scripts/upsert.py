@@ -0,0 +1,141 @@
+"""
+Upsert in blocco su job_postings, idempotente grazie all'indice univoco su partner_job_id.
+Usa il costrutto nativo del dialetto: INSERT ... ON DUPLICATE KEY UPDATE su MySQL,
+INSERT ... ON CONFLICT DO UPDATE su PostgreSQL e SQLite.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import Callable, List, Tuple
+
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlmodel import Session
+
+from api.wrapping.models import JobPostings
+
+# Colonne mai sovrascritte quando il partner_job_id esiste già
+_PRESERVED_COLUMNS = {"id", "partner_job_id", "created_at"}
+
+_INSERT_BY_DIALECT = {
+    "mysql": mysql.insert,
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+def job_posting_row(job_posting: JobPostings) -> dict:
+    """Valori di un JobPostings come dict per l'INSERT multi-riga (senza id, assegnato dal database)."""
+    return {
+        column.name: getattr(job_posting, column.name)
+        for column in JobPostings.__table__.columns
+        if column.name != "id"
+    }
+
+
+def upsert_statement(dialect_name: str, rows: List[dict]):
+    """Costruisce l'INSERT multi-riga con la clausola di upsert del dialetto indicato."""
+    try:
+        insert = _INSERT_BY_DIALECT[dialect_name]
+    except KeyError:
+        raise ValueError(f"Upsert non supportato per il dialetto {dialect_name!r}") from None
+    
+    statement = insert(JobPostings).values(rows)
+    updated = [name for name in rows[0] if name not in _PRESERVED_COLUMNS]
+    if dialect_name == "mysql":
+        return statement.on_duplicate_key_update({name: statement.inserted[name] for name in updated})
+    return statement.on_conflict_do_update(
+        index_elements=[JobPostings.partner_job_id],
+        set_={name: statement.excluded[name] for name in updated},
+    )
+
+
+def upsert_job_postings(session: Session, job_postings: List[JobPostings], chunk_size: int = 200) -> int:
+    """
+    Scrive i job postings con un INSERT multi-riga ogni chunk_size record, aggiornando quelli con
+    partner_job_id già presente. Non esegue il commit; restituisce il numero di record scritti.
+    """
+    dialect_name = session.get_bind().dialect.name
+    written = 0
+    for i in range(0, len(job_postings), chunk_size):
+        rows = [job_posting_row(job_posting) for job_posting in job_postings[i:i + chunk_size]]
+        session.execute(upsert_statement(dialect_name, rows))
+        written += len(rows)
+    return written
+
+
+class BatchWriter:
+    """
+    Stage di scrittura single-thread: accumula i job postings e li scrive con un upsert multi-riga
+    quando il buffer raggiunge max_rows record o sono passati max_interval_s secondi dall'ultimo flush.
+    Il tempo viene controllato solo in add() e flush_if_due(): mentre non arrivano record il chiamante
+    deve invocare flush_if_due() periodicamente (vedi idle di enrich_concurrently).
+    Ogni flush è una transazione: dopo il commit i record sono durevoli anche se il processo si interrompe.
+    Se un blocco fallisce viene diviso a metà ricorsivamente, così solo i record invalidi vengono scartati.
+    before_commit(session, blocco), se presente, viene eseguito nella stessa transazione dell'upsert.
+    """
+
+    def __init__(
+        self,
+        engine,
+        max_rows: int = 200,
+        max_interval_s: float = 5.0,
+        clock=time.monotonic,
+        before_commit: Callable[[Session, List[JobPostings]], None] | None = None,
+    ):
+        self.engine = engine
+        self.before_commit = before_commit
+        self.max_rows = max_rows
+        self.max_interval_s = max_interval_s
+        self.clock = clock
+        self.written = 0
+        self.failed: List[Tuple[JobPostings, Exception]] = []
+        self.flushes = 0
+        self._buffer: List[JobPostings] = []
+        self._last_flush = clock()
+
+    def add(self, job_posting: JobPostings) -> None:
+        self._buffer.append(job_posting)
+        if len(self._buffer) >= self.max_rows:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self) -> None:
+        """Scrive il buffer se sono passati max_interval_s secondi dall'ultimo flush."""
+        if self._buffer and self.clock() - self._last_flush >= self.max_interval_s:
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = self.clock()
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        self._write(batch)
+        self.flushes += 1
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self) -> "BatchWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _write(self, batch: List[JobPostings]) -> None:
+        try:
+            with Session(self.engine) as session:
+                upsert_job_postings(session, batch, chunk_size=len(batch))
+                if self.before_commit is not None:
+                    self.before_commit(session, batch)
+                session.commit()
+            self.written += len(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self.failed.append((batch[0], e))
+                print(f"  ⚠️  Impossibile scrivere partner_job_id {batch[0].partner_job_id}: {e}")
+                return
+            middle = len(batch) // 2
+            self._write(batch[:middle])
+            self._write(batch[middle:])
@@ -0,0 +1,889 @@
+from __future__ import annotations
+
+import threading
+import time
+
+from scripts.enrichment import RateLimiter, enrich_concurrently
+
+
+def test_enrich_concurrently_ordered_results():
+    """Test ordered mode yields results in input order even when later items finish first."""
+    def enrich(i: int) -> int:
+        time.sleep(0.02 * (5 - i))
+        return i * 10
+
+    results = list(enrich_concurrently(range(5), enrich, concurrency=5, ordered=True))
+    assert results == [(i, i * 10) for i in range(5)]
+
+
+def test_enrich_concurrently_bounds_parallelism():
+    """Test exactly `concurrency` calls are in flight together, never more."""
+    lock = threading.Lock()
+    in_flight = 0
+    peak = 0
+    # Every call waits for three others: the run only completes if 4 calls overlap
+    together = threading.Barrier(4, timeout=5)
+
+    def enrich(i: int) -> int:
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        together.wait()
+        with lock:
+            in_flight -= 1
+        return i
+
+    results = list(enrich_concurrently(range(12), enrich, concurrency=4))
+
+    assert sorted(item for item, _ in results) == list(range(12))
+    assert peak == 4
+
+
+def test_rate_limiter_waits_for_request_and_token_budget():
+    """Test the token bucket blocks once requests or tokens per minute are exhausted."""
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds: float) -> None:
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=600, clock=lambda: now[0], sleep=sleep)
+    limiter.acquire(100)
+    limiter.acquire(100)
+    assert sleeps == []
+
+    # Request bucket empty: one request refills in 30s
+    limiter.acquire(100)
+    assert sleeps == [30.0]
+
+    # 450 tokens left and no request: waits for the slower of the two refills (30s request, 15s tokens)
+    sleeps.clear()
+    limiter.acquire(600)
+    assert sleeps == [30.0]
+
+
+def test_shared_openai_client_reuses_connection():
+    """Test the shared client keeps one keep-alive connection and records connect/wait/total timings."""
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    from scripts.openai_client import LatencyRecorder, create_openai_client
+
+    class _ChatHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            body = json.dumps({
+                "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": "gpt-4.1-mini",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": " improved "}}],
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ChatHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        recorder = LatencyRecorder()
+        client = create_openai_client("test", base_url=f"http://127.0.0.1:{server.server_port}/v1", recorder=recorder)
+        for _ in range(3):
+            with recorder.measure():
+                response = client.chat.completions.create(model="gpt-4.1-mini", messages=[{"role": "user", "content": "x"}])
+            assert response.choices[0].message.content == " improved "
+    finally:
+        server.shutdown()
+
+    summary = recorder.summary()
+    assert summary["calls"] == 3
+    assert summary["new_connections"] == 1
+    assert all(call.wait_s > 0 and call.total_s >= call.wait_s for call in recorder.calls)
+
+
+def _sqlite_engine(tmp_path):
+    """
+    File-backed engine: every pooled connection is its own SQLite connection, so transactions of the
+    enrichment threads stay isolated (a StaticPool would share one connection and its transaction).
+    """
+    from sqlalchemy import event
+    from sqlmodel import SQLModel, create_engine
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'main.db'}", connect_args={"check_same_thread": False, "timeout": 30})
+
+    @event.listens_for(engine, "connect")
+    def _attach_lw_schema(dbapi_connection, _):
+        dbapi_connection.execute(f"ATTACH DATABASE '{tmp_path / 'lw.db'}' AS lw")
+
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+
+def test_enrichment_cache_hit_miss_and_eviction(tmp_path):
+    """Test cache keys ignore whitespace, entries expire by TTL and prune keeps the most recently used."""
+    from datetime import timedelta
+    from sqlmodel import Session
+
+    from api.wrapping.models import EnrichmentCacheEntry, utc_now
+    from scripts.enrichment_cache import EnrichmentCache
+
+    engine = _sqlite_engine(tmp_path)
+    cache = EnrichmentCache(engine, prompt="p", model="m", ttl_days=1, max_entries=2, memory_entries=0)
+
+    assert cache.get("<p>Job A</p>") is None
+    cache.put("<p>Job A</p>", "improved A")
+    assert cache.get("  <p>Job A</p>\r\n") == "improved A"
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.hit_rate == 0.5
+
+    # Another prompt or model never shares entries
+    assert EnrichmentCache(engine, prompt="p2", model="m").get("<p>Job A</p>") is None
+
+    cache.put("Job B", "improved B")
+    cache.put("Job C", "improved C")
+    with Session(engine) as s:
+        stale = s.get(EnrichmentCacheEntry, cache.key_for("Job B"))
+        stale.last_used_at = utc_now() - timedelta(days=2)
+        s.add(stale)
+        s.commit()
+    assert cache.get("Job B") is None
+
+    assert cache.prune() == 1
+    cache.put("Job D", "improved D")
+    assert cache.prune() == 1
+    assert cache.get("<p>Job A</p>") is None
+    assert cache.get("Job C") == "improved C"
+    assert cache.get("Job D") == "improved D"
+
+
+def test_enrichment_cache_memory_hits_throttle_touches_and_respect_ttl(tmp_path):
+    """Test memory hits skip the database until the touch interval passes and expire with the TTL."""
+    from datetime import datetime, timedelta
+
+    from sqlalchemy import event
+    from sqlmodel import Session
+
+    from api.wrapping.models import EnrichmentCacheEntry
+    from scripts.enrichment_cache import EnrichmentCache
+
+    engine = _sqlite_engine(tmp_path)
+    updates = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _count_updates(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("UPDATE"):
+            updates.append(statement)
+
+    now = [datetime(2026, 1, 1)]
+    cache = EnrichmentCache(engine, prompt="p", model="m", ttl_days=1, touch_interval_s=3600, clock=lambda: now[0])
+    cache.put("Job A", "improved A")
+
+    for _ in range(3):
+        assert cache.get("Job A") == "improved A"
+    assert updates == []
+
+    # The touch interval elapsed: one UPDATE carries the pending hits
+    now[0] += timedelta(hours=2)
+    assert cache.get("Job A") == "improved A"
+    assert len(updates) == 1
+    with Session(engine) as s:
+        entry = s.get(EnrichmentCacheEntry, cache.key_for("Job A"))
+        assert (entry.last_used_at, entry.hits) == (now[0], 4)
+
+    assert cache.get("Job A") == "improved A"
+    assert cache.flush() == 1
+    assert cache.flush() == 0
+    with Session(engine) as s:
+        assert s.get(EnrichmentCacheEntry, cache.key_for("Job A")).hits == 5
+
+    # Expired in the table: the memory tier does not serve it either
+    now[0] += timedelta(days=2)
+    assert cache.get("Job A") is None
+    assert (cache.hits, cache.misses) == (5, 1)
+
+
+def test_improve_job_description_uses_cache_before_network(tmp_path):
+    """Test a cached description is returned without calling OpenAI and misses are stored."""
+    from scripts import improve_job_descriptions
+    from scripts.enrichment_cache import EnrichmentCache
+
+    class _Client:
+        calls = 0
+
+        class chat:
+            class completions:
+                @staticmethod
+                def create(**kwargs):
+                    _Client.calls += 1
+
+                    class _Message:
+                        content = "improved"
+
+                    class _Choice:
+                        message = _Message
+
+                    class _Response:
+                        choices = [_Choice]
+
+                    return _Response
+
+    cache = EnrichmentCache(_sqlite_engine(tmp_path), prompt="p", model="m")
+    for _ in range(3):
+        assert improve_job_descriptions.improve_job_description_with_openai("desc", client=_Client, cache=cache) == "improved"
+    assert _Client.calls == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+class _BatchStubHandler:
+    """Minimal OpenAI Files + Batches API: a batch completes on its second poll."""
+
+    def __init__(self):
+        self.files = {}
+        self.batches = {}
+        self.polls = {}
+
+    def handle(self, method, path, headers, body):
+        import json
+        import re
+
+        if method == "POST" and path == "/v1/files":
+            boundary = headers["Content-Type"].split("boundary=")[1].encode()
+            part = next(p for p in body.split(b"--" + boundary) if b"filename=" in p)
+            content = part.split(b"\r\n\r\n", 1)[1].rsplit(b"\r\n", 1)[0]
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = content
+            return {"id": file_id, "object": "file", "bytes": len(content), "created_at": 0,
+                    "filename": "batch.jsonl", "purpose": "batch", "status": "processed"}
+        if method == "POST" and path == "/v1/batches":
+            request = json.loads(body)
+            batch_id = f"batch-{len(self.batches) + 1}"
+            lines = [json.loads(line) for line in self.files[request["input_file_id"]].splitlines() if line]
+            output = "\n".join(json.dumps({
+                "custom_id": line["custom_id"],
+                "response": {"status_code": 200, "body": {"choices": [{"message": {
+                    "role": "assistant",
+                    "content": f" improved {line['body']['messages'][-1]['content'].rsplit(' ', 1)[-1]} "}}]}},
+            }) for line in lines)
+            self.files[f"out-{batch_id}"] = output.encode()
+            self.batches[batch_id] = {"id": batch_id, "object": "batch", "endpoint": request["endpoint"],
+                                      "input_file_id": request["input_file_id"], "completion_window": "24h",
+                                      "created_at": 0, "status": "in_progress",
+                                      "request_counts": {"total": len(lines), "completed": 0, "failed": 0}}
+            return self.batches[batch_id]
+        match = re.fullmatch(r"/v1/batches/([\w-]+)", path)
+        if method == "GET" and match:
+            batch = self.batches[match.group(1)]
+            self.polls[batch["id"]] = self.polls.get(batch["id"], 0) + 1
+            if self.polls[batch["id"]] >= 2:
+                batch.update(status="completed", output_file_id=f"out-{batch['id']}")
+                batch["request_counts"]["completed"] = batch["request_counts"]["total"]
+            return batch
+        match = re.fullmatch(r"/v1/files/([\w-]+)/content", path)
+        if method == "GET" and match:
+            return self.files[match.group(1)]
+        raise AssertionError(f"unexpected request {method} {path}")
+
+
+def _serve_stub(stub):
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _respond(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            result = stub.handle(self.command, self.path, self.headers, self.rfile.read(length))
+            body = result if isinstance(result, bytes) else json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = _respond
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_bulk_mode_against_stub_server_resumes_after_restart(tmp_path):
+    """Test bulk mode submits JSONL batches, resumes them from pipeline_jobs after a restart and ingests once."""
+    from sqlmodel import Session, select
+
+    from api.wrapping.models import JobPostingPre, JobPostings
+    from scripts import improve_job_descriptions, pipeline_state
+    from scripts.enrichment_cache import EnrichmentCache
+    from scripts.openai_client import create_openai_client
+
+    engine = _sqlite_engine(tmp_path)
+    with Session(engine) as s:
+        for i in range(1, 6):
+            s.add(JobPostingPre(id=i, position=f"Role {i}", partner_job_id=f"P{i}",
+                                job_description=f"desc {i}" if i != 5 else None))
+        s.commit()
+    cache = EnrichmentCache(engine, prompt="p", model="m")
+    cache.put("desc 4", "cached 4")
+
+    stub = _BatchStubHandler()
+    server = _serve_stub(stub)
+    try:
+        client = create_openai_client("test", base_url=f"http://127.0.0.1:{server.server_port}/v1")
+
+        class _Crash(Exception):
+            pass
+
+        def _crash(_seconds):
+            raise _Crash()
+
+        try:
+            improve_job_descriptions.process_bulk(
+                engine, pipeline_state.PipelineQueue(engine, worker_id="pod-1"), client=client, cache=cache,
+                max_requests_per_batch=2, sleep=_crash,
+            )
+        except _Crash:
+            pass
+        # Cached and empty descriptions were inserted, two batches are in flight and recorded in the database
+        assert len(stub.batches) == 2
+        assert pipeline_state.PipelineQueue(engine).pending_batches() == sorted(stub.batches)
+
+        # The replacement pod has another worker id and no local state
+        queue = pipeline_state.PipelineQueue(engine, worker_id="pod-2")
+        inserted = improve_job_descriptions.process_bulk(
+            engine, queue, client=client, cache=cache, sleep=lambda _: None,
+        )
+    finally:
+        server.shutdown()
+
+    assert inserted == 3
+    assert len(stub.batches) == 2
+    assert queue.pending_batches() == []
+    assert queue.counts() == {"pending": 0, "enriching": 0, "done": 5, "failed": 0}
+    with Session(engine) as s:
+        descriptions = {p.partner_job_id: p.description for p in s.exec(select(JobPostings)).all()}
+    assert descriptions == {
+        "P1": "improved 1", "P2": "improved 2", "P3": "improved 3", "P4": "cached 4", "P5": None,
+    }
+    assert cache.get("desc 1") == "improved 1"
+
+
+def test_bulk_mode_drops_results_of_changed_pre_rows(tmp_path):
+    """Test bulk ingest drops results whose pre row was removed or rewritten while the batch was running."""
+    from sqlmodel import Session, select
+
+    from api.wrapping.models import JobPostingPre, JobPostings
+    from scripts import improve_job_descriptions, pipeline_state
+    from scripts.enrichment_cache import EnrichmentCache
+    from scripts.openai_client import create_openai_client
+
+    engine = _sqlite_engine(tmp_path)
+    with Session(engine) as s:
+        for i in range(1, 4):
+            s.add(JobPostingPre(id=i, position=f"Role {i}", partner_job_id=f"P{i}", job_description=f"desc {i}"))
+        s.commit()
+    cache = EnrichmentCache(engine, prompt="p", model="m")
+    queue = pipeline_state.PipelineQueue(engine, worker_id="w1")
+
+    stub = _BatchStubHandler()
+    server = _serve_stub(stub)
+    try:
+        client = create_openai_client("test", base_url=f"http://127.0.0.1:{server.server_port}/v1")
+
+        class _Crash(Exception):
+            pass
+
+        def _crash(_seconds):
+            raise _Crash()
+
+        try:
+            improve_job_descriptions.process_bulk(engine, queue, client=client, cache=cache, sleep=_crash)
+        except _Crash:
+            pass
+
+        # The pre table is regenerated while the batch runs: P1 is gone (its id reused by P9), P2 was rewritten
+        with Session(engine) as s:
+            s.delete(s.get(JobPostingPre, 1))
+            s.get(JobPostingPre, 2).job_description = "desc 2 rewritten"
+            s.commit()
+            s.add(JobPostingPre(id=1, position="Other", partner_job_id="P9", job_description="desc 9"))
+            s.commit()
+
+        inserted = improve_job_descriptions.process_bulk(engine, queue, client=client, cache=cache, sleep=lambda _: None)
+    finally:
+        server.shutdown()
+
+    assert inserted == 1
+    with Session(engine) as s:
+        descriptions = {p.partner_job_id: p.description for p in s.exec(select(JobPostings)).all()}
+    assert descriptions == {"P3": "improved 3"}
+    assert cache.get("desc 1") is None
+    assert cache.get("desc 2") is None
+    # The dropped items are retried through the queue
+    assert queue.counts() == {"pending": 0, "enriching": 0, "done": 1, "failed": 2}
+
+
+def test_set_based_diff_new_expired_and_missing(tmp_path):
+    """Test the SQL anti-joins pick new pre rows, delete expired postings with tombstones, and verify."""
+    from datetime import datetime, timedelta, timezone
+    from sqlmodel import Session, select
+
+    from api.wrapping.models import JobPostingPre, JobPostings, JobPostingTombstone
+    from scripts import diff_engine
+    from scripts.improve_job_descriptions import (
+        get_new_job_postings_to_process,
+        remove_expired_job_postings,
+        verify_all_processed,
+    )
+
+    engine = _sqlite_engine(tmp_path)
+    with Session(engine) as s:
+        for i in range(1, 6):
+            s.add(JobPostingPre(id=i, position=f"Role {i}", partner_job_id=f"P{i}"))
+        s.add(JobPostingPre(id=6, position="No partner id"))
+        for i in (1, 2, 7, 8):
+            s.add(JobPostings(id=i, position=f"Role {i}", partner_job_id=f"P{i}"))
+        s.commit()
+
+    with Session(engine) as s:
+        assert diff_engine.count_new(s) == 3
+        assert diff_engine.count_untracked(s) == 1
+        assert diff_engine.count_missing(s) == 3
+        assert diff_engine.sample_missing(s) == ["P3", "P4", "P5"]
+        assert [p.id for p in get_new_job_postings_to_process(s)] == [3, 4, 5]
+
+        assert remove_expired_job_postings(s) == 2
+        assert sorted(s.exec(select(JobPostings.partner_job_id)).all()) == ["P1", "P2"]
+        tombstones = s.exec(select(JobPostingTombstone)).all()
+        assert sorted((t.partner_job_id, t.posting_id) for t in tombstones) == [("P7", 7), ("P8", 8)]
+        # Timestamps are naive UTC, as the feed serves them
+        utc = datetime.now(timezone.utc).replace(tzinfo=None)
+        assert all(abs(t.deleted_at - utc) < timedelta(minutes=1) for t in tombstones)
+        assert remove_expired_job_postings(s) == 0
+
+    assert verify_all_processed(engine) is False
+    with Session(engine) as s:
+        for i in (3, 4, 5):
+            s.add(JobPostings(position=f"Role {i}", partner_job_id=f"P{i}"))
+        s.commit()
+    assert verify_all_processed(engine) is True
+
+
+def test_remove_expired_skips_when_pre_is_empty(tmp_path):
+    """Test nothing is deleted when job_posting_pre is empty (e.g. a failed load)."""
+    from sqlmodel import Session
+
+    from api.wrapping.models import JobPostings
+    from scripts import diff_engine
+    from scripts.improve_job_descriptions import remove_expired_job_postings
+
+    engine = _sqlite_engine(tmp_path)
+    with Session(engine) as s:
+        s.add(JobPostings(position="Role", partner_job_id="P1"))
+        s.commit()
+        assert remove_expired_job_postings(s) == 0
+        assert diff_engine.count_rows(s, JobPostings) == 1
+
+
+def test_upsert_job_postings_is_idempotent(tmp_path):
+    """Test rerunning the upsert updates rows by partner_job_id instead of duplicating them."""
+    import pytest
+    from sqlalchemy.dialects import mysql
+    from sqlalchemy.exc import IntegrityError
+    from sqlmodel import Session, select
+
+    from api.wrapping.models import JobPostings
+    from scripts.upsert import upsert_job_postings, upsert_statement
+
+    engine = _sqlite_engine(tmp_path)
+    with Session(engine) as s:
+        postings = [JobPostings(position=f"Role {i}", partner_job_id=f"P{i}", description="v1") for i in range(5)]
+        assert upsert_job_postings(s, postings, chunk_size=2) == 5
+        s.commit()
+
+        postings = [JobPostings(position=f"Role {i}", partner_job_id=f"P{i}", description="v2") for i in range(3, 7)]
+        upsert_job_postings(s, postings)
+        s.commit()
+
+        rows = s.exec(select(JobPostings.partner_job_id, JobPostings.description).order_by(JobPostings.partner_job_id)).all()
+        assert rows == [(f"P{i}", "v1" if i < 3 else "v2") for i in range(7)]
+
+        s.add(JobPostings(position="Dup", partner_job_id="P0"))
+        with pytest.raises(IntegrityError):
+            s.commit()
+
+    statement = upsert_statement("mysql", [{"position": "x", "partner_job_id": "P1"}])
+    mysql_sql = str(statement.compile(dialect=mysql.dialect()))
+    assert "ON DUPLICATE KEY UPDATE position = VALUES(position)" in mysql_sql
+
+
+def test_batch_writer_flushes_by_count_and_time_and_bisects_failures(tmp_path):
+    """Test rows are committed per flush and a bad row is isolated without dropping its batch."""
+    from sqlmodel import Session, select
+
+    from api.wrapping.models import JobPostings
+    from scripts.upsert import BatchWriter
+
+    engine = _sqlite_engine(tmp_path)
+    now = [0.0]
+    writer = BatchWriter(engine, max_rows=4, max_interval_s=10, clock=lambda: now[0])
+
+    for i in range(3):
+        writer.add(JobPostings(position=f"Role {i}", partner_job_id=f"P{i}"))
+    assert writer.flushes == 0
+    now[0] = 11.0
+    writer.add(JobPostings(position="Role 3", partner_job_id="P3"))
+    assert (writer.flushes, writer.written) == (1, 4)
+
+    with writer:
+        for i in range(4, 8):
+            # position is NOT NULL: this row alone must be rejected
+            writer.add(JobPostings(position=None if i == 6 else f"Role {i}", partner_job_id=f"P{i}"))
+
+    assert writer.written == 7
+    assert [posting.partner_job_id for posting, _ in writer.failed] == ["P6"]
+    with Session(engine) as s:
+        assert len(s.exec(select(JobPostings)).all()) == 7
+
+
+def test_batch_writer_flushes_on_idle_while_enrichment_waits(tmp_path):
+    """Test buffered rows are committed by time while the consumer waits for a slow enrichment."""
+    from api.wrapping.models import JobPostings
+    from scripts.enrichment import enrich_concurrently
+    from scripts.upsert import BatchWriter
+
+    release = threading.Event()
+
+    def enrich(i):
+        if i == 2:
+            release.wait(5)
+        return i
+
+    now = [0.0]
+    writer = BatchWriter(_sqlite_engine(tmp_path), max_rows=100, max_interval_s=5, clock=lambda: now[0])
+
+    def idle():
+        now[0] += 10
+        writer.flush_if_due()
+        if writer.written:
+            release.set()
+
+    with writer:
+        for _, i in enrich_concurrently([1, 2], enrich, concurrency=2, ordered=True, idle=idle, idle_interval_s=0.01):
+            writer.add(JobPostings(position=f"Role {i}", partner_job_id=f"P{i}"))
+        # Row 1 was written while row 2 was still enriching, row 2 waits for close
+        assert (writer.flushes, writer.written) == (1, 1)
+    assert writer.written == 2
+
+
+def test_incremental_without_queue_publishes_original_on_enrichment_error(tmp_path, monkeypatch):
+    """Test an enrichment error without a pipeline queue falls back to the original description."""
+    from sqlmodel import Session, select
+
+    from api.wrapping.models import JobPostingPre, JobPostings
+    from scripts import improve_job_descriptions
+    from scripts.enrichment_cache import EnrichmentCache
+
+    def enrich(job_description, **kwargs):
+        if job_description == "desc 2":
+            raise RuntimeError("unexpected")
+        return f"improved {job_description}"
+
+    monkeypatch.setattr(improve_job_descriptions, "improve_job_description_with_openai", enrich)
+    engine = _sqlite_engine(tmp_path)
+    with Session(engine) as s:
+        for i in range(1, 4):
+            s.add(JobPostingPre(id=i, position=f"Role {i}", partner_job_id=f"P{i}", job_description=f"desc {i}"))
+        s.commit()
+        pending = list(s.exec(select(JobPostingPre)).all())
+
+    cache = EnrichmentCache(engine, prompt="p", model="m")
+    inserted = improve_job_descriptions.process_and_insert_incremental(engine, pending, client=object(), cache=cache)
+
+    assert inserted == 3
+    with Session(engine) as s:
+        descriptions = {p.partner_job_id: p.description for p in s.exec(select(JobPostings)).all()}
+    assert descriptions == {"P1": "improved desc 1", "P2": "desc 2", "P3": "improved desc 3"}
+
+
+def test_pipeline_queue_resumes_and_backs_off_failures(tmp_path):
+    """Test queued work survives a crash, failures back off exponentially and are retried later."""
+    from datetime import datetime, timedelta
+    from types import SimpleNamespace
+
+    from sqlmodel import Session, select
+
+    from api.wrapping.models import JobPostingPre, JobPostings, PipelineJob
+    from scripts import improve_job_descriptions, pipeline_state
+    from scripts.enrichment_cache import EnrichmentCache
+
+    failing = {"desc 4"}
+
+    def create(messages, **kwargs):
+        description = messages[-1]["content"].rsplit("\n", 1)[-1]
+        if description in failing:
+            raise RuntimeError("rate limited")
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"improved {description}"))])
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    engine = _sqlite_engine(tmp_path)
+    with Session(engine) as s:
+        for i in range(1, 5):
+            s.add(JobPostingPre(id=i, position=f"Role {i}", partner_job_id=f"P{i}", job_description=f"desc {i}"))
+        s.commit()
+
+    now = [datetime(2026, 1, 1)]
+    queue = pipeline_state.PipelineQueue(engine, worker_id="w1", backoff_base_s=60, clock=lambda: now[0])
+    assert queue.sync() == 4
+    # Simulated crash: P1 was claimed by this worker and never finished
+    assert queue.claim(1) == ["P1"]
+    assert queue.counts()[pipeline_state.ENRICHING] == 1
+
+    queue = pipeline_state.PipelineQueue(engine, worker_id="w1", backoff_base_s=60, clock=lambda: now[0])
+    cache = EnrichmentCache(engine, prompt="p", model="m")
+    inserted = improve_job_descriptions.process_queue(engine, queue, claim_size=2, client=client, cache=cache)
+    assert inserted == 3
+    assert queue.counts() == {"pending": 0, "enriching": 0, "done": 3, "failed": 1}
+    with Session(engine) as s:
+        job = s.get(PipelineJob, "P4")
+        assert (job.attempts, job.last_error, job.next_attempt_at) == (1, "rate limited", now[0] + timedelta(seconds=60))
+        assert s.get(PipelineJob, "P1").attempts == 2
+
+    # Still backing off: nothing is claimed
+    assert improve_job_descriptions.process_queue(engine, queue, client=client, cache=cache) == 0
+
+    failing.clear()
+    now[0] += timedelta(seconds=61)
+    assert improve_job_descriptions.process_queue(engine, queue, client=client, cache=cache) == 1
+    assert queue.counts()[pipeline_state.DONE] == 4
+    with Session(engine) as s:
+        descriptions = s.exec(select(JobPostings.description).order_by(JobPostings.partner_job_id)).all()
+    assert descriptions == [f"improved desc {i}" for i in range(1, 5)]
+    assert queue.backoff(3) == timedelta(seconds=240)
+
+
+def test_pipeline_skips_pre_rows_without_partner_id_on_every_run(tmp_path):
+    """Test rows without partner_job_id are never enriched nor inserted, however many times the pipeline runs."""
+    from types import SimpleNamespace
+
+    from sqlmodel import Session, select
+
+    from api.wrapping.models import JobPostingPre, JobPostings
+    from scripts import improve_job_descriptions, pipeline_state
+    from scripts.enrichment_cache import EnrichmentCache
+
+    calls = []
+
+    def create(messages, **kwargs):
+        description = messages[-1]["content"].rsplit("\n", 1)[-1]
+        calls.append(description)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"improved {description}"))])
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    engine = _sqlite_engine(tmp_path)
+    with Session(engine) as s:
+        s.add(JobPostingPre(id=1, position="Role 1", partner_job_id="P1", job_description="desc 1"))
+        s.add(JobPostingPre(id=2, position="No partner id", job_description="desc 2"))
+        s.commit()
+
+    cache = EnrichmentCache(engine, prompt="p", model="m")
+    for _ in range(2):
+        queue = pipeline_state.PipelineQueue(engine, worker_id="w1")
+        improve_job_descriptions.process_queue(engine, queue, client=client, cache=cache, concurrency=1)
+        with Session(engine) as s:
+            assert improve_job_descriptions.get_new_job_postings_to_process(s) == []
+
+    assert calls == ["desc 1"]
+    with Session(engine) as s:
+        assert [p.partner_job_id for p in s.exec(select(JobPostings)).all()] == ["P1"]
+
+
+def test_pipeline_queue_concurrent_claims_never_overlap(tmp_path):
+    """Test workers claiming from the same queue concurrently never get the same item (SQLite fallback)."""
+    from sqlalchemy.dialects import mysql, postgresql, sqlite
+    from sqlmodel import Session
+
+    from api.wrapping.models import JobPostingPre
+    from scripts import pipeline_state
+
+    engine = _sqlite_engine(tmp_path)
+    with Session(engine) as s:
+        s.add_all(JobPostingPre(position=f"Role {i}", partner_job_id=f"P{i:03d}") for i in range(60))
+        s.commit()
+    assert pipeline_state.PipelineQueue(engine, worker_id="coordinator").sync() == 60
+
+    claims = {}
+
+    def work(worker_id):
+        queue = pipeline_state.PipelineQueue(engine, worker_id=worker_id)
+        claims[worker_id] = []
+        while batch := queue.claim(4):
+            claims[worker_id].extend(batch)
+
+    threads = [threading.Thread(target=work, args=(f"w{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    claimed = [partner_job_id for batch in claims.values() for partner_job_id in batch]
+    assert sorted(claimed) == [f"P{i:03d}" for i in range(60)]
+    assert pipeline_state.PipelineQueue(engine).counts()[pipeline_state.ENRICHING] == 60
+
+    queue = pipeline_state.PipelineQueue(engine)
+    statement = queue.claim_candidates_statement(queue.clock(), 10, skip_locked=True)
+    assert "FOR UPDATE SKIP LOCKED" in str(statement.compile(dialect=postgresql.dialect()))
+    assert pipeline_state.supports_skip_locked(postgresql.dialect())
+    assert not pipeline_state.supports_skip_locked(sqlite.dialect())
+    mysql_dialect = mysql.dialect()
+    mysql_dialect.server_version_info = (5, 7, 40)
+    assert not pipeline_state.supports_skip_locked(mysql_dialect)
+    mysql_dialect.server_version_info = (8, 0, 36)
+    assert pipeline_state.supports_skip_locked(mysql_dialect)
+
+
+def test_coordinator_reports_until_remote_workers_drain_queue(tmp_path):
+    """Test the coordinator queues work and reports aggregate progress while other workers drain it."""
+    from sqlmodel import Session
+
+    from api.wrapping.models import JobPostingPre
+    from scripts import improve_job_descriptions, pipeline_state
+
+    engine = _sqlite_engine(tmp_path)
+    with Session(engine) as s:
+        s.add_all(JobPostingPre(position=f"Role {i}", partner_job_id=f"P{i}") for i in range(6))
+        s.commit()
+
+    coordinator = pipeline_state.PipelineQueue(engine, worker_id="coordinator")
+    remote = pipeline_state.PipelineQueue(engine, worker_id="pod-1")
+    sleeps = []
+
+    def remote_worker_step(_interval):
+        # Each report interval the remote worker completes a batch of two items
+        sleeps.append(_interval)
+        claimed = remote.claim(2)
+        with Session(engine) as s:
+            remote.mark_done(s, claimed)
+            s.commit()
+
+    done = improve_job_descriptions.coordinate_workers(
+        engine, coordinator, workers=0, interval_s=5, sleep=remote_worker_step
+    )
+    assert done == 6
+    assert sleeps == [5, 5, 5]
+    assert coordinator.done_by_worker() == {"pod-1": 6}
+
+
+def test_change_detection_reenriches_only_changed_descriptions(tmp_path):
+    """Test fingerprints classify rows and only new or changed descriptions reach OpenAI."""
+    from types import SimpleNamespace
+
+    from sqlmodel import Session, select
+
+    from api.wrapping.models import JobPostingPre, JobPostings
+    from scripts import diff_engine, improve_job_descriptions, pipeline_state
+    from scripts.enrichment_cache import EnrichmentCache
+
+    calls = []
+
+    def create(messages, **kwargs):
+        description = messages[-1]["content"].rsplit("\n", 1)[-1]
+        calls.append(description)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"improved {description}"))])
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    engine = _sqlite_engine(tmp_path)
+    with Session(engine) as s:
+        for i in range(1, 5):
+            s.add(JobPostingPre(id=i, position=f"Role {i}", partner_job_id=f"P{i}", job_description=f"desc {i}", location="Milano"))
+        # Rows written before fingerprints existed
+        for i in range(1, 4):
+            s.add(JobPostings(position=f"Role {i}", partner_job_id=f"P{i}", description=f"improved desc {i}", location="Milano"))
+        s.add(JobPostings(position="Old", partner_job_id="P9"))
+        s.commit()
+
+        assert improve_job_descriptions.detect_changes(s) == diff_engine.DiffSummary(
+            new=1, changed=0, metadata_changed=0, unchanged=3, expired=1
+        )
+
+        s.get(JobPostingPre, 1).job_description = "desc 1 rewritten"
+        s.get(JobPostingPre, 2).location = "Roma"
+        s.get(JobPostingPre, 3).job_description = "desc   3"  # whitespace only: unchanged
+        s.commit()
+        assert improve_job_descriptions.detect_changes(s) == diff_engine.DiffSummary(
+            new=1, changed=1, metadata_changed=1, unchanged=1, expired=1
+        )
+
+    assert improve_job_descriptions.apply_metadata_changes(engine) == 1
+    queue = pipeline_state.PipelineQueue(engine, worker_id="w1")
+    cache = EnrichmentCache(engine, prompt="p", model="m")
+    assert improve_job_descriptions.process_queue(engine, queue, client=client, cache=cache) == 2
+    assert sorted(calls) == ["desc 1 rewritten", "desc 4"]
+
+    with Session(engine) as s:
+        rows = s.exec(
+            select(JobPostings.partner_job_id, JobPostings.description, JobPostings.location)
+            .where(JobPostings.partner_job_id != "P9")
+            .order_by(JobPostings.partner_job_id)
+        ).all()
+        assert rows == [
+            ("P1", "improved desc 1 rewritten", "Milano"),
+            ("P2", "improved desc 2", "Roma"),
+            ("P3", "improved desc 3", "Milano"),
+            ("P4", "improved desc 4", "Milano"),
+        ]
+        assert diff_engine.classify(s) == diff_engine.DiffSummary(
+            new=0, changed=0, metadata_changed=0, unchanged=4, expired=1
+        )
+
+
+def test_run_metrics_textfile_and_pushgateway_export(tmp_path, monkeypatch):
+    """Test the pipeline run metrics are written as a textfile and pushed to a Pushgateway in exposition format."""
+    import httpx
+
+    from scripts import improve_job_descriptions
+    from scripts.openai_client import CallTimings
+    from utils import metrics
+
+    pushed = []
+
+    def fake_put(url, content, headers, timeout):
+        pushed.append((url, content.decode("utf-8"), headers["Content-Type"]))
+        return httpx.Response(200, request=httpx.Request("PUT", url))
+
+    textfile = tmp_path / "enrichment.prom"
+    monkeypatch.setattr(metrics, "METRICS_TEXTFILE_PATH", str(textfile))
+    monkeypatch.setattr(metrics, "METRICS_PUSHGATEWAY_URL", "http://pushgateway:9091/")
+    monkeypatch.setattr(metrics.httpx, "put", fake_put)
+    monkeypatch.setattr(improve_job_descriptions.latency_recorder, "calls", [CallTimings(0.0, 0.3, 0.4), CallTimings(0.05, 2.0, 2.2)])
+
+    improve_job_descriptions.export_run_metrics(
+        lambda: improve_job_descriptions.build_run_metrics(
+            {"new": 3, "processed": 2}, 12.5, queue_counts={"pending": 1, "done": 2}, all_processed=False
+        ),
+        grouping={"worker": "pod-1"},
+    )
+
+    text = textfile.read_text()
+    assert 'enrichment_run_records{outcome="processed"} 2' in text
+    assert "enrichment_run_duration_seconds 12.5" in text
+    assert "enrichment_all_processed 0" in text
+    assert 'pipeline_jobs{status="pending"} 1' in text
+    assert 'enrichment_openai_call_seconds_bucket{phase="total",le="0.5"} 1' in text
+    assert 'enrichment_openai_call_seconds_bucket{phase="total",le="+Inf"} 2' in text
+    assert 'enrichment_openai_call_seconds_count{phase="wait"} 2' in text
+    assert "# TYPE enrichment_openai_call_seconds histogram" in text
+    assert not list(tmp_path.glob("*.tmp"))
+    assert pushed == [
+        ("http://pushgateway:9091/metrics/job/improve_job_descriptions/worker/pod-1", text, metrics.CONTENT_TYPE)
+    ]
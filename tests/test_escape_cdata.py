@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import os
+import re
+import timeit
+
+import pytest
+
+from api.wrapping.wrapping import _escape_cdata
+
+
+def _legacy_escape_cdata(value) -> str:
+    """Reference implementation: UTF-8 round trip, control-char regex, then ]]> replace."""
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        value_str = value.decode("utf-8", errors="replace")
+    else:
+        value_str = str(value).encode("utf-8", errors="replace").decode("utf-8")
+    value_str = re.sub(r"[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]", "", value_str)
+    return value_str.replace("]]>", "]]]]><![CDATA[>")
+
+
+_PARAGRAPH = (
+    "<p><strong>Riassunto dell'opportunità da parte della <i>Joinrs AI</i>:</strong> "
+    "Canonical è alla ricerca di <b>Junior Software Support Engineer</b> con laurea STEM.</p><br><br>"
+)
+
+
+def _description(size: int) -> str:
+    return (_PARAGRAPH * (size // len(_PARAGRAPH) + 1))[:size]
+
+
+@pytest.mark.parametrize("value", [
+    None,
+    "",
+    "Software Engineer",
+    b"bytes \xc3\xa8 value",
+    b"invalid \xff byte",
+    12345,
+    "tab\tnew\nline\rkept",
+    "control\x00\x08\x0b\x0c\x1f\x7f removed",
+    "cdata ]]> end ]]>",
+    "split ]]\x01> sequence",
+    "lone \ud800 surrogate",
+    _description(4000) + "]]>" + "\x02",
+])
+def test_escape_cdata_matches_reference(value):
+    """Test the fast-path sanitizer is equivalent to the reference implementation."""
+    assert _escape_cdata(value) == _legacy_escape_cdata(value)
+
+
+@pytest.mark.skipif(not os.getenv("RUN_BENCHMARKS"), reason="set RUN_BENCHMARKS=1 to run micro-benchmarks")
+@pytest.mark.parametrize("size", [64, 1_000, 8_000, 32_000])
+def test_escape_cdata_benchmark(size, record_property):
+    """Micro-benchmark: per-field cost on clean values, recorded as test properties next to the reference."""
+    value = _description(size)
+    number = 2000
+
+    fast = min(timeit.repeat(lambda: _escape_cdata(value), number=number, repeat=3)) / number
+    legacy = min(timeit.repeat(lambda: _legacy_escape_cdata(value), number=number, repeat=3)) / number
+
+    record_property("escape_cdata_us_per_field", round(fast * 1e6, 2))
+    record_property("reference_us_per_field", round(legacy * 1e6, 2))
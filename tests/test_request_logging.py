@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from main import app
+from utils import geo
+from utils.logger import get_logger
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.payloads = []
+
+    def emit(self, record):
+        self.payloads.append(record.extra)
+
+
+@pytest.fixture()
+def captured_logs():
+    handler = _ListHandler()
+    logger = get_logger()
+    logger.addHandler(handler)
+    geo.geo_cache.clear()
+    yield handler.payloads
+    logger.removeHandler(handler)
+    geo.geo_cache.clear()
+
+
+def test_request_latency_independent_of_geo_provider(monkeypatch, captured_logs):
+    """Test a slow geo provider delays only the log record, not the response, and is cached per IP."""
+    calls = []
+    finished = []
+    release = threading.Event()
+
+    async def slow_fetch_geo(ip):
+        calls.append(ip)
+        # The provider answers only once the test allows it
+        for _ in range(500):
+            if release.is_set():
+                break
+            await asyncio.sleep(0.01)
+        finished.append(ip)
+        return {"country_iso_code": "IT"}
+
+    monkeypatch.setattr(geo, "fetch_geo", slow_fetch_geo)
+    with TestClient(app) as client:
+        for _ in range(3):
+            r = client.get("/", headers={"x-forwarded-for": "93.184.216.34"})
+            assert r.status_code == 200
+        # Every response was sent while the lookup was still pending
+        assert finished == []
+        release.set()
+        client.get("/", headers={"x-forwarded-for": "10.0.0.1"})
+    # Leaving the client runs the lifespan shutdown, which flushes the queue
+
+    assert len(captured_logs) == 4
+    public = [p for p in captured_logs if p["destination"]["ip"] == "93.184.216.34"]
+    assert [p["destination"]["geo"] for p in public] == [{"country_iso_code": "IT"}] * 3
+    assert calls == ["93.184.216.34"]
+    private = [p for p in captured_logs if p["destination"]["ip"] == "10.0.0.1"]
+    assert "geo" not in private[0]["destination"]
+
+
+def test_geo_cache_lru_and_ttl():
+    """Test entries expire after their TTL (shorter for empty results) and the LRU bound holds."""
+    now = [0.0]
+    cache = geo.GeoCache(max_entries=2, ttl_s=100, negative_ttl_s=10, clock=lambda: now[0])
+    cache.put("1.1.1.1", {"city_name": "A"})
+    cache.put("2.2.2.2", {})
+    assert cache.get("2.2.2.2") == {}
+    assert cache.get("1.1.1.1") == {"city_name": "A"}
+    cache.put("3.3.3.3", {"city_name": "C"})
+    assert cache.get("2.2.2.2") is None  # least recently used evicted
+    now[0] = 50
+    assert cache.get("1.1.1.1") == {"city_name": "A"}
+    assert cache.get("3.3.3.3") == {"city_name": "C"}
+    now[0] = 101
+    assert cache.get("1.1.1.1") is None
+    assert (cache.hits, cache.misses) == (4, 2)
+
+
+FIXTURE_CSV = Path(__file__).parent / "fixtures" / "geo_ranges.csv"
+
+
+def test_range_geo_database_lookup(tmp_path):
+    """Test the mmap range database resolves IPv4/IPv6 addresses at range bounds and misses gaps."""
+    from scripts.build_geo_db import build_geo_db
+
+    path = tmp_path / "geo.db"
+    assert build_geo_db(FIXTURE_CSV, path) == 4
+    database = geo.RangeGeoDatabase(str(path))
+    try:
+        assert database.lookup("2.32.0.0")["city_name"] == "Milan"
+        assert database.lookup("2.47.255.255")["location"] == {"lon": 9.19, "lat": 45.4642}
+        assert database.lookup("151.8.1.2")["city_name"] == "Rome"
+        assert database.lookup("93.184.216.34")["country_iso_code"] == "US"
+        assert database.lookup("2001:db8::1") == {"continent_name": "Europe", "country_iso_code": "DE", "country_name": "Germany"}
+        assert database.lookup("2.48.0.0") is None
+        assert database.lookup("1.1.1.1") is None
+        assert database.lookup("255.255.255.255") is None
+        assert database.lookup("not an ip") is None
+    finally:
+        database.close()
+
+    with pytest.raises(ValueError):
+        geo.write_range_database(str(tmp_path / "bad.db"), [("1.0.0.0", "1.0.0.255", {}), ("1.0.0.128", "1.0.1.0", {})])
+
+
+def test_lookup_geo_prefers_local_database_and_falls_back_on_miss(tmp_path, monkeypatch):
+    """Test lookups hit the local database without network and only misses reach the HTTP provider."""
+    from scripts.build_geo_db import build_geo_db
+
+    path = tmp_path / "geo.db"
+    build_geo_db(FIXTURE_CSV, path)
+    calls = []
+
+    async def fetch_geo(ip):
+        calls.append(ip)
+        return {"country_iso_code": "AU"}
+
+    monkeypatch.setattr(geo, "fetch_geo", fetch_geo)
+    monkeypatch.setattr(geo, "_geo_database", geo.RangeGeoDatabase(str(path)))
+    monkeypatch.setattr(geo, "_geo_database_loaded", True)
+    geo.geo_cache.clear()
+
+    assert asyncio.run(geo.lookup_geo("151.1.1.1"))["city_name"] == "Rome"
+    assert calls == []
+    assert asyncio.run(geo.lookup_geo("1.1.1.1")) == {"country_iso_code": "AU"}
+    assert calls == ["1.1.1.1"]
+
+    monkeypatch.setattr(geo, "GEO_HTTP_FALLBACK", False)
+    assert asyncio.run(geo.lookup_geo("8.8.8.8")) == {}
+    assert calls == ["1.1.1.1"]
+    geo.geo_cache.clear()
+
+
+def test_unreadable_geo_database_is_logged_as_warning(tmp_path, monkeypatch, captured_logs):
+    """Test an unreadable GEO_DB_PATH goes through the service logger and leaves the HTTP provider in use."""
+    path = tmp_path / "broken.db"
+    path.write_bytes(b"not a geo database")
+    monkeypatch.setattr(geo, "GEO_DB_PATH", str(path))
+    monkeypatch.setattr(geo, "_geo_database", None)
+    monkeypatch.setattr(geo, "_geo_database_loaded", False)
+
+    assert geo.get_geo_database() is None
+    assert len(captured_logs) == 1
+    assert captured_logs[0]["event"] == "geo_database_unavailable"
+    assert captured_logs[0]["path"] == str(path)
+    assert captured_logs[0]["error"]
+
+
+def test_parse_user_agent_is_cached(monkeypatch):
+    """Test repeated user agents hit the LRU cache, results stay isolated and oversized strings bypass it."""
+    from utils import logger
+
+    logger._cached_parse_user_agent.cache_clear()
+    ua = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15"
+    first = logger.parse_user_agent(ua)
+    first["os"]["name"] = "changed"
+    second = logger.parse_user_agent(ua)
+    assert second["original"] == ua
+    assert second["os"]["name"] != "changed"
+    assert logger.user_agent_cache_info()["hits"] == 1
+    assert logger.user_agent_cache_info()["misses"] == 1
+
+    monkeypatch.setattr(logger, "UA_CACHE_MAX_LENGTH", 10)
+    assert logger.parse_user_agent(ua)["original"] == ua
+    assert logger.user_agent_cache_info()["hits"] == 1
+    assert logger.user_agent_cache_info()["size"] == 1
+
+
+class _BlockedStream:
+    """Stream whose writes block until released, like a stalled stdout pipe."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.writes = []
+
+    def write(self, data):
+        self.release.wait(5)
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+
+def test_queue_logging_does_not_block_on_slow_stream():
+    """Test records are written in batches off the calling thread, and overflow is dropped and reported."""
+    from utils import logger as logger_module
+
+    stream = _BlockedStream()
+    handler, listener = logger_module.create_queue_logging(stream, max_size=50, batch_size=100)
+    log = logging.getLogger("test-queue-logging")
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    listener.start()
+    try:
+        for i in range(200):
+            log.info("http_request", extra={"extra": {"n": i}})
+        # Every call returned while the stream was still stalled
+        assert stream.writes == []
+        stream.release.set()
+    finally:
+        stream.release.set()
+        listener.stop()
+        log.removeHandler(handler)
+
+    lines = [json.loads(line) for data in stream.writes for line in data.splitlines()]
+    written = [line["n"] for line in lines if "n" in line]
+    assert written == sorted(written)
+    assert handler.dropped > 0
+    assert len(written) + handler.dropped == 200
+    assert len(stream.writes) < len(written)
+    reports = [line for line in lines if line.get("message") == "log_records_dropped"]
+    assert sum(line["dropped"] for line in reports) == handler.dropped
+    assert all(line["level"] == "WARNING" for line in reports)
+
+
+def test_json_formatter_output_matches_stdlib_json():
+    """Test the optional fast encoder produces the same document as json, including non-JSON values."""
+    from utils import logger as logger_module
+
+    record = logging.LogRecord("svc", logging.INFO, __file__, 1, "http_request", None, None)
+    record.extra = {"request": {"path": "/wrapping", "città": "Milano"}, "at": datetime(2024, 1, 2, 3, 4, 5), 1: "x"}
+    expected = {"level": "INFO", "logger": "svc", "time": int(record.created * 1000)}
+    expected.update({"request": {"path": "/wrapping", "città": "Milano"}, "at": str(datetime(2024, 1, 2, 3, 4, 5)), "1": "x"})
+    assert json.loads(logger_module.JsonFormatter().format(record)) == expected
+
+
+def test_request_log_policies(monkeypatch, captured_logs):
+    """Test routes can be skipped or sampled, status overrides win, and skipped requests build no payload."""
+    from utils import logger
+
+    policy = logger.RequestLogPolicy("/health=skip,/=sample:3,/wrapping*=always", "5xx=always,404=skip")
+    assert policy.should_log("/wrapping/index", 200)
+    assert not policy.should_log("/health", 200)
+    assert policy.should_log("/health", 503)
+    assert not policy.should_log("/wrapping", 404)
+    assert policy.should_log("/other", 200)
+    assert [policy.should_log("/", 200) for _ in range(6)] == [True, False, False, True, False, False]
+    with pytest.raises(ValueError):
+        logger.parse_log_policies("/health=sample:0")
+    with pytest.raises(ValueError):
+        logger.parse_log_policies("/health")
+
+    built = []
+    original_build = main.build_log_payload
+    monkeypatch.setattr(main, "build_log_payload", lambda **kwargs: built.append(kwargs) or original_build(**kwargs))
+    monkeypatch.setattr(main, "request_log_policy", logger.RequestLogPolicy("/health=skip,/=sample:2", "5xx=always"))
+    with TestClient(app) as client:
+        for _ in range(3):
+            assert client.get("/health").status_code == 200
+        for _ in range(4):
+            assert client.get("/").status_code == 200
+    assert len(built) == 2
+    assert [p["request"]["url"]["path"] for p in captured_logs] == ["/", "/"]
@@ -5,12 +5,14 @@ from typing import Generator
 
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import event
 from sqlalchemy.pool import StaticPool
 from sqlmodel import SQLModel, Session, create_engine
 
 from main import app
 from utils.database import get_session as original_get_session
 from api.wrapping import models
+from api.wrapping.snapshot import snapshot_cache
 
 
 @pytest.fixture(autouse=True)
@@ -27,6 +29,12 @@ def client() -> Generator[TestClient, None, None]:
         connect_args={"check_same_thread": False},
         poolclass=StaticPool,
     )
+
+    # Models live in the "lw" schema; SQLite needs it attached as a database
+    @event.listens_for(engine, "connect")
+    def _attach_lw_schema(dbapi_connection, _):
+        dbapi_connection.execute("ATTACH DATABASE ':memory:' AS lw")
+
     SQLModel.metadata.create_all(engine)
 
     def get_test_session() -> Generator[Session, None, None]:
@@ -37,16 +45,18 @@ def client() -> Generator[TestClient, None, None]:
             session.close()
 
     app.dependency_overrides[original_get_session] = get_test_session
+    snapshot_cache.clear()
     with TestClient(app) as c:
         yield c
     app.dependency_overrides.clear()
+    snapshot_cache.clear()
 
 
 def test_health_endpoint(client: TestClient):
     """Test health check endpoint."""
     r = client.get("/health")
     assert r.status_code == 200
-    assert r.json() == {"Ok!"}
+    assert r.json() == ["Ok!"]
 
 
 def test_root_endpoint(client: TestClient):
@@ -62,7 +72,7 @@ def test_wrapping_endpoint_empty(client: TestClient):
     """Test wrapping endpoint with no job postings."""
     r = client.get("/wrapping")
     assert r.status_code == 200
-    assert r.headers["content-type"] == "application/xml"
+    assert r.headers["content-type"] == "application/xml; charset=utf-8"
     content = r.text
     assert "<source>" in content
     assert "</source>" in content
@@ -82,7 +92,7 @@ def test_wrapping_endpoint_with_jobs(client: TestClient):
     
     r = client.get("/wrapping")
     assert r.status_code == 200
-    assert r.headers["content-type"] == "application/xml"
+    assert r.headers["content-type"] == "application/xml; charset=utf-8"
     content = r.text
     
     # Check XML structure
@@ -98,3 +108,649 @@ def test_wrapping_endpoint_with_jobs(client: TestClient):
     assert "<![CDATA[Data Scientist]]>" in content
 
 
+
+
+def test_iter_wrapping_xml_matches_generate_wrapping_xml():
+    """Test streamed chunks join to the same document as the buffered renderer."""
+    from datetime import datetime
+    from api.wrapping.wrapping import generate_wrapping_xml, iter_wrapping_xml
+
+    jobs = [
+        models.JobPostings(id=i, position=f"Role {i}", last_build_date=datetime(2024, 1, i))
+        for i in range(1, 6)
+    ]
+    chunks = list(iter_wrapping_xml(jobs, datetime(2024, 1, 5), jobs_per_chunk=2))
+
+    # header + 3 job chunks (2, 2, 1) + footer
+    assert len(chunks) == 5
+    assert b"".join(chunks).decode("utf-8") == generate_wrapping_xml(jobs)
+
+
+def test_wrapping_endpoint_uses_max_last_build_date(client: TestClient):
+    """Test streamed lastBuildDate comes from the newest job posting."""
+    from datetime import datetime
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        s.add(models.JobPostings(id=1, position="A", last_build_date=datetime(2024, 1, 8, 11, 34, 23)))
+        s.add(models.JobPostings(id=2, position="B", last_build_date=datetime(2023, 5, 1)))
+        s.commit()
+
+    r = client.get("/wrapping")
+    assert r.status_code == 200
+    assert "<lastBuildDate> Mon, 08 Jan 2024 11:34:23 -0000 </lastBuildDate>" in r.text
+    assert r.text.endswith("</source>")
+
+
+def test_iter_available_job_postings_batches(client: TestClient):
+    """Test batched iteration returns every row in id order."""
+    from api.wrapping.service import iter_available_job_postings
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        for i in (3, 1, 5, 2, 4):
+            s.add(models.JobPostings(id=i, position=f"Role {i}"))
+        s.commit()
+
+        ids = [job.id for job in iter_available_job_postings(s, batch_size=2)]
+    assert ids == [1, 2, 3, 4, 5]
+
+
+def test_wrapping_conditional_requests(client: TestClient):
+    """Test ETag / Last-Modified validators and 304 responses."""
+    from datetime import datetime
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        s.add(models.JobPostings(id=1, position="A", updated_at=datetime(2024, 1, 8, 11, 34, 23)))
+        s.commit()
+
+    r = client.get("/wrapping")
+    assert r.status_code == 200
+    etag = r.headers["etag"]
+    assert r.headers["last-modified"] == "Mon, 08 Jan 2024 11:34:23 GMT"
+
+    r = client.get("/wrapping", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.headers["etag"] == etag
+    assert r.content == b""
+
+    r = client.get("/wrapping", headers={"If-Modified-Since": "Mon, 08 Jan 2024 11:34:23 GMT"})
+    assert r.status_code == 304
+    r = client.get("/wrapping", headers={"If-Modified-Since": "Sun, 07 Jan 2024 00:00:00 GMT"})
+    assert r.status_code == 200
+
+    # A new row changes the validators
+    with next(get_sess()) as s:  # type: ignore
+        s.add(models.JobPostings(id=2, position="B", updated_at=datetime(2024, 1, 1)))
+        s.commit()
+    r = client.get("/wrapping", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["etag"] != etag
+    assert "<![CDATA[B]]>" in r.text
+
+
+
+def test_wrapping_if_modified_since_sees_removals(client: TestClient):
+    """Test removing a posting moves Last-Modified, so If-Modified-Since alone does not get a stale 304."""
+    from datetime import datetime
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        s.add(models.JobPostings(id=1, position="Kept", partner_job_id="P1", updated_at=datetime(2024, 1, 8)))
+        s.add(models.JobPostings(id=2, position="Expired", partner_job_id="P2", updated_at=datetime(2024, 1, 1)))
+        s.commit()
+
+    feed_modified = client.get("/wrapping").headers["last-modified"]
+    page_modified = client.get("/wrapping", params={"after_id": 0}).headers["last-modified"]
+    assert client.get("/wrapping", headers={"If-Modified-Since": feed_modified}).status_code == 304
+
+    # The pipeline deletes expired postings and records a tombstone
+    with next(get_sess()) as s:  # type: ignore
+        s.delete(s.get(models.JobPostings, 2))
+        s.add(models.JobPostingTombstone(partner_job_id="P2", deleted_at=datetime(2024, 2, 1, 9, 30), posting_id=2))
+        s.commit()
+
+    r = client.get("/wrapping", headers={"If-Modified-Since": feed_modified})
+    assert r.status_code == 200
+    assert "<![CDATA[Expired]]>" not in r.text
+    assert r.headers["last-modified"] == "Thu, 01 Feb 2024 09:30:00 GMT"
+    assert client.get("/wrapping", params={"after_id": 0}, headers={"If-Modified-Since": page_modified}).status_code == 200
+    assert client.get("/wrapping", headers={"If-Modified-Since": r.headers["last-modified"]}).status_code == 304
+
+def test_wrapping_served_from_snapshot(client: TestClient, monkeypatch):
+    """Test the rendered feed is cached and reused while the table is unchanged."""
+    from api.wrapping import wrapping
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        s.add(models.JobPostings(id=1, position="A"))
+        s.commit()
+
+    first = client.get("/wrapping")
+    snapshot = snapshot_cache._snapshots.get("feed")
+    assert snapshot is not None
+    assert snapshot.body == first.content
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("feed re-rendered while snapshot is current")
+
+    monkeypatch.setattr(wrapping, "iter_available_job_postings", _fail)
+    second = client.get("/wrapping")
+    assert second.content == first.content
+    assert second.headers["etag"] == first.headers["etag"]
+
+
+def test_snapshot_cache_byte_budget():
+    """Test snapshots are evicted by bytes (compressed variants included) and oversized documents are refused."""
+    from api.wrapping.service import FeedState
+    from api.wrapping.snapshot import FeedSnapshot, SnapshotCache
+
+    state = FeedState(1, 1, None, None)
+    cache = SnapshotCache(max_entries=10, max_bytes=100, max_document_bytes=60)
+    for key in ("a", "b", "c"):
+        cache.put(key, FeedSnapshot(state=state, body=b"x" * 40))
+    assert list(cache._snapshots) == ["b", "c"]
+    assert cache.total_bytes == 80
+
+    assert not cache.accepts(61)
+    cache.put("c", FeedSnapshot(state=state, body=b"x" * 61))
+    assert list(cache._snapshots) == ["b"]
+
+    # A compressed variant added on demand counts against the budget too
+    snapshot = cache.get("b", state)
+    snapshot.encoded["gzip"] = b"z" * 30
+    cache.put("d", FeedSnapshot(state=state, body=b"y" * 30))
+    assert list(cache._snapshots) == ["b", "d"]
+    cache.body_for(cache.get("d", state), "gzip")
+    assert list(cache._snapshots) == ["d"]
+    assert cache.total_bytes <= 100
+
+
+def test_snapshot_cache_single_flight_and_abandoned_render():
+    """Test one render per key and state, and a render running past render_wait_s is taken over."""
+    from api.wrapping.service import FeedState
+    from api.wrapping.snapshot import SnapshotCache
+
+    now = [0.0]
+    cache = SnapshotCache(render_wait_s=30, clock=lambda: now[0])
+    state = FeedState(1, 1, None, None)
+
+    first, leader = cache.start_render("feed", state)
+    assert leader
+    assert cache.start_render("feed", state) == (first, False)
+    # Another state or key renders independently
+    assert cache.start_render("feed", FeedState(2, 2, None, None))[1]
+    assert cache.start_render("index", state)[1]
+
+    second, leader = cache.start_render("feed", state)
+    assert leader
+    now[0] = 31
+    assert not cache.wait_render(second)
+    third, leader = cache.start_render("feed", state)
+    assert leader and third is not second
+
+    # Finishing the abandoned render does not release the one that replaced it
+    cache.finish_render("feed", second)
+    assert second.done.is_set()
+    assert cache.start_render("feed", state) == (third, False)
+    cache.finish_render("feed", third)
+    assert cache.wait_render(third)
+    assert cache.start_render("feed", state)[1]
+
+
+def test_wrapping_large_document_streamed_without_snapshot(client: TestClient, monkeypatch):
+    """Test a document over the per-document limit is streamed in full but never kept in memory."""
+    import gzip
+
+    from api.wrapping import wrapping
+    from api.wrapping.snapshot import SnapshotCache
+
+    cache = SnapshotCache(max_document_bytes=500)
+    monkeypatch.setattr(wrapping, "snapshot_cache", cache)
+    monkeypatch.setattr(wrapping, "STREAM_JOBS_PER_CHUNK", 1)
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        s.add_all(models.JobPostings(id=i, position=f"Job {i}") for i in range(1, 11))
+        s.commit()
+
+    r = client.get("/wrapping", headers={"Accept-Encoding": "identity"})
+    assert r.status_code == 200
+    assert len(r.content) > 500
+    assert r.text.count("<job>") == 10
+    with client.stream("GET", "/wrapping", headers={"Accept-Encoding": "gzip"}) as r:
+        raw = b"".join(r.iter_raw())
+    assert gzip.decompress(raw).count(b"<job>") == 10
+    assert len(cache) == 0
+
+    # The index is small enough and is cached
+    r = client.get("/wrapping/index", headers={"Accept-Encoding": "identity"})
+    assert r.status_code == 200
+    assert len(r.content) <= 500
+    assert len(cache) == 1
+
+
+def test_wrapping_concurrent_misses_render_once(client: TestClient, monkeypatch):
+    """Test concurrent requests for an uncached document wait for a single render and share its snapshot."""
+    import asyncio
+    import threading
+
+    import httpx
+
+    from api.wrapping import wrapping
+    from api.wrapping.snapshot import SnapshotCache
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        s.add_all(models.JobPostings(id=i, position=f"Job {i}") for i in range(1, 6))
+        s.commit()
+
+    followers_waiting = threading.Event()
+    waiting = []
+
+    class _Cache(SnapshotCache):
+        def wait_render(self, render):
+            waiting.append(render)
+            if len(waiting) == 3:
+                followers_waiting.set()
+            return super().wait_render(render)
+
+    monkeypatch.setattr(wrapping, "snapshot_cache", _Cache())
+    real_rows = wrapping.iter_available_job_postings
+    renders = []
+
+    def blocking_rows(session):
+        renders.append(session)
+        # The render only proceeds once the other three requests are waiting for it
+        assert followers_waiting.wait(10)
+        return real_rows(session)
+
+    monkeypatch.setattr(wrapping, "iter_available_job_postings", blocking_rows)
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", follow_redirects=True) as ac:
+            return await asyncio.gather(*(ac.get("/wrapping", headers={"Accept-Encoding": "identity"}) for _ in range(4)))
+
+    responses = asyncio.run(run())
+    assert [r.status_code for r in responses] == [200] * 4
+    assert len({r.content for r in responses}) == 1
+    assert responses[0].text.count("<job>") == 5
+    assert len(renders) == 1
+    assert len(waiting) == 3
+
+
+def test_negotiate_encoding():
+    """Test Accept-Encoding negotiation honours q-values and falls back to identity."""
+    from api.wrapping.encoding import negotiate_encoding
+
+    assert negotiate_encoding(None) is None
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("gzip;q=0") is None
+    assert negotiate_encoding("*") is not None
+
+
+def test_wrapping_gzip_negotiation(client: TestClient):
+    """Test gzip is served (streamed, then from the snapshot) and identity on request."""
+    import gzip
+    from datetime import datetime
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        # A fixed lastBuildDate: without one the header falls back to the current time and renders differ
+        s.add(models.JobPostings(id=1, position="Software Engineer", last_build_date=datetime(2024, 1, 8, 11, 34, 23)))
+        s.commit()
+
+    identity = client.get("/wrapping", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in identity.headers
+    assert identity.headers["vary"] == "Accept-Encoding"
+
+    # First request compresses while streaming, the second reuses the snapshot variant
+    snapshot_cache.clear()
+    for _ in range(2):
+        with client.stream("GET", "/wrapping", headers={"Accept-Encoding": "gzip"}) as r:
+            raw = b"".join(r.iter_raw())
+        assert r.headers["content-encoding"] == "gzip"
+        assert r.headers["etag"] != identity.headers["etag"]
+        assert gzip.decompress(raw) == identity.content
+
+
+def test_wrapping_uses_stored_xml_fragment(client: TestClient):
+    """Test stored fragments are served verbatim and match the on-the-fly rendering."""
+    from api.wrapping.wrapping import materialize_job_fragment, render_job_fragment
+
+    job = models.JobPostings(id=1, position="Software Engineer", partner_job_id="P-1", description="a ]]> b")
+    assert materialize_job_fragment(job) == render_job_fragment(job)
+    assert materialize_job_fragment(models.JobPostings(id=2, position="No partner id")) is None
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        s.add(models.JobPostings(id=1, position="Live", xml_fragment=" <job>stored</job>"))
+        s.add(models.JobPostings(id=2, position="Rendered"))
+        s.commit()
+
+    r = client.get("/wrapping")
+    assert " <job>stored</job>" in r.text
+    assert "<![CDATA[Live]]>" not in r.text
+    assert "<![CDATA[Rendered]]>" in r.text
+
+
+def test_feed_rows_skip_columns_covered_by_fragment(client: TestClient):
+    """Test feed queries fetch the rendered columns only for rows without a stored fragment."""
+    from datetime import datetime
+
+    from api.wrapping.service import iter_available_job_postings, iter_changed_job_postings, iter_job_postings_page
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        s.add(models.JobPostings(id=1, position="Live", description="long", partner_job_id="P1",
+                                 xml_fragment=" <job>stored</job>", updated_at=datetime(2024, 3, 1)))
+        s.add(models.JobPostings(id=2, position="Rendered", description="long", partner_job_id="P2",
+                                 updated_at=datetime(2024, 3, 1)))
+        s.commit()
+
+        for rows in (
+            list(iter_available_job_postings(s)),
+            list(iter_job_postings_page(s, 0)),
+            list(iter_changed_job_postings(s, datetime(2024, 1, 1))),
+        ):
+            assert [(row.id, row.partner_job_id, row.position, row.description) for row in rows] == [
+                (1, "P1", None, None),
+                (2, "P2", "Rendered", "long"),
+            ]
+
+
+def test_wrapping_index_and_pages(client: TestClient, monkeypatch):
+    """Test the feed index lists keyset pages that together contain every job."""
+    import re
+    from datetime import datetime
+    from api.wrapping import wrapping
+
+    monkeypatch.setattr(wrapping, "PAGE_SIZE", 2)
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        for i in (1, 2, 5, 7, 9):
+            s.add(models.JobPostings(id=i, position=f"Role {i}", last_build_date=datetime(2024, 1, i)))
+        s.commit()
+
+    r = client.get("/wrapping/index")
+    assert r.status_code == 200
+    assert r.text.startswith('<?xml version="1.0" encoding="UTF-8"?>\n<sourceIndex>')
+    urls = re.findall(r"<url><!\[CDATA\[(.*?)\]\]></url>", r.text)
+    assert [u.rsplit("after_id=", 1)[1] for u in urls] == ["0", "2", "7"]
+    assert "<jobs>1</jobs>" in r.text
+    assert "<lastBuildDate> Tue, 09 Jan 2024 00:00:00 -0000 </lastBuildDate>" in r.text
+
+    titles = []
+    for url in urls:
+        page = client.get(url)
+        assert page.status_code == 200
+        assert page.text.startswith('<?xml version="1.0" encoding="UTF-8"?>\n<source>')
+        titles += re.findall(r"<title><!\[CDATA\[(.*?)\]\]></title>", page.text)
+    assert titles == [f"Role {i}" for i in (1, 2, 5, 7, 9)]
+
+    # Pages are validated independently: changing a row in the last page leaves the first one intact
+    first_etag = client.get(urls[0]).headers["etag"]
+    last_etag = client.get(urls[2]).headers["etag"]
+    with next(get_sess()) as s:  # type: ignore
+        job = s.get(models.JobPostings, 9)
+        job.position = "Role 9 updated"
+        s.add(job)
+        s.commit()
+    assert client.get(urls[0], headers={"If-None-Match": first_etag}).status_code == 304
+    assert client.get(urls[2], headers={"If-None-Match": last_etag}).status_code == 200
+
+    # Only the pages listed in the index are kept as snapshots; arbitrary after_id values are served uncached
+    snapshot_cache.clear()
+    for after_id in (0, 2, 7, 1, 3, 5, 100):
+        assert client.get("/wrapping", params={"after_id": after_id}).status_code == 200
+    assert len(snapshot_cache) == 3
+
+
+def test_wrapping_page_validators_only_see_removals_in_their_range(client: TestClient, monkeypatch):
+    """Test a removal moves the validators of the page that contained it and leaves the other pages cached."""
+    import re
+    from datetime import datetime
+    from api.wrapping import wrapping
+
+    monkeypatch.setattr(wrapping, "PAGE_SIZE", 2)
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        for i in (1, 2, 5, 7, 9):
+            s.add(models.JobPostings(id=i, position=f"Role {i}", partner_job_id=f"P{i}", updated_at=datetime(2024, 1, i)))
+        s.commit()
+
+    urls = re.findall(r"<url><!\[CDATA\[(.*?)\]\]></url>", client.get("/wrapping/index").text)
+    assert [u.rsplit("after_id=", 1)[1] for u in urls] == ["0", "2", "7"]
+    before = {url: client.get(url).headers for url in urls}
+
+    # The last posting of the last page expires: its remaining row keeps the same timestamps
+    with next(get_sess()) as s:  # type: ignore
+        s.delete(s.get(models.JobPostings, 9))
+        s.add(models.JobPostingTombstone(partner_job_id="P9", deleted_at=datetime(2024, 2, 1), posting_id=9))
+        s.commit()
+
+    for url in urls[:2]:
+        headers = {"If-None-Match": before[url]["etag"], "If-Modified-Since": before[url]["last-modified"]}
+        assert client.get(url, headers=headers).status_code == 304
+    r = client.get(urls[2], headers={"If-Modified-Since": before[urls[2]]["last-modified"]})
+    assert r.status_code == 200
+    assert r.headers["last-modified"] == "Thu, 01 Feb 2024 00:00:00 GMT"
+
+    # A tombstone without posting_id (recorded before the column existed) cannot be placed and counts everywhere
+    with next(get_sess()) as s:  # type: ignore
+        s.add(models.JobPostingTombstone(partner_job_id="P3", deleted_at=datetime(2024, 3, 1)))
+        s.commit()
+    assert client.get(urls[0], headers={"If-None-Match": before[urls[0]]["etag"]}).status_code == 200
+
+
+def test_wrapping_delta_feed(client: TestClient):
+    """Test ?since= returns only changed jobs plus tombstones of removed ones."""
+    from datetime import datetime
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        s.add(models.JobPostings(id=1, position="Old", partner_job_id="P1", updated_at=datetime(2024, 1, 1)))
+        s.add(models.JobPostings(id=2, position="New", partner_job_id="P2", updated_at=datetime(2024, 3, 1)))
+        s.add(models.JobPostings(id=3, position="Back", partner_job_id="P3", updated_at=datetime(2024, 3, 1)))
+        s.add(models.JobPostingTombstone(partner_job_id="P9", deleted_at=datetime(2024, 2, 15)))
+        s.add(models.JobPostingTombstone(partner_job_id="P8", deleted_at=datetime(2024, 1, 15)))
+        # Removed and then published again: not a deletion anymore
+        s.add(models.JobPostingTombstone(partner_job_id="P3", deleted_at=datetime(2024, 2, 20)))
+        s.commit()
+
+    r = client.get("/wrapping", params={"since": "2024-02-01T00:00:00Z"})
+    assert r.status_code == 200
+    assert "<![CDATA[New]]>" in r.text
+    assert "<![CDATA[Back]]>" in r.text
+    assert "<![CDATA[Old]]>" not in r.text
+    assert r.text.count("<deletedJob>") == 1
+    assert "<partnerJobId><![CDATA[P9]]></partnerJobId>\n  <deletedAt> Thu, 15 Feb 2024 00:00:00 -0000 </deletedAt>" in r.text
+    assert r.text.endswith("</deletedJob>\n</source>")
+
+    etag = r.headers["etag"]
+    assert client.get("/wrapping", params={"since": "2024-02-01T00:00:00Z"}, headers={"If-None-Match": etag}).status_code == 304
+
+    # A new removal changes the delta even though no posting changed
+    with next(get_sess()) as s:  # type: ignore
+        s.add(models.JobPostingTombstone(partner_job_id="P7", deleted_at=datetime(2024, 3, 2)))
+        s.commit()
+    r = client.get("/wrapping", params={"since": "2024-02-01T00:00:00Z"}, headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.text.count("<deletedJob>") == 2
+
+    # Deltas are never stored as snapshots: each client-chosen since would hold a rendered copy
+    snapshot_cache.clear()
+    for since in ("2024-02-01T00:00:00Z", "1970-01-01T00:00:00Z"):
+        assert client.get("/wrapping", params={"since": since}).status_code == 200
+    assert len(snapshot_cache) == 0
+
+    # The full feed never lists deletions
+    assert "<deletedJob>" not in client.get("/wrapping").text
+
+
+
+def test_iter_changed_job_postings_batches_without_server_side_cursor(client: TestClient, monkeypatch):
+    """Test the delta rows are read in keyset batches filtered by updated_at when the driver buffers results."""
+    from datetime import datetime
+
+    from api.wrapping.service import iter_changed_job_postings
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        for i in range(1, 8):
+            s.add(models.JobPostings(id=i, position=f"Role {i}", updated_at=datetime(2024, 1 + i % 2 * 2, 1)))
+        s.commit()
+
+        statements = []
+        original_exec = s.exec
+        monkeypatch.setattr(s, "exec", lambda statement: statements.append(statement) or original_exec(statement))
+        ids = [job.id for job in iter_changed_job_postings(s, datetime(2024, 2, 1), batch_size=2)]
+    assert ids == [1, 3, 5, 7]
+    assert len(statements) == 3
+    assert all("yield_per" not in st.get_execution_options() for st in statements)
+
+
+def test_health_latency_flat_while_feeds_render(client: TestClient, monkeypatch):
+    """Load test: /health answers while several /wrapping renders are blocked in the database at once."""
+    import asyncio
+    import threading
+
+    import httpx
+
+    from api.wrapping import wrapping
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        s.add_all(models.JobPostings(id=i, position=f"Job {i}") for i in range(1, 51))
+        s.commit()
+
+    # Simulate a slow database: the state query blocks until the probes are done
+    real_state = wrapping.get_feed_state
+    release = threading.Event()
+    lock = threading.Lock()
+    in_flight = [0, 0]  # current, max
+
+    def slow_state(session):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        try:
+            release.wait(10)
+        finally:
+            with lock:
+                in_flight[0] -= 1
+        return real_state(session)
+
+    monkeypatch.setattr(wrapping, "get_feed_state", slow_state)
+    monkeypatch.setattr(wrapping, "SNAPSHOT_CACHE_ENABLED", False)
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", follow_redirects=True) as ac:
+            async def probe():
+                try:
+                    for _ in range(500):
+                        if in_flight[0] == 6:
+                            break
+                        await asyncio.sleep(0.01)
+                    answered_while_blocked = []
+                    for _ in range(10):
+                        r = await ac.get("/health")
+                        answered_while_blocked.append(r.status_code == 200 and in_flight[0] == 6)
+                    return answered_while_blocked
+                finally:
+                    release.set()
+
+            feeds = [ac.get("/wrapping") for _ in range(6)]
+            *responses, answered = await asyncio.gather(*feeds, probe())
+            return responses, answered
+
+    responses, answered = asyncio.run(run())
+    assert [(r.status_code, r.text.count("<job>")) for r in responses] == [(200, 50)] * 6
+    # The six renders were in the database together and every probe was answered meanwhile
+    assert in_flight[1] == 6
+    assert answered == [True] * 10
+
+
+def _metric_value(text: str, sample: str) -> float:
+    for line in text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+def test_metrics_endpoint_reports_feed_builds(client: TestClient):
+    """Test /metrics exposes request latency per route and status and the feed build timers and counters."""
+    import gzip
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        for i in range(1, 4):
+            s.add(models.JobPostings(id=i, position=f"Job {i}"))
+        s.commit()
+
+    before = client.get("/metrics").text
+    snapshot_cache.clear()
+    with client.stream("GET", "/wrapping", headers={"Accept-Encoding": "gzip"}) as r:
+        raw = b"".join(r.iter_raw())
+    assert gzip.decompress(raw).count(b"<job>") == 3
+    # Served from the snapshot: counted as bytes sent, not as a build
+    with client.stream("GET", "/wrapping", headers={"Accept-Encoding": "gzip"}) as r:
+        cached = b"".join(r.iter_raw())
+    client.get("/missing")
+
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain; version=0.0.4")
+    after = r.text
+
+    def delta(sample: str) -> float:
+        return _metric_value(after, sample) - _metric_value(before, sample)
+
+    assert delta('http_request_duration_seconds_count{route="/wrapping/",status="200"}') == 2
+    assert delta('http_request_duration_seconds_count{route="unmatched",status="404"}') == 1
+    assert delta('wrapping_db_fetch_seconds_count{kind="feed"}') == 2
+    assert delta('wrapping_render_seconds_count{kind="feed"}') == 1
+    assert delta('wrapping_encode_seconds_count{kind="feed"}') == 1
+    assert delta('wrapping_rows_sum{kind="feed"}') == 3
+    assert delta('wrapping_rows_bucket{kind="feed",le="10"}') == 1
+    assert delta('wrapping_response_bytes_total{kind="feed"}') == len(raw) + len(cached)
+    # Label combinations are created up front, so idle series are exported as zero
+    assert 'wrapping_render_seconds_count{kind="delta"}' in after
+
+
+def test_iter_all_streams_only_with_server_side_cursors(client: TestClient, monkeypatch):
+    """Test buffering drivers (mysql-connector, SQLite) use keyset batches and streaming drivers one cursor."""
+    from sqlalchemy import create_engine as sa_create_engine
+
+    from api.wrapping import service
+
+    assert not service.streams_results(Session(sa_create_engine("mysql+mysqlconnector://user:pw@db/lw")))
+
+    get_sess = list(app.dependency_overrides.values())[0]
+    with next(get_sess()) as s:  # type: ignore
+        for i in range(1, 6):
+            s.add(models.JobPostings(id=i, position=f"Role {i}"))
+        s.commit()
+
+        statements = []
+        original_exec = s.exec
+
+        def spy_exec(statement, *args, **kwargs):
+            statements.append(statement)
+            return original_exec(statement, *args, **kwargs)
+
+        monkeypatch.setattr(s, "exec", spy_exec)
+        assert [job.id for job in service.iter_all(s, models.JobPostings, batch_size=2)] == [1, 2, 3, 4, 5]
+        assert len(statements) == 4
+        assert all("yield_per" not in st.get_execution_options() for st in statements)
+
+        # SQLite has no server-side cursors: only check the statement the streaming branch issues
+        statements.clear()
+        monkeypatch.setattr(service, "streams_results", lambda session: True)
+        monkeypatch.setattr(s, "exec", lambda statement: statements.append(statement) or [])
+        assert list(service.iter_all(s, models.JobPostings, batch_size=2)) == []
+        assert len(statements) == 1
+        assert statements[0].get_execution_options()["yield_per"] == 2
@@ -0,0 +1,306 @@
+from __future__ import annotations
+
+import asyncio
+import ipaddress
+import json
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+import httpx
+
+
+GEO_LOOKUP_BASE = os.getenv("GEO_LOOKUP_BASE", "https://ipwho.is")
+GEO_LOOKUP_TIMEOUT_MS = int(os.getenv("GEO_LOOKUP_TIMEOUT_MS", "150"))
+GEO_MAX_CONNECTIONS = int(os.getenv("GEO_MAX_CONNECTIONS", "10"))
+GEO_CACHE_MAX_ENTRIES = int(os.getenv("GEO_CACHE_MAX_ENTRIES", "10000"))
+GEO_CACHE_TTL_S = float(os.getenv("GEO_CACHE_TTL_S", "86400"))
+# Failed or empty lookups are cached for a shorter time so a flaky provider is retried
+GEO_CACHE_NEGATIVE_TTL_S = float(os.getenv("GEO_CACHE_NEGATIVE_TTL_S", "300"))
+# Local range database (built with scripts/build_geo_db.py); the HTTP provider is only asked on a miss
+GEO_DB_PATH = os.getenv("GEO_DB_PATH", "")
+GEO_HTTP_FALLBACK = os.getenv("GEO_HTTP_FALLBACK", "true").lower() in ("1", "true", "yes")
+
+
+def is_private_ip(ip: Optional[str]) -> bool:
+    if not ip:
+        return True
+    try:
+        if ip.startswith("127.") or ip == "::1":
+            return True
+        if ip.startswith("10."):
+            return True
+        if ip.startswith("192.168."):
+            return True
+        if ip.startswith("172."):
+            # 172.16.0.0 – 172.31.255.255
+            try:
+                second = int(ip.split(".")[1])
+                return 16 <= second <= 31
+            except Exception:
+                return False
+    except Exception:
+        return False
+    return False
+
+
+class GeoCache:
+    """In-process LRU cache of geo lookups keyed by IP, with per-entry expiry."""
+
+    def __init__(
+        self,
+        max_entries: int = GEO_CACHE_MAX_ENTRIES,
+        ttl_s: float = GEO_CACHE_TTL_S,
+        negative_ttl_s: float = GEO_CACHE_NEGATIVE_TTL_S,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.negative_ttl_s = negative_ttl_s
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    def get(self, ip: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(ip)
+        if entry is None or entry[0] <= self.clock():
+            if entry is not None:
+                del self._entries[ip]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(ip)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, ip: str, geo: Dict[str, Any]) -> None:
+        ttl_s = self.ttl_s if geo else self.negative_ttl_s
+        self._entries[ip] = (self.clock() + ttl_s, geo)
+        self._entries.move_to_end(ip)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+geo_cache = GeoCache()
+
+
+def _ip_key(ip: str) -> bytes:
+    """16-byte big-endian key: IPv4 addresses are mapped into ::ffff:0:0/96 so both families share one table."""
+    address = ipaddress.ip_address(ip)
+    if address.version == 4:
+        address = ipaddress.IPv6Address(b"\x00" * 10 + b"\xff\xff" + address.packed)
+    return address.packed
+
+
+class RangeGeoDatabase:
+    """
+    Read-only geo database of sorted, non-overlapping IP ranges, memory-mapped and searched with bisection.
+
+    File layout (big-endian): an 8-byte magic, the record count and the offset of the string table;
+    fixed-size records (range start, range end, offset of the geo entry); then the string table, where
+    each geo dict is stored once as length-prefixed JSON.
+    """
+
+    MAGIC = b"LWGEODB1"
+    HEADER = struct.Struct(">8sII")
+    RECORD = struct.Struct(">16s16sI")
+    LENGTH = struct.Struct(">I")
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.record_count, self._strings_offset = self.HEADER.unpack_from(self._mm, 0)
+        if magic != self.MAGIC:
+            self._mm.close()
+            raise ValueError(f"{path} is not a geo range database")
+        self._geo_by_offset: Dict[int, Dict[str, Any]] = {}
+
+    def _start(self, index: int) -> bytes:
+        offset = self.HEADER.size + index * self.RECORD.size
+        return self._mm[offset:offset + 16]
+
+    def _geo(self, offset: int) -> Dict[str, Any]:
+        geo = self._geo_by_offset.get(offset)
+        if geo is None:
+            position = self._strings_offset + offset
+            (length,) = self.LENGTH.unpack_from(self._mm, position)
+            start = position + self.LENGTH.size
+            geo = json.loads(self._mm[start:start + length])
+            self._geo_by_offset[offset] = geo
+        return geo
+
+    def lookup(self, ip: str) -> Optional[Dict[str, Any]]:
+        """Geo dict of the range containing ip, or None when no range matches."""
+        try:
+            key = _ip_key(ip)
+        except ValueError:
+            return None
+        # Last record whose start is <= key
+        lo, hi = 0, self.record_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._start(mid) <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        _, end, geo_offset = self.RECORD.unpack_from(self._mm, self.HEADER.size + (lo - 1) * self.RECORD.size)
+        return self._geo(geo_offset) if key <= end else None
+
+    def close(self) -> None:
+        self._mm.close()
+
+
+def write_range_database(path: str, ranges: Iterable[Tuple[str, str, Dict[str, Any]]]) -> int:
+    """Write (first ip, last ip, geo) ranges in the RangeGeoDatabase format; returns the number of ranges."""
+    records = sorted((_ip_key(first), _ip_key(last), geo) for first, last, geo in ranges)
+    strings = bytearray()
+    offsets: Dict[str, int] = {}
+    body = bytearray()
+    previous_end = None
+    for start, end, geo in records:
+        if end < start:
+            raise ValueError(f"Invalid range {ipaddress.IPv6Address(start)} - {ipaddress.IPv6Address(end)}")
+        if previous_end is not None and start <= previous_end:
+            raise ValueError(f"Overlapping range starting at {ipaddress.IPv6Address(start)}")
+        previous_end = end
+        encoded = json.dumps(geo, ensure_ascii=False, sort_keys=True)
+        if encoded not in offsets:
+            offsets[encoded] = len(strings)
+            data = encoded.encode("utf-8")
+            strings += RangeGeoDatabase.LENGTH.pack(len(data)) + data
+        body += RangeGeoDatabase.RECORD.pack(start, end, offsets[encoded])
+    strings_offset = RangeGeoDatabase.HEADER.size + len(body)
+    with open(path, "wb") as f:
+        f.write(RangeGeoDatabase.HEADER.pack(RangeGeoDatabase.MAGIC, len(records), strings_offset))
+        f.write(body)
+        f.write(strings)
+    return len(records)
+
+
+_geo_database: Optional[RangeGeoDatabase] = None
+_geo_database_loaded = False
+
+
+def get_geo_database() -> Optional[RangeGeoDatabase]:
+    """The local range database from GEO_DB_PATH, opened once; None when unset or unreadable."""
+    global _geo_database, _geo_database_loaded
+    if not _geo_database_loaded:
+        _geo_database_loaded = True
+        if GEO_DB_PATH:
+            try:
+                _geo_database = RangeGeoDatabase(GEO_DB_PATH)
+            except (OSError, ValueError) as exc:
+                # utils.logger imports this module, so the logger is only imported when needed
+                from utils.logger import get_logger
+
+                get_logger().warning(
+                    "geo_database_unavailable",
+                    extra={"extra": {"event": "geo_database_unavailable", "path": GEO_DB_PATH, "error": str(exc)}},
+                )
+    return _geo_database
+
+
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_geo_client() -> httpx.AsyncClient:
+    """Shared pooled client for the geo provider (created lazily, once per event loop)."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client_loop = loop
+        _client = httpx.AsyncClient(
+            timeout=GEO_LOOKUP_TIMEOUT_MS / 1000.0,
+            limits=httpx.Limits(max_connections=GEO_MAX_CONNECTIONS, max_keepalive_connections=GEO_MAX_CONNECTIONS),
+        )
+    return _client
+
+
+async def close_geo_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _parse_ipwhois(data: Dict[str, Any]) -> Dict[str, Any]:
+    # ipwho.is returns {success: bool, ...}
+    if not data or ("success" in data and not data.get("success")):
+        return {}
+    lat = data.get("latitude")
+    lon = data.get("longitude")
+    geo = {
+        "region_iso_code": data.get("region_code"),
+        "continent_name": data.get("continent"),
+        "city_name": data.get("city"),
+        "country_iso_code": data.get("country_code"),
+        "country_name": data.get("country"),
+        "location": {"lon": lon, "lat": lat} if lat is not None and lon is not None else None,
+        "region_name": data.get("region"),
+    }
+    # Drop None location if incomplete
+    if geo.get("location") is None:
+        geo.pop("location", None)
+    return geo
+
+
+async def fetch_geo(ip: str) -> Dict[str, Any]:
+    """Query the HTTP geo provider; any failure yields an empty result."""
+    try:
+        resp = await get_geo_client().get(f"{GEO_LOOKUP_BASE}/{ip}")
+        return _parse_ipwhois(resp.json())
+    except Exception:
+        return {}
+
+
+_in_flight: Dict[str, "asyncio.Future[Dict[str, Any]]"] = {}
+
+
+async def lookup_geo(ip: Optional[str]) -> Dict[str, Any]:
+    """
+    Geo information for a public IP: from the local range database when configured, otherwise (or on a
+    miss, unless GEO_HTTP_FALLBACK is off) from the HTTP provider through the cache, with concurrent
+    lookups of one IP coalesced.
+    """
+    if is_private_ip(ip):
+        return {}
+    database = get_geo_database()
+    if database is not None:
+        geo = database.lookup(ip)
+        if geo is not None:
+            return geo
+        if not GEO_HTTP_FALLBACK:
+            return {}
+    cached = geo_cache.get(ip)
+    if cached is not None:
+        return cached
+    pending = _in_flight.get(ip)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    future = asyncio.get_running_loop().create_future()
+    _in_flight[ip] = future
+    try:
+        geo = await fetch_geo(ip)
+        geo_cache.put(ip, geo)
+        future.set_result(geo)
+        return geo
+    except BaseException:
+        # Cancelled: coalesced callers get an empty result instead of the cancellation
+        future.set_result({})
+        raise
+    finally:
+        _in_flight.pop(ip, None)
@@ -1,10 +1,56 @@
 from __future__ import annotations
 
+import asyncio
+import atexit
+import functools
 import json
 import logging
+import logging.handlers
 import os
+import queue
 import time
-from typing import Any, Dict, Optional
+from typing import IO, Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from utils.geo import is_private_ip, lookup_geo
+
+# Prefer the user-agents library if available
+try:
+    from user_agents import parse as ua_parse  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    ua_parse = None  # type: ignore
+
+# Parsed user agents kept in memory; longer strings (UA spam) are parsed without being cached
+UA_CACHE_MAX_ENTRIES = int(os.getenv("UA_CACHE_MAX_ENTRIES", "1024"))
+UA_CACHE_MAX_LENGTH = int(os.getenv("UA_CACHE_MAX_LENGTH", "512"))
+
+
+# Log records waiting to be written by the background listener, and records written per stdout write
+LOG_QUEUE_MAX_SIZE = int(os.getenv("LOG_QUEUE_MAX_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "256"))
+# Set to false to write records synchronously from the calling thread
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() in ("1", "true", "yes")
+# Request log policies: comma-separated "route=action" and "status=action" pairs, action being
+# skip, always or sample:N (one request in N); status overrides win over route policies
+LOG_ROUTE_POLICIES = os.getenv("LOG_ROUTE_POLICIES", "/health=skip,/metrics=skip")
+LOG_STATUS_POLICIES = os.getenv("LOG_STATUS_POLICIES", "5xx=always")
+
+
+def _json_dumps(data: Dict[str, Any]) -> str:
+    return json.dumps(data, ensure_ascii=False, default=str)
+
+
+# Prefer orjson if available (several times faster on the request log payloads)
+try:
+    import orjson  # type: ignore
+
+    def _dumps(data: Dict[str, Any]) -> str:
+        try:
+            return orjson.dumps(data, default=str).decode("utf-8")
+        except TypeError:
+            # e.g. non-string keys, which orjson rejects
+            return _json_dumps(data)
+except Exception:  # pragma: no cover - optional dependency
+    _dumps = _json_dumps
 
 
 class JsonFormatter(logging.Formatter):
@@ -18,14 +64,158 @@ class JsonFormatter(logging.Formatter):
             base["exc_info"] = self.formatException(record.exc_info)
         if hasattr(record, "extra") and isinstance(getattr(record, "extra"), dict):
             base.update(getattr(record, "extra"))
-        return json.dumps(base, ensure_ascii=False)
+        return _dumps(base)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a bounded queue without blocking. Formatting happens on the listener thread, and
+    when the queue is full (the output cannot keep up) the record is dropped and counted instead.
+    """
+
+    def __init__(self, log_queue: "queue.Queue[Any]"):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # QueueHandler.prepare formats the record on the calling thread; the listener does it instead
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchStreamHandler(logging.StreamHandler):
+    """StreamHandler that writes a batch of records with a single write and flush."""
+
+    def emit_batch(self, records: List[logging.LogRecord]) -> None:
+        lines = []
+        for record in records:
+            if record.levelno < self.level or not self.filter(record):
+                continue
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+        if not lines:
+            return
+        with self.lock:
+            try:
+                self.stream.write(self.terminator.join(lines) + self.terminator)
+                self.flush()
+            except Exception:
+                self.handleError(records[-1])
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener that drains up to batch_size queued records at a time and hands them to the
+    handlers in one go. Records dropped by the queue handler are reported as a warning record.
+    """
+
+    def __init__(self, log_queue: "queue.Queue[Any]", *handlers: logging.Handler, batch_size: int = LOG_BATCH_SIZE,
+                 queue_handler: Optional[DroppingQueueHandler] = None):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = max(1, batch_size)
+        self.queue_handler = queue_handler
+        self._reported_dropped = 0
+
+    def enqueue_sentinel(self) -> None:
+        # Blocking put: the sentinel must get in even when the queue is full
+        self.queue.put(self._sentinel)
+
+    def _dropped_record(self) -> Optional[logging.LogRecord]:
+        if self.queue_handler is None or self.queue_handler.dropped == self._reported_dropped:
+            return None
+        dropped = self.queue_handler.dropped - self._reported_dropped
+        self._reported_dropped = self.queue_handler.dropped
+        record = logging.LogRecord(
+            self.queue_handler.name or "logging", logging.WARNING, __file__, 0, "log_records_dropped", None, None
+        )
+        record.extra = {"message": "log_records_dropped", "dropped": dropped}
+        return record
+
+    def handle_batch(self, records: List[logging.LogRecord]) -> None:
+        dropped = self._dropped_record()
+        if dropped is not None:
+            records = [dropped, *records]
+        for handler in self.handlers:
+            if isinstance(handler, BatchStreamHandler):
+                handler.emit_batch(records)
+            else:
+                for record in records:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+
+    def _monitor(self) -> None:
+        has_task_done = hasattr(self.queue, "task_done")
+        stopping = False
+        while not stopping:
+            batch = [self.dequeue(True)]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.dequeue(False))
+                except queue.Empty:
+                    break
+            records = []
+            for record in batch:
+                if record is self._sentinel:
+                    stopping = True
+                else:
+                    records.append(record)
+            if records:
+                self.handle_batch(records)
+            if has_task_done:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+def create_queue_logging(
+    stream: Optional[IO[str]] = None,
+    max_size: int = LOG_QUEUE_MAX_SIZE,
+    batch_size: int = LOG_BATCH_SIZE,
+) -> Tuple[DroppingQueueHandler, BatchingQueueListener]:
+    """Queue handler to attach to a logger, and the (not yet started) listener writing JSON lines to stream."""
+    log_queue: "queue.Queue[Any]" = queue.Queue(maxsize=max_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    stream_handler = BatchStreamHandler(stream)
+    stream_handler.setFormatter(JsonFormatter())
+    listener = BatchingQueueListener(log_queue, stream_handler, batch_size=batch_size, queue_handler=queue_handler)
+    return queue_handler, listener
+
+
+_listeners: Dict[str, BatchingQueueListener] = {}
+
+
+def stop_logging() -> None:
+    """Write out the queued records and stop the background listeners."""
+    while _listeners:
+        _, listener = _listeners.popitem()
+        listener.stop()
+
+
+atexit.register(stop_logging)
 
 
 def get_logger(name: str = "linkedin-wrapping-service") -> logging.Logger:
+    """
+    Service logger writing JSON lines to stderr. Unless LOG_ASYNC is off, records go through a bounded
+    queue to a background thread that serializes and writes them in batches, so a slow stream never
+    blocks the caller (records that do not fit in the queue are dropped and counted).
+    """
     logger = logging.getLogger(name)
     if not logger.handlers:
-        handler = logging.StreamHandler()
-        handler.setFormatter(JsonFormatter())
+        if LOG_ASYNC:
+            handler, listener = create_queue_logging()
+            handler.name = name
+            listener.start()
+            _listeners[name] = listener
+        else:
+            handler = logging.StreamHandler()
+            handler.setFormatter(JsonFormatter())
         logger.addHandler(handler)
         logger.setLevel(logging.INFO)
     logger.propagate = False
@@ -33,16 +223,24 @@ def get_logger(name: str = "linkedin-wrapping-service") -> logging.Logger:
 
 
 def parse_user_agent(ua: Optional[str]) -> Dict[str, Any]:
+    """Parsed user agent for the log payload; repeated strings are served from a bounded LRU cache."""
     if not ua:
         return {}
+    if len(ua) > UA_CACHE_MAX_LENGTH:
+        return _parse_user_agent(ua)
+    parsed = _cached_parse_user_agent(ua)
+    # Copy the nested blocks so callers cannot alter the cached entry
+    return {key: dict(value) if isinstance(value, dict) else value for key, value in parsed.items()}
+
+
+def user_agent_cache_info() -> Dict[str, int]:
+    info = _cached_parse_user_agent.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max_size": info.maxsize}
+
+
+def _parse_user_agent(ua: str) -> Dict[str, Any]:
     parsed: Dict[str, Any] = {"original": ua}
     try:
-        # Prefer the user-agents library if available
-        try:
-            from user_agents import parse as ua_parse  # type: ignore
-        except Exception:  # pragma: no cover - optional dependency
-            ua_parse = None  # type: ignore
-
         if ua_parse:
             ua_obj = ua_parse(ua)
             browser_name = ua_obj.browser.family or "Unknown"
@@ -97,6 +295,9 @@ def parse_user_agent(ua: Optional[str]) -> Dict[str, Any]:
     return parsed
 
 
+_cached_parse_user_agent = functools.lru_cache(maxsize=UA_CACHE_MAX_ENTRIES)(_parse_user_agent)
+
+
 def build_log_payload(
     *,
     started_at_ns: int,
@@ -156,58 +357,161 @@ def build_log_payload(
     return payload
 
 
-def _is_private_ip(ip: Optional[str]) -> bool:
-    if not ip:
-        return True
-    try:
-        if ip.startswith("127.") or ip == "::1":
-            return True
-        if ip.startswith("10."):
-            return True
-        if ip.startswith("192.168."):
+SKIP = "skip"
+ALWAYS = "always"
+SAMPLE = "sample"
+
+
+def parse_log_policies(spec: str) -> Dict[str, Tuple[str, int]]:
+    """
+    Parse "key=action,..." into {key: (action, rate)}. Actions: skip, always, sample:N.
+    Raises ValueError on malformed entries so a typo in the configuration fails at startup.
+    """
+    policies: Dict[str, Tuple[str, int]] = {}
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        key, sep, action = entry.rpartition("=")
+        key, action = key.strip(), action.strip().lower()
+        if not sep or not key:
+            raise ValueError(f"Invalid log policy {entry!r}: expected key=action")
+        name, _, rate = action.partition(":")
+        if action in (SKIP, ALWAYS):
+            policies[key] = (action, 1)
+        elif name == SAMPLE and rate.isdigit() and int(rate) > 0:
+            policies[key] = (SAMPLE, int(rate))
+        else:
+            raise ValueError(f"Invalid log policy action {action!r} for {key!r}: expected skip, always or sample:N")
+    return policies
+
+
+class RequestLogPolicy:
+    """
+    Decides whether a request is logged, before any payload is built.
+    Route keys are exact paths, or prefixes ending in "*"; status keys are codes ("404") or classes ("5xx").
+    Sampled routes log every N-th request (deterministically, with one counter per policy entry).
+    Requests that match no policy are always logged.
+    """
+
+    def __init__(self, route_policies: str = LOG_ROUTE_POLICIES, status_policies: str = LOG_STATUS_POLICIES):
+        routes = parse_log_policies(route_policies)
+        self._exact = {path: policy for path, policy in routes.items() if not path.endswith("*")}
+        # Longest prefix first so the most specific policy wins
+        self._prefixes = sorted(
+            ((path[:-1], policy) for path, policy in routes.items() if path.endswith("*")),
+            key=lambda item: len(item[0]),
+            reverse=True,
+        )
+        self._statuses = {key.lower(): policy for key, policy in parse_log_policies(status_policies).items()}
+        self._counters: Dict[str, int] = {}
+
+    def _route_policy(self, path: str) -> Tuple[Optional[str], Optional[Tuple[str, int]]]:
+        policy = self._exact.get(path)
+        if policy is not None:
+            return path, policy
+        for prefix, policy in self._prefixes:
+            if path.startswith(prefix):
+                return prefix + "*", policy
+        return None, None
+
+    def _status_policy(self, status_code: int) -> Tuple[Optional[str], Optional[Tuple[str, int]]]:
+        for key in (str(status_code), f"{status_code // 100}xx"):
+            policy = self._statuses.get(key)
+            if policy is not None:
+                return f"status:{key}", policy
+        return None, None
+
+    def should_log(self, path: str, status_code: int) -> bool:
+        key, policy = self._status_policy(status_code)
+        if policy is None:
+            key, policy = self._route_policy(path)
+        if policy is None:
             return True
-        if ip.startswith("172."):
-            # 172.16.0.0 – 172.31.255.255
+        action, rate = policy
+        if action == SAMPLE:
+            count = self._counters.get(key, 0)
+            self._counters[key] = count + 1
+            return count % rate == 0
+        return action == ALWAYS
+
+
+request_log_policy = RequestLogPolicy()
+
+
+class GeoLogQueue:
+    """
+    Emits request log records off the request path. Records for public IPs are queued and a few
+    background tasks attach the (cached) geo lookup before logging them, so request latency does not
+    depend on the geo provider. When the queue is full the record is logged at once without geo.
+    """
+
+    def __init__(
+        self,
+        lookup: Callable[[Optional[str]], Awaitable[Dict[str, Any]]] = lookup_geo,
+        max_size: int = int(os.getenv("GEO_QUEUE_MAX_SIZE", "1000")),
+        concurrency: int = int(os.getenv("GEO_LOOKUP_CONCURRENCY", "4")),
+    ):
+        self.lookup = lookup
+        self.max_size = max_size
+        self.concurrency = max(1, concurrency)
+        self.dropped = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: list[asyncio.Task] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _ensure_started(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if self._queue is None or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=self.max_size)
+            self._workers = [loop.create_task(self._worker(self._queue)) for _ in range(self.concurrency)]
+        return self._queue
+
+    def submit(self, payload: Dict[str, Any], client_ip: Optional[str]) -> None:
+        """Never blocks: must be called from the event loop."""
+        if is_private_ip(client_ip):
+            _emit(payload)
+            return
+        try:
+            self._ensure_started().put_nowait((payload, client_ip))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            _emit(payload)
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            payload, client_ip = await queue.get()
             try:
-                second = int(ip.split(".")[1])
-                return 16 <= second <= 31
+                geo = await self.lookup(client_ip)
+                if geo:
+                    payload["destination"]["geo"] = geo
+                _emit(payload)
             except Exception:
-                return False
-    except Exception:
-        return False
-    return False
+                # Never lose the record because of the geo provider
+                _emit(payload)
+            finally:
+                queue.task_done()
 
+    async def drain(self) -> None:
+        """Wait until every queued record has been logged."""
+        if self._queue is not None and self._loop is asyncio.get_running_loop():
+            await self._queue.join()
 
-async def lookup_geo(ip: Optional[str]) -> Dict[str, Any]:
-    if _is_private_ip(ip):
-        return {}
-    base = os.getenv("GEO_LOOKUP_BASE", "https://ipwho.is")
-    url = f"{base}/{ip}"
-    timeout_ms = int(os.getenv("GEO_LOOKUP_TIMEOUT_MS", "150"))
+    async def close(self) -> None:
+        await self.drain()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+
+
+def _emit(payload: Dict[str, Any]) -> None:
     try:
-        import httpx  # local import to keep baseline lightweight
-        async with httpx.AsyncClient(timeout=timeout_ms / 1000.0) as client:
-            resp = await client.get(url)
-            data = resp.json()
-            # ipwho.is returns {success: bool, ...}
-            if not data or ("success" in data and not data.get("success")):
-                return {}
-            lat = data.get("latitude")
-            lon = data.get("longitude")
-            geo = {
-                "region_iso_code": data.get("region_code"),
-                "continent_name": data.get("continent"),
-                "city_name": data.get("city"),
-                "country_iso_code": data.get("country_code"),
-                "country_name": data.get("country"),
-                "location": {"lon": lon, "lat": lat} if lat is not None and lon is not None else None,
-                "region_name": data.get("region"),
-            }
-            # Drop None location if incomplete
-            if geo.get("location") is None:
-                geo.pop("location", None)
-            return geo
+        get_logger().info("http_request", extra={"extra": payload})
     except Exception:
-        return {}
+        pass
 
 
+request_log_queue = GeoLogQueue()